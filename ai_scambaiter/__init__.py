@@ -1,5 +1,5 @@
 from __future__ import annotations
-from collections.abc import Sequence
+from collections.abc import Mapping, Sequence
 from enum import Enum, auto
 
 
@@ -10,11 +10,13 @@ from dataclasses import dataclass
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from typing import AsyncIterator
+    from collections.abc import Collection
+    from typing import AsyncContextManager, AsyncIterator
 
     from telethon.hints import TotalList
     from telethon.tl.custom import Message
     from ai_scambaiter.agent import Agent
+    from ai_scambaiter.history import ChatHistory
 
 
 class Role(Enum):
@@ -23,13 +25,36 @@ class Role(Enum):
     SYSTEM = auto()
 
 
-@dataclass
+@dataclass(slots=True)
 class GPTMessage:
+    """One message of a conversation. Agents hold many thousands of these, so the
+    class has no per-instance __dict__."""
+
     content: str
     role: Role
     n_tokens: int
 
 
+@dataclass
+class TokenUsage:
+    """Tokens spent on the requests of one agent."""
+
+    requests: int = 0
+    prompt_tokens: int = 0
+    # Prompt tokens served from the provider's prompt cache
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    # Requests which were cancelled or whose reply was discarded because newer
+    # messages arrived, and the (estimated) tokens spent on them
+    superseded_requests: int = 0
+    superseded_tokens: int = 0
+
+
+class IncompleteReplyError(Exception):
+    """The model stopped before the end of the reply (e.g. at the length limit
+    or by a content filter)."""
+
+
 class TelegramInterface(ABC):
     @abstractmethod
     async def start(self) -> None:
@@ -37,7 +62,11 @@ class TelegramInterface(ABC):
 
     @abstractmethod
     async def get_messages(
-        self, chat_id: int, number_of_messages: int = 100, oldest_first: bool = False
+        self,
+        chat_id: int,
+        number_of_messages: int = 100,
+        oldest_first: bool = False,
+        min_id: int = 0,
     ) -> TotalList:
         raise NotImplementedError()
 
@@ -46,14 +75,44 @@ class TelegramInterface(ABC):
     def dialogs(self) -> dict[int, object]:
         raise NotImplementedError()
 
+    async def get_dialog(self, chat_id_or_title: str) -> object | None:
+        """The dialog with this chat id or title, None if there is none."""
+        try:
+            return self.dialogs.get(int(chat_id_or_title))
+        except ValueError:
+            return next(
+                (
+                    d
+                    for d in self.dialogs.values()
+                    if getattr(d, "title", None) == chat_id_or_title
+                ),
+                None,
+            )
+
+    @abstractmethod
+    async def send_message(
+        self, chat_id: int, message: str, replace: bool = False
+    ) -> bool | None:
+        """Sends the message. replace marks it as a reply of the agent, which
+        drops the older replies of the chat still waiting to be sent; other
+        messages are always sent. Returns False if the message was dropped
+        because a newer reply replaced it."""
+        raise NotImplementedError()
+
     @abstractmethod
-    async def send_message(self, chat_id: int, message: str) -> None:
+    def typing(self, chat_id: int) -> AsyncContextManager[object]:
+        """Shows the typing indicator in the chat while the context is active."""
         raise NotImplementedError()
 
     @abstractmethod
     async def delete_last_message(self, chat_id: int) -> None:
         raise NotImplementedError()
 
+    @abstractmethod
+    def set_monitored_chats(self, chat_ids: Collection[int] | None) -> None:
+        """Only chats in chat_ids need to be delivered by message_stream."""
+        raise NotImplementedError()
+
     @abstractmethod
     async def message_stream(self) -> AsyncIterator[Message]:
         raise NotImplementedError()
@@ -72,11 +131,22 @@ class BotRunner(ABC):
     async def start(self) -> None:
         raise NotImplementedError()
 
+    @abstractmethod
+    async def stop(self) -> None:
+        raise NotImplementedError()
+
     @property
     @abstractmethod
     def agents(self) -> dict[int, Agent]:
         raise NotImplementedError()
 
+    @property
+    @abstractmethod
+    def chat_ids(self) -> Sequence[int]:
+        """The chat ids of the agents, in the order of agents, so the chat with
+        an index is found without iterating over them."""
+        raise NotImplementedError()
+
 
 class ChatGPTInterface(ABC):
     @abstractmethod
@@ -84,11 +154,89 @@ class ChatGPTInterface(ABC):
         raise NotImplementedError()
 
     @abstractmethod
-    def shorten_history(
-        self, n_preamble_tokens: int, history: list[GPTMessage]
+    def number_of_tokens_batch(self, texts: Sequence[str]) -> list[int]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def shorten_history(self, n_preamble_tokens: int, history: ChatHistory) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def message_param(self, message: GPTMessage) -> object:
+        """The representation of the message in requests to the provider."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def send_and_receive(
+        self,
+        messages: Sequence[GPTMessage],
+        usage: TokenUsage | None = None,
+        params: Sequence[object] | None = None,
+    ) -> str | None:
+        """Returns the reply to the messages, None on errors. The tokens used are
+        added to usage. If given, params must be the message_param of each
+        message; they are sent as they are instead of converting the messages."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def stream_and_receive(
+        self,
+        messages: Sequence[GPTMessage],
+        usage: TokenUsage | None = None,
+        params: Sequence[object] | None = None,
+    ) -> AsyncIterator[str]:
+        """Like send_and_receive, but yields the reply in pieces while it is
+        generated. Closing the iterator stops the generation. Where
+        send_and_receive returns None for a reply that was cut off, this raises
+        IncompleteReplyError after the last piece."""
+        raise NotImplementedError()
+
+
+class ConversationStore(ABC):
+    @abstractmethod
+    def load(
+        self, chat_id: int, number_of_messages: int
+    ) -> list[tuple[int, GPTMessage]]:
+        """Returns the last messages of a chat with their telegram message ids,
+        oldest first."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def add(self, chat_id: int, message_id: int, message: GPTMessage) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def add_many(
+        self, chat_id: int, messages: Sequence[tuple[int, GPTMessage]]
+    ) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def remove_last(self, chat_id: int, role: Role) -> None:
+        """Removes the newest message of the given role."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def save_summary(self, chat_id: int, message_id: int, summary: GPTMessage) -> None:
+        """Stores the summary of a chat, which covers the messages up to and
+        including message_id."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def load_summary(self, chat_id: int) -> tuple[int, GPTMessage] | None:
+        """Returns the stored summary with the id of the last message it covers."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def save_deadlines(
+        self,
+        deadlines: Mapping[tuple[int, str], float],
+        chat_ids: Collection[int] | None = None,
     ) -> None:
+        """Replaces the stored deadlines of chat_ids (all chats if None), given as
+        unix time per chat id and kind ("reply", "silence")."""
         raise NotImplementedError()
 
     @abstractmethod
-    async def send_and_receive(self, messages: Sequence[GPTMessage]) -> str | None:
+    def load_deadlines(self) -> dict[tuple[int, str], float]:
         raise NotImplementedError()
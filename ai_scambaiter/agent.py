@@ -2,11 +2,29 @@ import asyncio
 import datetime
 import logging
 import random
-from typing import TYPE_CHECKING, Any, cast
+import re
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable, Iterable
 
 from telethon.tl.custom import Message as TelegramMessage
 
-from ai_scambaiter import ChatGPTInterface, GPTMessage, Role, TelegramInterface
+from ai_scambaiter import (
+    ChatGPTInterface,
+    ConversationStore,
+    GPTMessage,
+    IncompleteReplyError,
+    Role,
+    TelegramInterface,
+    TokenUsage,
+)
+from ai_scambaiter import metrics
+from ai_scambaiter.history import ChatHistory
+from ai_scambaiter.prefilter import Decision
+from ai_scambaiter.rate_limit import backoff_delay
+from ai_scambaiter.scheduler import Scheduler
+from ai_scambaiter.settings import from_section
 
 if TYPE_CHECKING:
     from telethon.tl.custom.dialog import Dialog
@@ -14,6 +32,47 @@ if TYPE_CHECKING:
 
 _logger = logging.getLogger("Agent")
 
+# Number of messages loaded into the history on start
+HISTORY_LENGTH = 1000
+# End of the first sentence of a streamed reply which may be sent early
+_SENTENCE_END = re.compile(r"[.!?…]+[)\"'»]*\s")
+MIN_EARLY_SEND_LENGTH = 20
+
+_SUMMARY_INSTRUCTIONS = (
+    "You maintain the memory of a chat between Marvin (assistant) and another "
+    "person (user). Write a concise summary of the conversation below, merged with "
+    "the previous summary if there is one. Keep every fact that is needed to "
+    "continue the conversation consistently: names, places, dates, amounts, links, "
+    "platforms, promises, and the stories and personal details either side told. "
+    "Write plain text without headings."
+)
+_SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+
+@dataclass
+class AgentSettings:
+    """Options of the agents, read from the [agent] section of the configuration."""
+
+    # Seconds to wait for further messages before replying
+    response_wait: float = 10.0
+    # Stream replies from ChatGPT and show the typing indicator meanwhile
+    streaming: bool = False
+    # When streaming, send the first sentence while the rest is still generated
+    early_send: bool = False
+    # When the history exceeds this many tokens, the oldest messages are folded
+    # into a summary in the background (0 disables the summary)
+    summary_budget: int = 0
+    # Tokens of recent messages that are kept verbatim when folding
+    summary_keep: int = 4000
+    # Keep the request params of every history message, which saves rebuilding
+    # them for each request at the cost of about 190 bytes per message (more
+    # than twice the memory of the history itself)
+    cache_params: bool = False
+
+    @classmethod
+    def from_config(cls, section: dict[str, str] | None) -> "AgentSettings":
+        return from_section(cls, section)
+
 
 def _default_preamble(name: str | None) -> str:
     """Initial system prompt, can be changed via UI."""
@@ -63,17 +122,38 @@ class Agent:
         own_id: int,
         telegram_interface: TelegramInterface,
         chatgpt_interface: ChatGPTInterface,
+        conversation_store: ConversationStore | None = None,
+        settings: AgentSettings | None = None,
+        scheduler: Scheduler | None = None,
     ) -> None:
         self._chat_id_or_title: int | str = chat_id_or_title
         self._own_id: int = own_id
         self._telegram_interface: TelegramInterface = telegram_interface
         self._chatgpt_interface: ChatGPTInterface = chatgpt_interface
-        self._chatgpt_history: list[GPTMessage] = []
-        self._async_thread: asyncio.Task[None] | None = None
+        self._conversation_store: ConversationStore | None = conversation_store
+        self._settings: AgentSettings = settings or AgentSettings()
+        self._chatgpt_history: ChatHistory = ChatHistory(
+            chatgpt_interface.message_param if self._settings.cache_params else None,
+            keep_ids=True,
+        )
+        # Shared by all agents, owns the reply and silence deadlines
+        self._scheduler: Scheduler = scheduler or Scheduler()
         self._dialog: Dialog | None = None
         self._running: bool = False
-        self._new_message_event: asyncio.Event = asyncio.Event()
-        self._response_wait_time: datetime.timedelta = datetime.timedelta(seconds=10)
+        # Incremented with every message from the other side; a reply based on an
+        # older generation is outdated
+        self._generation: int = 0
+        # Message whose trace is finished by the next reply
+        self._trace_message_id: int | None = None
+        # Monotonic time at which replying response_wait seconds after the last
+        # message, without pre-filter, would have made a request we did not make
+        self._baseline_due: float | None = None
+        # Last write to the conversation store, the next one runs after it
+        self._store_write: asyncio.Task[None] | None = None
+        self._usage: TokenUsage = TokenUsage()
+        self._response_wait_time: datetime.timedelta = datetime.timedelta(
+            seconds=self._settings.response_wait
+        )
         self._max_silence_time: datetime.timedelta = datetime.timedelta(hours=4)
         self._last_message_received: datetime.datetime = (
             datetime.datetime.now() - self._response_wait_time
@@ -81,22 +161,85 @@ class Agent:
         self._preamble: GPTMessage = GPTMessage(
             role=Role.SYSTEM, content="", n_tokens=0
         )
+        # Summary of the messages which were folded out of the history
+        self._summary: GPTMessage | None = None
+        self._summary_param: object = None
+        self._summary_task: asyncio.Task[None] | None = None
+        # Failed summary requests in a row, and the monotonic time before which
+        # no new attempt is made
+        self._summary_failures: int = 0
+        self._summary_retry_at: float = 0.0
         self.set_preamble(_default_preamble(None))
 
     @property
     def chat_id(self) -> int:
         return self._dialog.id
 
-    async def receive_message(self, message: TelegramMessage | None) -> None:
+    @property
+    def title(self) -> str:
+        return self._dialog.title
+
+    @property
+    def usage(self) -> TokenUsage:
+        return self._usage
+
+    @property
+    def history_tokens(self) -> int:
+        return self._n_fixed_tokens() + self._chatgpt_history.n_tokens
+
+    async def receive_message(
+        self,
+        message: TelegramMessage | None,
+        decision: Decision = Decision.REPLY,
+        batch_wait: float | None = None,
+    ) -> None:
+        """Adds the message to the history and schedules the reply as the
+        pre-filter decided. A message which needs no reply (SKIP), or which is
+        batched while a reply is pending anyway, leaves the pending reply alone.
+        A batched message is otherwise answered after batch_wait seconds, also
+        if a reply is being generated, whose prompt does not contain it."""
         if message is not None:
             self.add_to_history(message)
             if message.sender_id == self._own_id:
                 # If the message is from us, don't reply
+                metrics.tracer.discard(self.chat_id, message.id)
+                return
+            self._count_avoided_call()
+            if decision is Decision.SKIP:
+                metrics.tracer.discard(self.chat_id, message.id)
                 return
             self._last_message_received = datetime.datetime.now()
+            if decision is Decision.BATCH and self._scheduler.is_pending(
+                self._reply_key
+            ):
+                # Answered by the pending reply
+                metrics.tracer.discard(self.chat_id, message.id)
+                return
+            if decision is Decision.BATCH and self._scheduler.is_running(
+                self._reply_key
+            ):
+                # The running reply is still sent, this message is answered by a
+                # follow-up unless another message comes first
+                metrics.tracer.discard(self.chat_id, message.id)
+                self._schedule_reply(batch_wait, cancel_running=False)
+                return
+            self._generation += 1
+            self._trace_message_id = message.id
+            if decision is Decision.BATCH:
+                self._schedule_reply(batch_wait)
+                return
         # Otherwise, this is not a real message, but a signal to generate an
         # additional message
-        self._new_message_event.set()
+        self._schedule_reply()
+
+    def _count_avoided_call(self) -> None:
+        """Counts the request the pre-filter avoided if, without it, the reply
+        to the previous message would have been requested by now, and starts
+        waiting for the reply to the new one."""
+        now = time.monotonic()
+        if self._baseline_due is not None and now >= self._baseline_due:
+            metrics.llm_calls_avoided.inc()
+        self._baseline_due = now + self._settings.response_wait
 
     def set_preamble(self, preamble: str) -> None:
         self._preamble = GPTMessage(
@@ -104,6 +247,7 @@ class Agent:
             content=preamble,
             n_tokens=self._chatgpt_interface.number_of_tokens(preamble),
         )
+        self._preamble_param = self._chatgpt_interface.message_param(self._preamble)
         _logger.debug(
             "Setting preamble with %i tokens: %s",
             self._preamble.n_tokens,
@@ -114,118 +258,260 @@ class Agent:
         return self._preamble.content
 
     async def start(self) -> None:
-        # Start an async thread with _message_processing_loop
-        dialogs = self._telegram_interface.dialogs
-        try:
-            chat_id = int(self._chat_id_or_title)
-            self._dialog = dialogs[chat_id]
-        except ValueError:
+        dialog = await self._telegram_interface.get_dialog(self._chat_id_or_title)
+        if dialog is None:
             try:
-                self._dialog: Any = next(
-                    d
-                    for d in dialogs.values()
-                    if d.title == cast(str, self._chat_id_or_title)
-                )
-            except StopIteration as exc:
+                int(self._chat_id_or_title)
+            except ValueError:
                 raise ValueError(
                     f"Dialog not found with  title {self._chat_id_or_title}."
-                ) from exc
-        except KeyError:
+                ) from None
             raise ValueError(f"Dialog not found with chat_id {self._chat_id_or_title}.")
+        self._dialog: Any = dialog
         self.set_preamble(_default_preamble(self._dialog.title))
 
-        history = await self._telegram_interface.get_messages(
-            self._dialog.id, number_of_messages=1000, oldest_first=False
-        )
-        for message in reversed(history):
-            self.add_to_history(message)
+        await self._load_history()
 
         self._running = True
-        self._async_thread = asyncio.create_task(self._message_processing_loop())
+        self._schedule_silence_timeout()
 
     async def stop(self) -> None:
         if self._running:
             self._running = False
-            self._new_message_event.set()
-            if self._async_thread:
-                await self._async_thread
-                self._async_thread = None
+            # A reply which is already being generated is still sent
+            self._scheduler.cancel(self._reply_key)
+            self._scheduler.cancel(self._silence_key)
+            if self._summary_task and not self._summary_task.done():
+                self._summary_task.cancel()
+            if self._store_write is not None:
+                await self._store_write
 
     def remove_last_assistant_message(self) -> None:
         """Removes the last message from the history that was sent by the assistant.
         Do not remove user messages, because they may have been received later."""
+        self._chatgpt_history.remove_last_assistant_message()
+        if self._conversation_store is not None:
+            self._write_to_store(
+                self._conversation_store.remove_last, self._dialog.id, Role.ASSISTANT
+            )
 
-        for i in range(len(self._chatgpt_history) - 1, -1, -1):
-            if self._chatgpt_history[i].role == Role.ASSISTANT:
-                del self._chatgpt_history[i]
-                return
+    def _write_to_store(self, function: Callable[..., None], *args: Any) -> None:
+        """Runs the write in a thread, after the earlier writes of this agent."""
+        self._store_write = asyncio.create_task(
+            self._store_after(self._store_write, function, *args)
+        )
+
+    async def _store_after(
+        self,
+        previous: asyncio.Task[None] | None,
+        function: Callable[..., None],
+        *args: Any,
+    ) -> None:
+        if previous is not None:
+            await previous
+        try:
+            await asyncio.to_thread(function, *args)
+        except sqlite3.Error as e:
+            _logger.error("Could not write to the conversation store: %s", e)
 
-    async def _message_processing_loop(self) -> None:
-        reply_task: asyncio.Task[None] | None = None
+    @property
+    def _reply_key(self) -> tuple[int, str]:
+        return (self._dialog.id, "reply")
 
-        while self._running:
-            try:
-                # Wait for a message from the queue, but if no message is received
-                # for a while, send a reply anyway.
-                try:
-                    await asyncio.wait_for(
-                        self._new_message_event.wait(),
-                        timeout=self._max_silence_time.total_seconds()
-                        + 3600 * random.random(),
-                    )
-                except asyncio.TimeoutError:
-                    _logger.debug(
-                        "Silence timeout waiting for message. Sending reply anyway."
-                    )
-                self._new_message_event.clear()
-                if not self._running:
-                    _logger.debug("Stopping message processing loop.")
-                    break
-                if reply_task:
-                    _logger.debug("Cancelling wait/reply task.")
-                    reply_task.cancel()
-                    try:
-                        await reply_task
-                    except asyncio.CancelledError:
-                        pass
-                _logger.debug("Creating reply message.")
-                reply_task = asyncio.create_task(self._send_reply())
-
-            except asyncio.CancelledError:
-                # Handle cancellation of the processing loop
-                if reply_task:
-                    reply_task.cancel()
-                break
+    @property
+    def _silence_key(self) -> tuple[int, str]:
+        return (self._dialog.id, "silence")
+
+    def _schedule_reply(
+        self, wait: float | None = None, cancel_running: bool = True
+    ) -> None:
+        """Replies after the response wait time (or wait seconds), unless another
+        message arrives meanwhile. A reply which is being generated is outdated
+        and cancelled, unless cancel_running is False."""
+        if not self._running:
+            return
+        if (
+            cancel_running
+            and self._scheduler.cancel_running(self._reply_key) is not None
+        ):
+            _logger.debug("Cancelling reply task.")
+        if wait is None:
+            wait = self._response_wait_time.total_seconds()
+        self._scheduler.schedule(self._reply_key, wait, self._send_reply)
+        self._schedule_silence_timeout()
+
+    def _schedule_silence_timeout(self) -> None:
+        """If nothing happens for a while, a reply is sent anyway."""
+        self._scheduler.schedule(
+            self._silence_key,
+            self._max_silence_time.total_seconds() + 3600 * random.random(),
+            self._on_silence,
+        )
+
+    async def _on_silence(self) -> None:
+        _logger.debug("Silence timeout waiting for message. Sending reply anyway.")
+        self._schedule_reply()
+
+    def restore_deadline(self, kind: str, delay: float) -> None:
+        """Continues a deadline ("reply" or "silence") from before a restart."""
+        if kind == "reply":
+            self._scheduler.schedule(self._reply_key, delay, self._send_reply)
+        elif kind == "silence":
+            self._scheduler.schedule(self._silence_key, delay, self._on_silence)
 
     async def _send_reply(self) -> None:
-        """Start a countdown and process the message after the countdown."""
-        try:
-            await asyncio.sleep(self._response_wait_time.total_seconds())
-            if not self._running:
-                return
-        except asyncio.CancelledError:
+        """Generates and sends the reply, run by the scheduler once the response
+        wait time has passed."""
+        if not self._running:
+            return
+        # Without pre-filter, this request would be made as well
+        self._baseline_due = None
+
+        messages, params = self._prompt()
+        n_prompt_tokens = self.history_tokens
+        generation = self._generation
+        self._trace("reply_started", metrics.debounce_wait, since="handled")
+        if self._settings.streaming:
+            await self._stream_reply(messages, params, n_prompt_tokens, generation)
             return
 
-        response = await self._chatgpt_interface.send_and_receive(
-            [self._preamble] + self._chatgpt_history
+        usage = TokenUsage()
+        try:
+            response = await self._chatgpt_interface.send_and_receive(
+                messages, usage, params
+            )
+        except asyncio.CancelledError:
+            self._count_superseded(n_prompt_tokens)
+            raise
+        self._add_usage(usage)
+        _logger.info(
+            "Response from ChatGPT (%i of %i prompt tokens cached): %s",
+            usage.cached_tokens,
+            usage.prompt_tokens,
+            response,
         )
-        _logger.info("Response from ChatGPT: %s", response)
         if response is None:
             _logger.error("No response from ChatGPT")
             return
+        if self._is_superseded(generation):
+            self._count_superseded(usage.prompt_tokens + usage.completion_tokens)
+            return
 
         # Do not add to history - we will receive it anyway via the telegram
         # interface
 
-        await self._telegram_interface.send_message(self._dialog.id, response)
+        await self._send(response)
 
-    def _message_to_gpt(self, message: TelegramMessage) -> GPTMessage | None:
+    async def _stream_reply(
+        self,
+        messages: list[GPTMessage],
+        params: list[object] | None,
+        n_prompt_tokens: int,
+        generation: int,
+    ) -> None:
+        """Streams the reply while showing the typing indicator. With early_send,
+        the first sentence is sent as soon as it is complete. A reply which is
+        cut off is not sent."""
+        usage = TokenUsage()
+        response = ""
+        n_sent = 0
+        try:
+            async with self._telegram_interface.typing(self._dialog.id):
+                async for delta in self._chatgpt_interface.stream_and_receive(
+                    messages, usage, params
+                ):
+                    response += delta
+                    if self._settings.early_send and n_sent == 0:
+                        end = _SENTENCE_END.search(response, MIN_EARLY_SEND_LENGTH)
+                        if end and not self._is_superseded(generation):
+                            first = response[: end.end()].strip()
+                            _logger.info("First sentence from ChatGPT: %s", first)
+                            await self._send(first)
+                            n_sent = end.end()
+        except asyncio.CancelledError:
+            self._count_superseded(
+                n_prompt_tokens + self._chatgpt_interface.number_of_tokens(response)
+            )
+            raise
+        except IncompleteReplyError:
+            # Like send_and_receive, the cut off reply is not sent; an early
+            # first sentence is a complete one
+            self._add_usage(usage)
+            _logger.error("Incomplete response from ChatGPT: %s", response)
+            return
+        self._add_usage(usage)
+        _logger.info(
+            "Response from ChatGPT (%i of %i prompt tokens cached): %s",
+            usage.cached_tokens,
+            usage.prompt_tokens,
+            response,
+        )
+        rest = response[n_sent:].strip()
+        if not rest:
+            if not n_sent:
+                _logger.error("No response from ChatGPT")
+            return
+        if self._is_superseded(generation):
+            self._count_superseded(usage.prompt_tokens + usage.completion_tokens)
+            return
+        await self._send(rest)
+
+    async def _send(self, text: str) -> None:
+        """Sends text as a reply, which drops older replies that are still
+        waiting to be sent."""
+        # Once started, a send is not interrupted by a newer message
+        sent = await asyncio.shield(
+            self._telegram_interface.send_message(self._dialog.id, text, replace=True)
+        )
+        if sent is False:
+            _logger.info("Reply was replaced by a newer one before it was sent")
+            return
+        self._trace("sent", metrics.reply_latency, since="received")
+        if self._trace_message_id is not None:
+            metrics.tracer.finish(self.chat_id, self._trace_message_id)
+            self._trace_message_id = None
+
+    def _trace(self, stage: str, histogram: metrics.Histogram, since: str) -> None:
+        """Marks a stage in the trace of the message being answered and records
+        the time since an earlier stage."""
+        if self._trace_message_id is None:
+            return
+        now = metrics.tracer.mark(self.chat_id, self._trace_message_id, stage)
+        elapsed = metrics.tracer.since(self.chat_id, self._trace_message_id, since, now)
+        if elapsed >= 0:
+            histogram.observe(elapsed)
+
+    def _is_superseded(self, generation: int) -> bool:
+        if generation == self._generation:
+            return False
+        _logger.info("Discarding reply, newer messages arrived meanwhile")
+        return True
+
+    def _count_superseded(self, n_tokens: int) -> None:
+        self._usage.superseded_requests += 1
+        self._usage.superseded_tokens += n_tokens
+
+    def _add_usage(self, usage: TokenUsage) -> None:
+        self._usage.requests += usage.requests
+        self._usage.prompt_tokens += usage.prompt_tokens
+        self._usage.cached_tokens += usage.cached_tokens
+        self._usage.completion_tokens += usage.completion_tokens
+
+    def _message_content(self, message: TelegramMessage) -> str | None:
         text: Any = message.text  # type: ignore
         if not isinstance(text, str) or not text:
             return None
-        content = text.replace("\n", " ")
+        return text.replace("\n", " ")
+
+    def _message_role(self, message: TelegramMessage) -> Role:
+        return Role.ASSISTANT if message.sender_id == self._own_id else Role.USER
+
+    def _message_to_gpt(self, message: TelegramMessage) -> GPTMessage | None:
+        content = self._message_content(message)
+        if content is None:
+            return None
         return GPTMessage(
-            role=Role.ASSISTANT if message.sender_id == self._own_id else Role.USER,
+            role=self._message_role(message),
             content=content,
             n_tokens=self._chatgpt_interface.number_of_tokens(content),
         )
@@ -235,10 +521,202 @@ class Agent:
         msg = self._message_to_gpt(message)
         if not msg:
             return
-        self._chatgpt_history.append(msg)
+        self._chatgpt_history.append(msg, message.id)
+        if self._conversation_store is not None and self._dialog is not None:
+            self._write_to_store(
+                self._conversation_store.add, self._dialog.id, message.id, msg
+            )
         # Shorten to meet token limit
+        self._shorten_history()
+
+    async def _load_history(self) -> None:
+        """Fills the history from the conversation store and fetches only the
+        messages which are newer than the last stored one from telegram. A stored
+        summary is restored, and the messages it covers are left out."""
+        self._chatgpt_history.clear()
+        self._set_summary(None)
+        last_message_id = 0
+        if self._conversation_store is not None:
+            summary = await asyncio.to_thread(
+                self._conversation_store.load_summary, self._dialog.id
+            )
+            if summary is not None:
+                last_message_id, msg = summary
+                self._set_summary(msg)
+            stored = await asyncio.to_thread(
+                self._conversation_store.load, self._dialog.id, HISTORY_LENGTH
+            )
+            for message_id, msg in stored:
+                if message_id > last_message_id:
+                    self._chatgpt_history.append(msg, message_id)
+            if stored:
+                last_message_id = max(last_message_id, stored[-1][0])
+        new_messages = await self._telegram_interface.get_messages(
+            self._dialog.id,
+            number_of_messages=HISTORY_LENGTH,
+            oldest_first=False,
+            min_id=last_message_id,
+        )
+        _logger.info(
+            "Loaded %i stored and %i new messages for %s",
+            len(self._chatgpt_history),
+            len(new_messages),
+            self._dialog.title,
+        )
+        await self._add_many_to_history(reversed(new_messages))
+
+    async def _add_many_to_history(self, messages: Iterable[TelegramMessage]) -> None:
+        """Adds messages (oldest first) to the history. The messages are tokenized
+        in one batch on a worker thread, so other chats are not blocked."""
+        message_ids: list[int] = []
+        roles: list[Role] = []
+        contents: list[str] = []
+        for message in messages:
+            content = self._message_content(message)
+            if content is not None:
+                message_ids.append(message.id)
+                roles.append(self._message_role(message))
+                contents.append(content)
+        n_tokens = await asyncio.to_thread(
+            self._chatgpt_interface.number_of_tokens_batch, contents
+        )
+        new_messages = [
+            GPTMessage(role=role, content=content, n_tokens=n)
+            for role, content, n in zip(roles, contents, n_tokens)
+        ]
+        for message_id, msg in zip(message_ids, new_messages):
+            self._chatgpt_history.append(msg, message_id)
+        if self._conversation_store is not None:
+            await asyncio.to_thread(
+                self._conversation_store.add_many,
+                self._dialog.id,
+                list(zip(message_ids, new_messages)),
+            )
+        self._shorten_history()
+
+    def _prompt(self) -> tuple[list[GPTMessage], list[object] | None]:
+        """The messages sent to ChatGPT (preamble, summary and recent history) and
+        their request params, which are kept up to date with the history (None if
+        cache_params is disabled).
+
+        The order is chosen so that the prompt only changes at its end between
+        replies (unless the preamble is edited, the summary is updated or the
+        history is trimmed), which allows the provider to cache the prefix."""
+        fixed = [self._preamble]
+        fixed_params = [self._preamble_param]
+        if self._summary is not None:
+            fixed.append(self._summary)
+            fixed_params.append(self._summary_param)
+        if not self._chatgpt_history.keeps_params:
+            return [*fixed, *self._chatgpt_history], None
+        return (
+            [*fixed, *self._chatgpt_history],
+            fixed_params + self._chatgpt_history.params(),
+        )
+
+    def _set_summary(self, summary: GPTMessage | None) -> None:
+        self._summary = summary
+        self._summary_param = (
+            self._chatgpt_interface.message_param(summary)
+            if summary is not None
+            else None
+        )
+
+    def _n_fixed_tokens(self) -> int:
+        """Tokens of the preamble and summary."""
+        n_tokens = self._preamble.n_tokens
+        if self._summary is not None:
+            n_tokens += self._summary.n_tokens
+        return n_tokens
+
+    def _shorten_history(self) -> None:
         self._chatgpt_interface.shorten_history(
-            self._preamble.n_tokens, self._chatgpt_history
+            self._n_fixed_tokens(), self._chatgpt_history
+        )
+        if (
+            self._settings.summary_budget
+            and self._chatgpt_history.n_tokens > self._settings.summary_budget
+            and (self._summary_task is None or self._summary_task.done())
+            and time.monotonic() >= self._summary_retry_at
+        ):
+            self._summary_task = asyncio.create_task(self._update_summary())
+
+    async def _update_summary(self) -> None:
+        """Folds the oldest messages into the summary, so that only summary_keep
+        tokens of the history remain verbatim. Runs in the background; messages
+        which arrive meanwhile are not affected. The summary is stored, so it is
+        not requested again after a restart; after a failure, the next attempt
+        is delayed with backoff."""
+        folded: list[GPTMessage] = []
+        last_folded_id: int | None = None
+        n_remaining = self._chatgpt_history.n_tokens
+        for message_id, message in self._chatgpt_history.items():
+            if n_remaining <= self._settings.summary_keep:
+                break
+            folded.append(message)
+            last_folded_id = message_id
+            n_remaining -= message.n_tokens
+        if not folded:
+            return
+        transcript = "\n".join(
+            f"{'Marvin' if m.role == Role.ASSISTANT else 'User'}: {m.content}"
+            for m in folded
+        )
+        if self._summary is not None:
+            previous = self._summary.content[len(_SUMMARY_PREFIX) :]
+            transcript = f"Previous summary: {previous}\n\nConversation:\n{transcript}"
+        request = [
+            GPTMessage(
+                role=Role.SYSTEM,
+                content=_SUMMARY_INSTRUCTIONS,
+                n_tokens=self._chatgpt_interface.number_of_tokens(
+                    _SUMMARY_INSTRUCTIONS
+                ),
+            ),
+            GPTMessage(
+                role=Role.USER,
+                content=transcript,
+                n_tokens=self._chatgpt_interface.number_of_tokens(transcript),
+            ),
+        ]
+        usage = TokenUsage()
+        try:
+            summary = await self._chatgpt_interface.send_and_receive(request, usage)
+        except Exception as e:
+            _logger.error("Error summarizing the history: %s", e)
+            summary = None
+        self._add_usage(usage)
+        if not summary:
+            delay = backoff_delay(self._summary_failures, base=10, cap=3600)
+            self._summary_failures += 1
+            self._summary_retry_at = time.monotonic() + delay
+            _logger.error("Could not summarize the history, retrying in %.0fs", delay)
+            return
+        self._summary_failures = 0
+        content = _SUMMARY_PREFIX + summary.replace("\n", " ")
+        self._set_summary(
+            GPTMessage(
+                role=Role.SYSTEM,
+                content=content,
+                n_tokens=self._chatgpt_interface.number_of_tokens(content),
+            )
+        )
+        if self._conversation_store is not None and last_folded_id is not None:
+            await asyncio.to_thread(
+                self._conversation_store.save_summary,
+                self._dialog.id,
+                last_folded_id,
+                self._summary,
+            )
+        # Messages may have been trimmed in the meantime, only drop what is
+        # still at the front
+        for message in folded:
+            if self._chatgpt_history.oldest() is message:
+                self._chatgpt_history.pop_oldest()
+        _logger.info(
+            "Folded %i messages into a summary of %i tokens",
+            len(folded),
+            self._summary.n_tokens,
         )
 
     def get_history(self, n: int | None = None) -> list[str]:
@@ -247,4 +725,4 @@ class Agent:
         if n is None:
             return [f"{m.role}: {m.content}" for m in self._chatgpt_history]
         else:
-            return [f"{m.role}: {m.content}" for m in self._chatgpt_history[-n:]]
+            return [f"{m.role}: {m.content}" for m in self._chatgpt_history.last(n)]
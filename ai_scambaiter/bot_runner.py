@@ -1,19 +1,36 @@
 from __future__ import annotations
 
+import asyncio
 import logging
+import random
+import time
+from collections import deque
 from typing import TYPE_CHECKING, AsyncIterator
 
-from ai_scambaiter.agent import Agent
+from telethon.errors import FloodWaitError
 
-from . import BotRunner
+from ai_scambaiter.agent import Agent, AgentSettings
+from ai_scambaiter.prefilter import Decision, Prefilter, PrefilterSettings
+from ai_scambaiter.scheduler import DEFAULT_MAX_WORKERS, Scheduler
+
+from . import BotRunner, metrics
 
 if TYPE_CHECKING:
     from typing import Callable
 
-    from . import ChatGPTInterface, GPTMessage, TelegramInterface
+    from telethon.tl.custom import Message
+
+    from . import ChatGPTInterface, ConversationStore, GPTMessage, TelegramInterface
 
 _logger = logging.getLogger("BotRunner")
 
+DEFAULT_START_CONCURRENCY = 4
+DEFAULT_CHECKPOINT_INTERVAL = 5.0
+DEFAULT_CATCH_UP_RAMP = 60.0
+DEFAULT_INBOX_SIZE = 1000
+INBOX_POLICIES = ("block", "drop_oldest")
+MAX_START_ATTEMPTS = 5
+
 
 class BotRunnerImpl(BotRunner):
     def __init__(
@@ -21,46 +38,286 @@ class BotRunnerImpl(BotRunner):
         message_stream: Callable[[], AsyncIterator[list[GPTMessage]]],
         telegram_interface: TelegramInterface,
         chatgpt_interface: ChatGPTInterface,
+        conversation_store: ConversationStore | None,
         conversations: str,
         own_id: str,
+        start_concurrency: str | None = None,
+        inbox_size: str | None = None,
+        inbox_policy: str | None = None,
+        agent_settings: dict[str, str] | None = None,
+        reply_workers: str | None = None,
+        checkpoint_interval: str | None = None,
+        catch_up_ramp: str | None = None,
+        prefilter_settings: dict[str, str] | None = None,
     ):
         self._message_stream = message_stream
         self._agents: dict[int, Agent] = {}
+        self._chat_ids: list[int] = []
         self._conversations: list[str] = conversations.strip().split("\n")
         self._telegram_interface: TelegramInterface = telegram_interface
         self._chatgpt_interface: ChatGPTInterface = chatgpt_interface
+        self._conversation_store: ConversationStore | None = conversation_store
         self._own_id: int = int(own_id)
+        self._start_concurrency: int = max(
+            1, int(start_concurrency or DEFAULT_START_CONCURRENCY)
+        )
+        self._inbox_size: int = int(inbox_size or DEFAULT_INBOX_SIZE)
+        self._inbox_policy: str = inbox_policy or INBOX_POLICIES[0]
+        if self._inbox_policy not in INBOX_POLICIES:
+            raise ValueError(f"Unknown inbox policy {self._inbox_policy}")
+        self._agent_settings: AgentSettings = AgentSettings.from_config(agent_settings)
+        self._scheduler: Scheduler = Scheduler(
+            max_workers=int(reply_workers or DEFAULT_MAX_WORKERS)
+        )
+        self._checkpoint_interval: float = float(
+            checkpoint_interval or DEFAULT_CHECKPOINT_INTERVAL
+        )
+        self._catch_up_ramp: float = float(catch_up_ramp or DEFAULT_CATCH_UP_RAMP)
+        self._checkpoint_task: asyncio.Task[None] | None = None
+        self._prefilter: Prefilter = Prefilter(
+            PrefilterSettings.from_config(prefilter_settings)
+        )
+        self._inboxes: dict[int, asyncio.Queue[Message]] = {}
+        self._consumers: dict[int, asyncio.Task[None]] = {}
+        # Messages of a chat whose inbox is full, with the block policy
+        self._overflows: dict[int, deque[Message]] = {}
+        self._inbox_drops: dict[int, int] = {}
+        metrics.registry.add_collector(self._collect_metrics)
 
     async def start(self) -> None:
-        for conv in self._conversations:
-            agent = Agent(
-                conv, self._own_id, self._telegram_interface, self._chatgpt_interface
-            )
-            await agent.start()
-            self._agents[agent.chat_id] = agent
+        """Starts one agent per configured conversation, several at a time.
+        Agents that fail to start are logged and skipped."""
+        semaphore = asyncio.Semaphore(self._start_concurrency)
+        t_start = time.monotonic()
+        n_started = 0
+
+        async def start_agent(conv: str) -> Agent | None:
+            nonlocal n_started
+            async with semaphore:
+                agent = await self._start_agent(conv)
+            if agent is not None:
+                n_started += 1
+                _logger.info(
+                    "Agent %i/%i for %s ready after %.1fs",
+                    n_started,
+                    len(self._conversations),
+                    conv,
+                    time.monotonic() - t_start,
+                )
+            return agent
+
+        agents = await asyncio.gather(
+            *(start_agent(conv) for conv in self._conversations)
+        )
+        # Insert in configuration order, so chat indices are stable between runs
+        for agent in agents:
+            if agent is not None:
+                self._agents[agent.chat_id] = agent
+        self._chat_ids = list(self._agents)
+        self._telegram_interface.set_monitored_chats(self._agents.keys())
+        await self._restore_deadlines()
+        _logger.info(
+            "Started %i of %i agents in %.1fs",
+            len(self._agents),
+            len(self._conversations),
+            time.monotonic() - t_start,
+        )
+
+    async def stop(self) -> None:
+        """Stops the agents and the tasks of run()."""
+        for task in (*self._consumers.values(), self._checkpoint_task):
+            if task is not None:
+                task.cancel()
+        self._consumers.clear()
+        self._checkpoint_task = None
+        for agent in self._agents.values():
+            await agent.stop()
+        metrics.registry.remove_collector(self._collect_metrics)
+
+    async def _start_agent(self, conv: str) -> Agent | None:
+        agent = Agent(
+            conv,
+            self._own_id,
+            self._telegram_interface,
+            self._chatgpt_interface,
+            self._conversation_store,
+            self._agent_settings,
+            self._scheduler,
+        )
+        for attempt in range(1, MAX_START_ATTEMPTS + 1):
+            try:
+                await agent.start()
+                return agent
+            except FloodWaitError as e:
+                if attempt == MAX_START_ATTEMPTS:
+                    break
+                delay = e.seconds + random.uniform(0, 1 + e.seconds / 10)
+                _logger.warning(
+                    "Flood wait while starting agent for %s, retrying in %.0fs",
+                    conv,
+                    delay,
+                )
+                await asyncio.sleep(delay)
+            except Exception as e:
+                _logger.error("Could not start agent for %s: %s", conv, e)
+                return None
+        _logger.error(
+            "Could not start agent for %s after %i attempts", conv, MAX_START_ATTEMPTS
+        )
+        return None
 
     async def run(self):
+        """Dispatches incoming messages into the inboxes of the agents. Each agent
+        consumes its inbox in its own task, so a slow agent does not delay the
+        others."""
+        for chat_id, agent in self._agents.items():
+            if chat_id not in self._consumers:
+                self._inboxes[chat_id] = asyncio.Queue(maxsize=self._inbox_size)
+                self._overflows[chat_id] = deque()
+                self._consumers[chat_id] = asyncio.create_task(
+                    self._consume_inbox(
+                        agent, self._inboxes[chat_id], self._overflows[chat_id]
+                    )
+                )
+        if (
+            self._checkpoint_task is None
+            and self._conversation_store is not None
+            and self._checkpoint_interval > 0
+        ):
+            self._checkpoint_task = asyncio.create_task(self._checkpoint_deadlines())
         while True:
             async for message in self._message_stream():
-                try:
-                    chat_id = message.chat_id
-                    if chat_id not in self._agents:
+                chat_id = getattr(message, "chat_id", None)
+                inbox = self._inboxes.get(chat_id)  # type: ignore
+                if inbox is None:
+                    if _logger.isEnabledFor(logging.DEBUG):
                         _logger.debug(
-                            "Got new other message with chat id %i: %s",
-                            message.chat_id,
-                            message.text,
+                            "Got new other message with chat id %s: %s",
+                            chat_id,
+                            getattr(message, "text", None),
                         )
-                        continue
-                    _logger.info(
-                        "Got new message with chat id %i: %s",
-                        message.chat_id,
-                        message.text,
-                    )
-                except AttributeError:
                     continue
-                agent = self._agents[chat_id]
-                await agent.receive_message(message)
+                _logger.info(
+                    "Got new message with chat id %i: %s", chat_id, message.text
+                )
+                self._deliver(chat_id, inbox, message)
+
+    async def _restore_deadlines(self) -> None:
+        """Continues the reply and silence deadlines of the last checkpoint.
+        Replies that became due while the bot was down are spread over the
+        catch-up ramp instead of being generated at once. Chats without a saved
+        deadline get none, their last message was skipped or answered on
+        purpose."""
+        if self._conversation_store is None:
+            return
+        saved = await asyncio.to_thread(self._conversation_store.load_deadlines)
+        now = time.time()
+        deadlines: list[tuple[float, Agent, str]] = []
+        for chat_id, agent in self._agents.items():
+            for kind in ("reply", "silence"):
+                due = saved.get((chat_id, kind))
+                if due is not None:
+                    deadlines.append((due, agent, kind))
+        overdue = sorted((d for d in deadlines if d[0] <= now), key=lambda d: d[0])
+        for due, agent, kind in deadlines:
+            if due > now:
+                agent.restore_deadline(kind, due - now)
+        for i, (_, agent, kind) in enumerate(overdue):
+            agent.restore_deadline(kind, self._catch_up_ramp * i / len(overdue))
+        _logger.info(
+            "Restored %i deadlines, %i of them overdue",
+            len(deadlines),
+            len(overdue),
+        )
+
+    async def _checkpoint_deadlines(self) -> None:
+        """Saves the deadlines of all agents whenever they changed."""
+        version = -1
+        while True:
+            await asyncio.sleep(self._checkpoint_interval)
+            if self._scheduler.version == version:
+                continue
+            version = self._scheduler.version
+            try:
+                await asyncio.to_thread(
+                    self._conversation_store.save_deadlines,  # type: ignore
+                    self._scheduler.snapshot(),
+                    list(self._agents),
+                )
+            except Exception as e:
+                _logger.error("Could not save deadlines: %s", e)
+
+    def _deliver(
+        self, chat_id: int, inbox: asyncio.Queue[Message], message: Message
+    ) -> None:
+        """Puts the message into the inbox. Never waits, so a full inbox does not
+        hold up the other chats: with the block policy, the message waits in the
+        overflow of its chat until the agent catches up."""
+        overflow = self._overflows[chat_id]
+        if not inbox.full() and not overflow:
+            inbox.put_nowait(message)
+        elif self._inbox_policy == "block":
+            overflow.append(message)
+        else:
+            dropped = inbox.get_nowait()
+            inbox.task_done()
+            self._inbox_drops[chat_id] = self._inbox_drops.get(chat_id, 0) + 1
+            _logger.warning(
+                "Inbox of chat %i is full, dropped message %i", chat_id, dropped.id
+            )
+            inbox.put_nowait(message)
+
+    async def _consume_inbox(
+        self,
+        agent: Agent,
+        inbox: asyncio.Queue[Message],
+        overflow: deque[Message],
+    ):
+        while True:
+            message = await inbox.get()
+            if overflow:
+                inbox.put_nowait(overflow.popleft())
+            now = metrics.tracer.mark(agent.chat_id, message.id, "handled")
+            latency = metrics.tracer.since(agent.chat_id, message.id, "received", now)
+            if latency >= 0:
+                metrics.dispatch_latency.observe(latency)
+            try:
+                decision = Decision.REPLY
+                if message.sender_id != self._own_id:
+                    decision = self._prefilter.classify(
+                        agent.chat_id, message.text, agent.title
+                    )
+                await agent.receive_message(
+                    message, decision, self._prefilter.settings.batch_wait
+                )
+            except Exception as e:
+                _logger.error(
+                    "Error handling message %i in chat %i: %s",
+                    message.id,
+                    agent.chat_id,
+                    e,
+                )
+            finally:
+                inbox.task_done()
+
+    def _collect_metrics(self) -> None:
+        metrics.scheduled_deadlines.set(self._scheduler.pending)
+        metrics.running_replies.set(self._scheduler.running)
+        for chat_id, agent in self._agents.items():
+            metrics.history_tokens.set(agent.history_tokens, chat=chat_id)
+            if chat_id in self._inboxes:
+                depth = self._inboxes[chat_id].qsize() + len(self._overflows[chat_id])
+                metrics.inbox_depth.set(depth, chat=chat_id)
+
+    @property
+    def inbox_drops(self) -> dict[int, int]:
+        """Number of messages dropped per chat because its inbox was full."""
+        return self._inbox_drops
 
     @property
     def agents(self) -> dict[int, Agent]:
         return self._agents
+
+    @property
+    def chat_ids(self) -> list[int]:
+        return self._chat_ids
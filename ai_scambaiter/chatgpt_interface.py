@@ -1,81 +1,325 @@
+import asyncio
+import atexit
+import functools
+import hashlib
 import logging
-from collections.abc import Sequence
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Sequence
 from openai.types.chat import (
+    ChatCompletion,
     ChatCompletionAssistantMessageParam,
     ChatCompletionMessageParam,
     ChatCompletionSystemMessageParam,
     ChatCompletionUserMessageParam,
 )
+import httpx
 import openai
+from openai.types import CompletionUsage
 import tiktoken
 
-from . import ChatGPTInterface, GPTMessage, Role
+from . import (
+    ChatGPTInterface,
+    GPTMessage,
+    IncompleteReplyError,
+    Role,
+    TokenUsage,
+    metrics,
+)
+from .history import ChatHistory
+from .rate_limit import RateLimiter, RemoteRateLimiter, backoff_delay
+from .recording import TrafficRecorder
 
 ROLE_TOKENS = 1  # Role is always 1 token
 MESSAGE_TOKENS = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
 REPLY_TOKENS = 2  # every reply is primed with <im_start>assistant
+TOKENIZER_THREADS = 4
+DEFAULT_TOKEN_CACHE_SIZE = 100000
+# Seconds new token counts are collected before they are written to disk
+TOKEN_CACHE_FLUSH_INTERVAL = 1.0
+MAX_COMPLETION_TOKENS = 8000
+# Expected length of a reply, used to budget tokens before the actual usage is known
+COMPLETION_TOKEN_ESTIMATE = 200
+
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 200000
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_TIMEOUT = 120.0
 
 _logger = logging.getLogger("ChatGPT")
 
 
+class TokenCountCache:
+    """Bounded LRU cache of token counts, optionally backed by a sqlite file.
+
+    Entries are keyed by a hash of the text, and on disk additionally by the name of
+    the encoding, so counts from a different tokenizer are never reused. The cache
+    is used from tokenizer threads and therefore guarded by a lock. New counts are
+    written to disk in batches by a background thread, so counting a text on the
+    event loop never waits for a commit."""
+
+    def __init__(
+        self,
+        encoding_name: str,
+        max_size: int = DEFAULT_TOKEN_CACHE_SIZE,
+        path: str | None = None,
+    ):
+        self._encoding_name = encoding_name
+        self._max_size = max_size
+        self._entries: OrderedDict[bytes, int] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db: sqlite3.Connection | None = None
+        # Written by the flush thread, read with the lock held
+        self._db_lock = threading.Lock()
+        self._pending: list[tuple[str, bytes, int]] = []
+        self._flush_wanted = threading.Event()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS token_counts ("
+                "encoding TEXT NOT NULL, hash BLOB NOT NULL, n_tokens INTEGER NOT NULL, "
+                "PRIMARY KEY (encoding, hash)) WITHOUT ROWID"
+            )
+            self._db.commit()
+            threading.Thread(
+                target=self._flush_loop, name="TokenCountCache", daemon=True
+            ).start()
+            atexit.register(self.flush)
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def get_many(
+        self, texts: Sequence[str], from_disk: bool = True
+    ) -> list[int | None]:
+        """Returns the cached counts, None for unknown texts. Texts which are not
+        in memory are looked up on disk unless from_disk is False, which is for
+        callers on the event loop."""
+        keys = [self._key(t) for t in texts]
+        result: list[int | None] = []
+        missing: dict[bytes, list[int]] = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                n = self._entries.get(key)
+                if n is not None:
+                    self._entries.move_to_end(key)
+                else:
+                    missing.setdefault(key, []).append(i)
+                result.append(n)
+        # Without the lock, so lookups in memory do not wait for the disk
+        loaded = self._load(list(missing)) if missing and from_disk else []
+        with self._lock:
+            for key, n in loaded:
+                self._remember(key, n)
+                for i in missing.pop(key):
+                    result[i] = n
+            n_missing = sum(len(indices) for indices in missing.values())
+            self.misses += n_missing
+            self.hits += len(texts) - n_missing
+        return result
+
+    def put_many(self, texts: Sequence[str], counts: Sequence[int]) -> None:
+        rows = [(self._key(t), n) for t, n in zip(texts, counts)]
+        with self._lock:
+            for key, n in rows:
+                self._remember(key, n)
+            if self._db is not None:
+                self._pending.extend((self._encoding_name, key, n) for key, n in rows)
+        if self._db is not None:
+            self._flush_wanted.set()
+
+    def flush(self) -> None:
+        """Writes the counts which are not on disk yet."""
+        if self._db is None:
+            return
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if not rows:
+            return
+        with self._db_lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?)", rows
+            )
+            self._db.commit()
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._flush_wanted.wait()
+            # Collect the counts of a burst of new messages into one commit
+            time.sleep(TOKEN_CACHE_FLUSH_INTERVAL)
+            self._flush_wanted.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                _logger.warning("Could not write token counts: %s", e)
+
+    def _load(self, keys: list[bytes]) -> list[tuple[bytes, int]]:
+        if self._db is None:
+            return []
+        rows: list[tuple[bytes, int]] = []
+        with self._db_lock:
+            # Stay below sqlite's limit for host parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                rows.extend(
+                    self._db.execute(
+                        "SELECT hash, n_tokens FROM token_counts WHERE encoding = ? "
+                        f"AND hash IN ({', '.join('?' * len(chunk))})",
+                        [self._encoding_name, *chunk],
+                    )
+                )
+        return rows
+
+    def _remember(self, key: bytes, n_tokens: int) -> None:
+        self._entries[key] = n_tokens
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
 class ChatGPTInterfaceImpl(ChatGPTInterface):
     """Interface to the OpenAI API."""
 
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        token_cache_path: str | None = None,
+        token_cache_size: str | None = None,
+        requests_per_minute: str | None = None,
+        tokens_per_minute: str | None = None,
+        max_concurrency: str | None = None,
+        max_retries: str | None = None,
+        timeout: str | None = None,
+        trim_chunk_tokens: str | None = None,
+        base_url: str | None = None,
+        recorder: TrafficRecorder | None = None,
+        rate_limit_server: str | None = None,
+    ):
         self._running = True
-        self._client = openai.AsyncOpenAI(api_key=api_key)
+        self._recorder: TrafficRecorder = recorder or TrafficRecorder()
+        n_concurrent = int(max_concurrency or DEFAULT_MAX_CONCURRENCY)
+        self._client = openai.AsyncOpenAI(
+            api_key=api_key,
+            # Empty for the OpenAI API, or e.g. a local stub for tests
+            base_url=base_url or None,
+            # Retries are done here, so they are rate limited as well
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=n_concurrent,
+                    max_keepalive_connections=n_concurrent,
+                    keepalive_expiry=60,
+                ),
+                timeout=httpx.Timeout(float(timeout or DEFAULT_TIMEOUT), connect=10),
+            ),
+        )
+        rpm = int(requests_per_minute or DEFAULT_REQUESTS_PER_MINUTE)
+        tpm = int(tokens_per_minute or DEFAULT_TOKENS_PER_MINUTE)
+        # Worker processes of the supervisor share the budget of the account
+        self._rate_limiter: RateLimiter = (
+            RemoteRateLimiter(rate_limit_server, rpm, tpm, n_concurrent)
+            if rate_limit_server
+            else RateLimiter(rpm, tpm, n_concurrent)
+        )
+        self._max_retries = int(max_retries or DEFAULT_MAX_RETRIES)
         self._openai_model = "gpt-4o-mini"
         self._max_input_tokens = 120000
+        self._trim_chunk_tokens = int(
+            trim_chunk_tokens if trim_chunk_tokens is not None else 8000
+        )
         try:
-            self._token_encoder = tiktoken.encoding_for_model(self._openai_model)
+            self._encoding_name = tiktoken.model.encoding_name_for_model(
+                self._openai_model
+            )
         except KeyError:
-            self._token_encoder = tiktoken.get_encoding("cl100k_base")
+            self._encoding_name = "cl100k_base"
+        self._token_cache = TokenCountCache(
+            self._encoding_name,
+            max_size=int(token_cache_size or DEFAULT_TOKEN_CACHE_SIZE),
+            path=token_cache_path,
+        )
+
+    @functools.cached_property
+    def _token_encoder(self) -> tiktoken.Encoding:
+        """Loaded on first use, since it may have to be downloaded."""
+        return tiktoken.get_encoding(self._encoding_name)
+
+    @property
+    def token_cache(self) -> TokenCountCache:
+        return self._token_cache
 
     def number_of_tokens(self, text: str) -> int:
-        return len(self._token_encoder.encode(text)) + ROLE_TOKENS + MESSAGE_TOKENS
-
-    def shorten_history(
-        self, n_preamble_tokens: int, history: list[GPTMessage]
-    ) -> None:
-        """Shortens the history to fit within the token limit."""
-        number_of_tokens = (
-            n_preamble_tokens + sum(m.n_tokens for m in history) + REPLY_TOKENS
-        )
-        while number_of_tokens > self._max_input_tokens and history:
-            number_of_tokens -= history.pop(0).n_tokens
+        """Counts the tokens of a single text. Used on the event loop, so only
+        the cache in memory is consulted, not the one on disk."""
+        return self._count_tokens([text], from_disk=False)[0]
+
+    def number_of_tokens_batch(self, texts: Sequence[str]) -> list[int]:
+        """Like number_of_tokens, but encodes all texts in one call on a thread
+        pool. Texts which were counted before are taken from the cache, also
+        from disk, so this is meant to run on a worker thread."""
+        return self._count_tokens(texts, from_disk=True)
+
+    def _count_tokens(self, texts: Sequence[str], from_disk: bool) -> list[int]:
+        if not texts:
+            return []
+        counts = self._token_cache.get_many(texts, from_disk)
+        unknown = [i for i, n in enumerate(counts) if n is None]
+        if unknown:
+            unknown_texts = [texts[i] for i in unknown]
+            if len(unknown_texts) == 1:
+                encoded = [self._token_encoder.encode(unknown_texts[0])]
+            else:
+                encoded = self._token_encoder.encode_batch(
+                    unknown_texts, num_threads=TOKENIZER_THREADS
+                )
+            new_counts = [len(tokens) for tokens in encoded]
+            self._token_cache.put_many(unknown_texts, new_counts)
+            for i, n in zip(unknown, new_counts):
+                counts[i] = n
+        return [n + ROLE_TOKENS + MESSAGE_TOKENS for n in counts]  # type: ignore
+
+    def shorten_history(self, n_preamble_tokens: int, history: ChatHistory) -> None:
+        """Shortens the history to fit within the token limit.
+
+        Once over the limit, trim_chunk_tokens more than necessary are removed, so
+        the start of the prompt stays the same for the following requests and the
+        provider's prompt cache can be used."""
+        budget = self._max_input_tokens - n_preamble_tokens - REPLY_TOKENS
+        if history.n_tokens <= budget:
+            return
+        budget -= self._trim_chunk_tokens
+        while history.n_tokens > budget and history:
+            history.pop_oldest()
 
-    async def send_and_receive(self, messages: Sequence[GPTMessage]) -> str | None:
+    def message_param(self, message: GPTMessage) -> ChatCompletionMessageParam:
+        return _to_openai_param(message)
+
+    async def send_and_receive(
+        self,
+        messages: Sequence[GPTMessage],
+        usage: TokenUsage | None = None,
+        params: Sequence[object] | None = None,
+    ) -> str | None:
         _logger.debug(
             "Request from ChatGPT with %i messages: %s",
             len(messages),
             messages[-1].content if messages else None,
         )
-        openai_messages: list[ChatCompletionMessageParam] = []
-        for m in messages:
-            if m.role == Role.SYSTEM:
-                openai_messages.append(
-                    ChatCompletionSystemMessageParam(role="system", content=m.content)
-                )
-            elif m.role == Role.USER:
-                openai_messages.append(
-                    ChatCompletionUserMessageParam(role="user", content=m.content)
-                )
-            else:
-                openai_messages.append(
-                    ChatCompletionAssistantMessageParam(
-                        role="assistant", content=m.content
-                    )
-                )
-        try:
-            response = await self._client.chat.completions.create(
-                model=self._openai_model,
-                messages=openai_messages,
-                max_completion_tokens=8000,
-                temperature=0.5,
-                n=1,
-            )
-        except Exception as e:
-            _logger.error("Error from ChatGPT: %s", e)
+        t_start = time.monotonic()
+        response = await self._create_completion(
+            _to_openai_messages(messages, params), _prompt_tokens(messages)
+        )
+        if response is not None:
+            _add_usage(usage, response.usage)
+        if response is None:
             return None
         if not response.choices:
             _logger.error("No choices in response from ChatGPT")
@@ -90,4 +334,205 @@ class ChatGPTInterfaceImpl(ChatGPTInterface):
             len(response.choices),
             response.choices[0].message.content if response.choices else None,
         )
-        return response.choices[0].message.content or "Again?"
+        reply = response.choices[0].message.content or "Again?"
+        self._recorder.record_completion(messages, reply, time.monotonic() - t_start)
+        return reply
+
+    async def _create_completion(
+        self, messages: list[ChatCompletionMessageParam], n_prompt_tokens: int
+    ) -> ChatCompletion | None:
+        """Sends the request within the rate limits and retries on rate limit,
+        server and connection errors."""
+        estimate = n_prompt_tokens + COMPLETION_TOKEN_ESTIMATE
+        metrics.llm_request_tokens.observe(n_prompt_tokens)
+        for attempt in range(self._max_retries + 1):
+            async with self._rate_limiter.reserve(estimate):
+                t_start = time.monotonic()
+                try:
+                    response = await self._client.chat.completions.create(
+                        model=self._openai_model,
+                        messages=messages,
+                        max_completion_tokens=MAX_COMPLETION_TOKENS,
+                        temperature=0.5,
+                        n=1,
+                    )
+                except (
+                    openai.RateLimitError,
+                    openai.InternalServerError,
+                    openai.APIConnectionError,
+                ) as e:
+                    metrics.llm_requests.inc(outcome="retryable_error")
+                    error: openai.APIError = e
+                except Exception as e:
+                    metrics.llm_requests.inc(outcome="error")
+                    _logger.error("Error from ChatGPT: %s", e)
+                    return None
+                else:
+                    metrics.llm_latency.observe(
+                        time.monotonic() - t_start, kind="complete"
+                    )
+                    metrics.llm_requests.inc(outcome="ok")
+                    if response.usage is not None:
+                        self._rate_limiter.adjust_tokens(
+                            estimate - response.usage.total_tokens
+                        )
+                    return response
+            if not await self._wait_for_retry(attempt, error):
+                return None
+        return None
+
+    async def stream_and_receive(
+        self,
+        messages: Sequence[GPTMessage],
+        usage: TokenUsage | None = None,
+        params: Sequence[object] | None = None,
+    ) -> AsyncIterator[str]:
+        """Streams the reply. Errors are only retried as long as nothing has been
+        yielded yet; afterwards the stream just ends. A reply which is cut off
+        raises IncompleteReplyError once the stream is done."""
+        openai_messages = _to_openai_messages(messages, params)
+        t_request = time.monotonic()
+        pieces: list[str] = []
+        n_prompt_tokens = _prompt_tokens(messages)
+        estimate = n_prompt_tokens + COMPLETION_TOKEN_ESTIMATE
+        metrics.llm_request_tokens.observe(n_prompt_tokens)
+        for attempt in range(self._max_retries + 1):
+            received = False
+            finish_reason = None
+            async with self._rate_limiter.reserve(estimate):
+                t_start = time.monotonic()
+                try:
+                    stream = await self._client.chat.completions.create(
+                        model=self._openai_model,
+                        messages=openai_messages,
+                        max_completion_tokens=MAX_COMPLETION_TOKENS,
+                        temperature=0.5,
+                        n=1,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    )
+                    try:
+                        async for chunk in stream:
+                            if chunk.usage is not None:
+                                self._rate_limiter.adjust_tokens(
+                                    estimate - chunk.usage.total_tokens
+                                )
+                                _add_usage(usage, chunk.usage)
+                            if not chunk.choices:
+                                continue
+                            choice = chunk.choices[0]
+                            if choice.delta.content:
+                                if not received:
+                                    metrics.llm_latency.observe(
+                                        time.monotonic() - t_start, kind="first_token"
+                                    )
+                                received = True
+                                pieces.append(choice.delta.content)
+                                yield choice.delta.content
+                            finish_reason = choice.finish_reason or finish_reason
+                    finally:
+                        await stream.close()
+                    metrics.llm_latency.observe(
+                        time.monotonic() - t_start, kind="stream"
+                    )
+                    metrics.llm_requests.inc(outcome="ok")
+                    if finish_reason not in (None, "stop"):
+                        _logger.error("ChatGPT stopped with reason: %s", finish_reason)
+                        raise IncompleteReplyError(finish_reason)
+                    self._recorder.record_completion(
+                        messages, "".join(pieces), time.monotonic() - t_request
+                    )
+                    return
+                except IncompleteReplyError:
+                    raise
+                except (
+                    openai.RateLimitError,
+                    openai.InternalServerError,
+                    openai.APIConnectionError,
+                ) as e:
+                    if received:
+                        metrics.llm_requests.inc(outcome="error")
+                        _logger.error("Error from ChatGPT while streaming: %s", e)
+                        return
+                    metrics.llm_requests.inc(outcome="retryable_error")
+                    error: openai.APIError = e
+                except Exception as e:
+                    metrics.llm_requests.inc(outcome="error")
+                    _logger.error("Error from ChatGPT: %s", e)
+                    return
+            if not await self._wait_for_retry(attempt, error):
+                return
+
+    async def _wait_for_retry(self, attempt: int, error: openai.APIError) -> bool:
+        """Waits before the next attempt. Returns False if there are no attempts
+        left."""
+        if attempt >= self._max_retries:
+            _logger.error(
+                "Error from ChatGPT, giving up after %i attempts: %s",
+                attempt + 1,
+                error,
+            )
+            return False
+        delay = backoff_delay(attempt, retry_after=_retry_after(error))
+        _logger.warning(
+            "Error from ChatGPT, retrying in %.1fs (attempt %i/%i): %s",
+            delay,
+            attempt + 1,
+            self._max_retries,
+            error,
+        )
+        await asyncio.sleep(delay)
+        return True
+
+
+def _to_openai_param(message: GPTMessage) -> ChatCompletionMessageParam:
+    if message.role == Role.SYSTEM:
+        return ChatCompletionSystemMessageParam(role="system", content=message.content)
+    elif message.role == Role.USER:
+        return ChatCompletionUserMessageParam(role="user", content=message.content)
+    else:
+        return ChatCompletionAssistantMessageParam(
+            role="assistant", content=message.content
+        )
+
+
+def _to_openai_messages(
+    messages: Sequence[GPTMessage], params: Sequence[object] | None = None
+) -> list[ChatCompletionMessageParam]:
+    if params is not None:
+        return params  # type: ignore
+    return [_to_openai_param(m) for m in messages]
+
+
+def _add_usage(
+    usage: TokenUsage | None, completion_usage: CompletionUsage | None
+) -> None:
+    """Adds the usage of a request to the totals of the caller and to the metrics."""
+    if completion_usage is not None:
+        details = getattr(completion_usage, "prompt_tokens_details", None)
+        cached_tokens = (details.cached_tokens or 0) if details is not None else 0
+        metrics.llm_tokens.inc(completion_usage.prompt_tokens, kind="prompt")
+        metrics.llm_tokens.inc(completion_usage.completion_tokens, kind="completion")
+        metrics.llm_tokens.inc(cached_tokens, kind="cached")
+    if usage is None:
+        return
+    usage.requests += 1
+    if completion_usage is not None:
+        usage.prompt_tokens += completion_usage.prompt_tokens
+        usage.completion_tokens += completion_usage.completion_tokens
+        usage.cached_tokens += cached_tokens
+
+
+def _prompt_tokens(messages: Sequence[GPTMessage]) -> int:
+    return sum(m.n_tokens for m in messages) + REPLY_TOKENS
+
+
+def _retry_after(error: openai.APIError) -> float:
+    """Delay requested by the server, 0 if none."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return 0.0
+    try:
+        return float(response.headers.get("retry-after", 0))
+    except ValueError:
+        return 0.0
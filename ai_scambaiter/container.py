@@ -3,26 +3,60 @@ from dependency_injector import containers, providers
 from . import (
     BotRunner,
     ChatGPTInterface,
+    ConversationStore,
     TelegramInterface,
 )
 from .bot_runner import BotRunnerImpl
 from .chatgpt_interface import ChatGPTInterfaceImpl
+from .conversation_store import ConversationStoreImpl
+from .recording import TrafficRecorder
+from .relay import TelegramRelay
+from .supervisor import Supervisor
 from .telegram_interface import TelegramInterfaceImpl
 
 
 class Container(containers.DeclarativeContainer):
     config = providers.Configuration(ini_files=["./config.ini"])
 
+    traffic_recorder = providers.Singleton(
+        TrafficRecorder,
+        path=config.recording.path,
+    )
+
     telegram_interface: TelegramInterface = providers.Singleton(
         TelegramInterfaceImpl,
         api_id=config.auth.telegram_api_id,
         api_hash=config.auth.telegram_api_hash,
         phone=config.auth.phone,
+        ingress_size=config.telegram.ingress_size,
+        ingress_policy=config.telegram.ingress_policy,
+        ingress_spill_path=config.telegram.ingress_spill,
+        recorder=traffic_recorder,
+        session=config.auth.session,
+        dialog_cache_path=config.telegram.dialog_cache,
+        outbound_settings=config.outbound,
+        chats=config.conversations.chats,
     )
 
     chatgpt_inferface: ChatGPTInterface = providers.Singleton(
         ChatGPTInterfaceImpl,
         api_key=config.auth.openai_api_key,
+        token_cache_path=config.chatgpt.token_cache,
+        token_cache_size=config.chatgpt.token_cache_size,
+        requests_per_minute=config.chatgpt.requests_per_minute,
+        tokens_per_minute=config.chatgpt.tokens_per_minute,
+        max_concurrency=config.chatgpt.max_concurrency,
+        max_retries=config.chatgpt.max_retries,
+        timeout=config.chatgpt.timeout,
+        trim_chunk_tokens=config.chatgpt.trim_chunk_tokens,
+        base_url=config.chatgpt.base_url,
+        recorder=traffic_recorder,
+        rate_limit_server=config.chatgpt.rate_limit_server,
+    )
+
+    conversation_store: ConversationStore = providers.Singleton(
+        ConversationStoreImpl,
+        path=config.storage.conversations,
     )
 
     bot_runner: BotRunner = providers.Singleton(
@@ -30,6 +64,30 @@ class Container(containers.DeclarativeContainer):
         message_stream=telegram_interface.provided.message_stream,
         telegram_interface=telegram_interface,
         chatgpt_interface=chatgpt_inferface,
+        conversation_store=conversation_store,
         conversations=config.conversations.chats,
         own_id=config.auth.own_id,
+        start_concurrency=config.conversations.start_concurrency,
+        inbox_size=config.conversations.inbox_size,
+        inbox_policy=config.conversations.inbox_policy,
+        agent_settings=config.agent,
+        reply_workers=config.conversations.reply_workers,
+        checkpoint_interval=config.conversations.checkpoint_interval,
+        catch_up_ramp=config.conversations.catch_up_ramp,
+        prefilter_settings=config.prefilter,
+    )
+
+    supervisor = providers.Singleton(
+        Supervisor,
+        workers=config.supervisor.workers,
+        requests_per_minute=config.chatgpt.requests_per_minute,
+        tokens_per_minute=config.chatgpt.tokens_per_minute,
+        rate_limit_port=config.supervisor.rate_limit_port,
+        agent_workers=config.supervisor.agent_workers,
+    )
+
+    telegram_relay = providers.Singleton(
+        TelegramRelay,
+        telegram_interface=telegram_interface,
+        path=config.supervisor.relay_socket,
     )
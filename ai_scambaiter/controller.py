@@ -36,10 +36,8 @@ class Controller:
     def print_help(self):
         print(help_text)
         print("Chats:\n")
-        agents = self._bot_runner.agents.keys()
-        for i, chat_id in enumerate(agents):
-            dialog = self._telegram_interface.dialogs[chat_id]
-            print(f"{i}: {chat_id} - {dialog.title}")
+        for i, (chat_id, agent) in enumerate(self._bot_runner.agents.items()):
+            print(f"{i}: {chat_id} - {agent.title}")
 
     async def run(self):
         self.print_help()
@@ -78,10 +76,11 @@ class Controller:
                 print(f"Error: {e}")
 
     def _get_chat_id(self, chat_index: int) -> int | None:
-        if chat_index < 0 or chat_index >= len(self._bot_runner.agents):
+        chat_ids = self._bot_runner.chat_ids
+        if chat_index < 0 or chat_index >= len(chat_ids):
             print("Invalid chat_index")
             return None
-        return list(self._bot_runner.agents.keys())[chat_index]
+        return chat_ids[chat_index]
 
     @inject
     async def _send_message(
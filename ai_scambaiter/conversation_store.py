@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import logging
+import sqlite3
+import threading
+from collections.abc import Collection, Mapping, Sequence
+
+from . import ConversationStore, GPTMessage, Role
+
+DEFAULT_PATH = "conversations.db"
+
+_logger = logging.getLogger("Store")
+
+
+class ConversationStoreImpl(ConversationStore):
+    """Append-only sqlite store (WAL mode) of the messages of all chats."""
+
+    def __init__(self, path: str | None = None):
+        self._path = path or DEFAULT_PATH
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self._path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, "
+            "role INTEGER NOT NULL, content TEXT NOT NULL, n_tokens INTEGER NOT NULL, "
+            "PRIMARY KEY (chat_id, message_id)) WITHOUT ROWID"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "chat_id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL, "
+            "content TEXT NOT NULL, n_tokens INTEGER NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS deadlines ("
+            "chat_id INTEGER NOT NULL, kind TEXT NOT NULL, due_at REAL NOT NULL, "
+            "PRIMARY KEY (chat_id, kind)) WITHOUT ROWID"
+        )
+        self._db.commit()
+        _logger.info("Using conversation store %s", self._path)
+
+    def load(
+        self, chat_id: int, number_of_messages: int
+    ) -> list[tuple[int, GPTMessage]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT message_id, role, content, n_tokens FROM messages "
+                "WHERE chat_id = ? ORDER BY message_id DESC LIMIT ?",
+                (chat_id, number_of_messages),
+            ).fetchall()
+        return [
+            (message_id, GPTMessage(content=content, role=Role(role), n_tokens=n))
+            for message_id, role, content, n in reversed(rows)
+        ]
+
+    def add(self, chat_id: int, message_id: int, message: GPTMessage) -> None:
+        self.add_many(chat_id, [(message_id, message)])
+
+    def add_many(
+        self, chat_id: int, messages: Sequence[tuple[int, GPTMessage]]
+    ) -> None:
+        if not messages:
+            return
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)",
+                [
+                    (chat_id, message_id, m.role.value, m.content, m.n_tokens)
+                    for message_id, m in messages
+                ],
+            )
+            self._db.commit()
+
+    def remove_last(self, chat_id: int, role: Role) -> None:
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM messages WHERE chat_id = ? AND message_id = ("
+                "SELECT MAX(message_id) FROM messages WHERE chat_id = ? AND role = ?)",
+                (chat_id, chat_id, role.value),
+            )
+            self._db.commit()
+
+    def save_summary(self, chat_id: int, message_id: int, summary: GPTMessage) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?)",
+                (chat_id, message_id, summary.content, summary.n_tokens),
+            )
+            self._db.commit()
+
+    def load_summary(self, chat_id: int) -> tuple[int, GPTMessage] | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT message_id, content, n_tokens FROM summaries WHERE chat_id = ?",
+                (chat_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        message_id, content, n_tokens = row
+        return message_id, GPTMessage(
+            content=content, role=Role.SYSTEM, n_tokens=n_tokens
+        )
+
+    def save_deadlines(
+        self,
+        deadlines: Mapping[tuple[int, str], float],
+        chat_ids: Collection[int] | None = None,
+    ) -> None:
+        with self._lock:
+            if chat_ids is None:
+                self._db.execute("DELETE FROM deadlines")
+            else:
+                # Other processes may keep the deadlines of other chats here
+                self._db.executemany(
+                    "DELETE FROM deadlines WHERE chat_id = ?",
+                    [(chat_id,) for chat_id in chat_ids],
+                )
+            self._db.executemany(
+                "INSERT INTO deadlines VALUES (?, ?, ?)",
+                [(chat_id, kind, due) for (chat_id, kind), due in deadlines.items()],
+            )
+            self._db.commit()
+
+    def load_deadlines(self) -> dict[tuple[int, str], float]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT chat_id, kind, due_at FROM deadlines"
+            ).fetchall()
+        return {(chat_id, kind): due for chat_id, kind, due in rows}
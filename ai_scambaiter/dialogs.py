@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections.abc import Iterable
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+
+from telethon import utils
+from telethon.extensions import BinaryReader
+
+if TYPE_CHECKING:
+    from telethon import TelegramClient
+
+_logger = logging.getLogger("Telegram")
+
+
+@dataclass(slots=True)
+class DialogEntry:
+    id: int
+    title: str
+    # Id of the newest message when the dialog was last seen in the dialog list
+    top_message: int = 0
+    # Input peer, so requests need no lookup of the entity
+    entity: Any = None
+
+
+class DialogRegistry:
+    """The dialogs of the account, indexed by chat id and title.
+
+    Dialogs are fetched when they are first needed: a single chat by id, or the
+    dialog list when a title is unknown. The list is refreshed incrementally,
+    newest dialog first, up to the first dialog without new messages. Entries are
+    kept in a sqlite file at path, so restarts need no download at all; the file
+    is written by a worker thread."""
+
+    def __init__(self, client: TelegramClient | None = None, path: str | None = None):
+        self._client = client
+        self._entries: dict[int, DialogEntry] = {}
+        self._titles: dict[str, int] = {}
+        self._refresh_lock = asyncio.Lock()
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS dialogs ("
+                "chat_id INTEGER PRIMARY KEY, title TEXT NOT NULL, "
+                "top_message INTEGER NOT NULL, input_peer BLOB)"
+            )
+            self._db.commit()
+            self._load()
+
+    @property
+    def entries(self) -> dict[int, DialogEntry]:
+        return self._entries
+
+    def get(self, chat_id: int) -> DialogEntry | None:
+        return self._entries.get(chat_id)
+
+    def by_title(self, title: str) -> DialogEntry | None:
+        chat_id = self._titles.get(title)
+        return self._entries.get(chat_id) if chat_id is not None else None
+
+    def lookup(self, chat_id_or_title: str | int) -> DialogEntry | None:
+        """The known dialog with this chat id or title, without fetching it."""
+        try:
+            return self.get(int(chat_id_or_title))
+        except ValueError:
+            return self.by_title(str(chat_id_or_title))
+
+    async def resolve(self, chat_id_or_title: str | int) -> DialogEntry | None:
+        """The dialog with this chat id or title, fetched if it is not known."""
+        if (entry := self.lookup(chat_id_or_title)) is not None:
+            return entry
+        async with self._refresh_lock:
+            # Another agent may have fetched it meanwhile
+            if (entry := self.lookup(chat_id_or_title)) is not None:
+                return entry
+            try:
+                chat_id = int(chat_id_or_title)
+            except ValueError:
+                await self._refresh()
+                return self.lookup(chat_id_or_title)
+            if (entry := await self._fetch(chat_id)) is None:
+                await self._refresh()
+                entry = self.get(chat_id)
+            return entry
+
+    async def refresh(self, full: bool = False) -> int:
+        """Updates the dialogs with new messages (all dialogs if full) from the
+        dialog list. Returns the number of updated dialogs."""
+        async with self._refresh_lock:
+            return await self._refresh(full)
+
+    async def add(self, entries: Iterable[DialogEntry]) -> None:
+        """Adds or updates the entries, which are known at once and stored."""
+        entries = list(entries)
+        for entry in entries:
+            self._add(entry)
+        if self._db is None or not entries:
+            return
+        rows = [
+            (
+                e.id,
+                e.title,
+                e.top_message,
+                bytes(e.entity) if e.entity is not None else None,
+            )
+            for e in entries
+        ]
+        try:
+            await asyncio.to_thread(self._store, rows)
+        except sqlite3.Error as e:
+            _logger.error("Could not store the dialogs: %s", e)
+
+    def _store(self, rows: list[tuple]) -> None:
+        assert self._db is not None
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO dialogs VALUES (?, ?, ?, ?)", rows
+            )
+            self._db.commit()
+
+    def _add(self, entry: DialogEntry) -> None:
+        old = self._entries.get(entry.id)
+        if old is not None and self._titles.get(old.title) == entry.id:
+            del self._titles[old.title]
+        self._entries[entry.id] = entry
+        # With duplicate titles the first dialog seen keeps the title
+        self._titles.setdefault(entry.title, entry.id)
+
+    def _load(self) -> None:
+        assert self._db is not None
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT chat_id, title, top_message, input_peer FROM dialogs"
+            ).fetchall()
+        for chat_id, title, top_message, input_peer in rows:
+            entity = None
+            if input_peer is not None:
+                try:
+                    entity = BinaryReader(input_peer).tgread_object()
+                except Exception as e:
+                    _logger.warning("Invalid cached entity of %i: %s", chat_id, e)
+            self._add(DialogEntry(chat_id, title, top_message, entity))
+        _logger.info("Loaded %i cached dialogs", len(rows))
+
+    async def _fetch(self, chat_id: int) -> DialogEntry | None:
+        """Fetches a single chat, without the dialog list."""
+        if self._client is None:
+            return None
+        try:
+            entity = await self._client.get_entity(chat_id)
+        except ValueError:
+            # Not in the session's entity cache yet
+            return None
+        entry = DialogEntry(
+            chat_id, utils.get_display_name(entity), 0, utils.get_input_peer(entity)
+        )
+        await self.add([entry])
+        return entry
+
+    async def _refresh(self, full: bool = False) -> int:
+        if self._client is None:
+            return 0
+        changed: list[DialogEntry] = []
+        async for dialog in self._client.iter_dialogs():
+            top_message = dialog.message.id if dialog.message is not None else 0
+            known = self._entries.get(dialog.id)
+            if (
+                not full
+                and not dialog.pinned
+                and known is not None
+                and known.top_message == top_message
+            ):
+                # The list is sorted by the newest message, the rest is unchanged
+                break
+            changed.append(
+                DialogEntry(
+                    dialog.id, dialog.title or "", top_message, dialog.input_entity
+                )
+            )
+        await self.add(changed)
+        _logger.info("Refreshed %i dialogs", len(changed))
+        return len(changed)
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+from collections import deque
+from itertools import islice
+from typing import Callable, Iterator
+
+from . import GPTMessage, Role
+
+
+class ChatHistory:
+    """Conversation history with a running token total.
+
+    Messages are kept in a deque, so appending and evicting the oldest message are
+    O(1). Removed messages are replaced by a tombstone (None) instead of being
+    deleted from the middle of the deque; tombstones are dropped once they reach
+    the front.
+
+    If to_param is given, the provider specific representation of every message is
+    created once on append and kept next to it, so a request can be assembled
+    without converting the whole history again. With keep_ids, the telegram
+    message id given on append is kept as well."""
+
+    def __init__(
+        self,
+        to_param: Callable[[GPTMessage], object] | None = None,
+        keep_ids: bool = False,
+    ) -> None:
+        self._to_param = to_param
+        self._keep_ids = keep_ids
+        self._messages: deque[GPTMessage | None] = deque()
+        # Same length as self._messages if to_param is given, otherwise empty
+        self._params: deque[object] = deque()
+        # Same length as self._messages if keep_ids is set, otherwise empty
+        self._ids: deque[int | None] = deque()
+        # Absolute positions of the assistant messages that are still present
+        self._assistant_positions: deque[int] = deque()
+        # Absolute position of self._messages[0]
+        self._offset: int = 0
+        self._n_tokens: int = 0
+        self._n_messages: int = 0
+
+    @property
+    def n_tokens(self) -> int:
+        """Sum of the tokens of all messages in the history."""
+        return self._n_tokens
+
+    def __len__(self) -> int:
+        return self._n_messages
+
+    def __bool__(self) -> bool:
+        return self._n_messages > 0
+
+    def __iter__(self) -> Iterator[GPTMessage]:
+        return (m for m in self._messages if m is not None)
+
+    def append(self, message: GPTMessage, message_id: int | None = None) -> None:
+        if message.role == Role.ASSISTANT:
+            self._assistant_positions.append(self._offset + len(self._messages))
+        self._messages.append(message)
+        if self._to_param is not None:
+            self._params.append(self._to_param(message))
+        if self._keep_ids:
+            self._ids.append(message_id)
+        self._n_tokens += message.n_tokens
+        self._n_messages += 1
+
+    def oldest(self) -> GPTMessage | None:
+        """Returns the oldest message without removing it."""
+        self._drop_leading_tombstones()
+        return self._messages[0] if self._messages else None
+
+    def pop_oldest(self) -> GPTMessage:
+        """Removes and returns the oldest message."""
+        self._drop_leading_tombstones()
+        if not self._messages:
+            raise IndexError("pop from empty history")
+        message = self._messages.popleft()
+        assert message is not None
+        if self._params:
+            self._params.popleft()
+        if self._ids:
+            self._ids.popleft()
+        if self._assistant_positions and self._assistant_positions[0] == self._offset:
+            self._assistant_positions.popleft()
+        self._offset += 1
+        self._n_tokens -= message.n_tokens
+        self._n_messages -= 1
+        self._drop_leading_tombstones()
+        return message
+
+    def remove_last_assistant_message(self) -> GPTMessage | None:
+        """Removes the most recent assistant message, if any."""
+        if not self._assistant_positions:
+            return None
+        index = self._assistant_positions.pop() - self._offset
+        message = self._messages[index]
+        assert message is not None
+        if index == len(self._messages) - 1:
+            self._messages.pop()
+            if self._params:
+                self._params.pop()
+            if self._ids:
+                self._ids.pop()
+        else:
+            self._messages[index] = None
+        self._n_tokens -= message.n_tokens
+        self._n_messages -= 1
+        self._drop_leading_tombstones()
+        return message
+
+    def last(self, n: int) -> list[GPTMessage]:
+        """Returns the last n messages, oldest first."""
+        if n <= 0:
+            return []
+        latest = islice((m for m in reversed(self._messages) if m is not None), n)
+        return list(latest)[::-1]
+
+    def items(self) -> Iterator[tuple[int | None, GPTMessage]]:
+        """The messages with their telegram message ids, oldest first."""
+        if not self._keep_ids:
+            raise RuntimeError("History does not keep message ids")
+        return ((i, m) for i, m in zip(self._ids, self._messages) if m is not None)
+
+    @property
+    def keeps_params(self) -> bool:
+        return self._to_param is not None
+
+    def params(self) -> list[object]:
+        """The provider specific representations of all messages, oldest first."""
+        if self._to_param is None:
+            raise RuntimeError("History does not keep message params")
+        if len(self._messages) == self._n_messages:
+            return list(self._params)
+        return [p for m, p in zip(self._messages, self._params) if m is not None]
+
+    def clear(self) -> None:
+        self._offset += len(self._messages)
+        self._messages.clear()
+        self._params.clear()
+        self._ids.clear()
+        self._assistant_positions.clear()
+        self._n_tokens = 0
+        self._n_messages = 0
+
+    def _drop_leading_tombstones(self) -> None:
+        while self._messages and self._messages[0] is None:
+            self._messages.popleft()
+            if self._params:
+                self._params.popleft()
+            if self._ids:
+                self._ids.popleft()
+            self._offset += 1
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from collections.abc import Callable, Collection
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, TypeVar
+
+from telethon import utils
+from telethon.tl.custom import Message
+
+from . import metrics
+
+_logger = logging.getLogger("Telegram")
+
+# What to do with a new message if the buffer is full:
+# block            - wait until there is space (stalls the telegram client)
+# drop_oldest      - discard the oldest buffered message
+# drop_unmonitored - discard the oldest message of a chat without agent, otherwise
+#                    spill; messages of monitored chats are never discarded
+# spill            - write messages to a file until there is space again
+INGRESS_POLICIES = ("block", "drop_oldest", "drop_unmonitored", "spill")
+DEFAULT_SPILL_PATH = "ingress_spill.bin"
+
+_T = TypeVar("_T")
+
+
+def message_fields(message: Any) -> list:
+    """The fields of a message the agents use, see make_message."""
+    return [message.chat_id, message.id, message.sender_id, message.text]
+
+
+def _peer(marked_id: int) -> Any:
+    real_id, peer_type = utils.resolve_id(marked_id)
+    return peer_type(real_id)
+
+
+def make_message(
+    chat_id: int, message_id: int, sender_id: int | None, text: str | None
+) -> Message:
+    """Rebuilds a message with the fields the agents use."""
+    message = Message(
+        message_id,
+        peer_id=_peer(chat_id),
+        from_id=_peer(sender_id) if sender_id is not None else None,
+    )
+    message.text = text
+    return message
+
+
+class IngressBuffer:
+    """Buffer between telethon's event handler and the bot runner.
+
+    Except for the block policy, put() never waits, so a slow consumer cannot stall
+    the telegram client. Once the monitored chats are known, messages from other
+    chats are discarded before they are buffered. Until then, monitored_chats are
+    the chats known to be monitored (e.g. from the configuration), so the
+    drop_unmonitored policy can discard messages of other chats at startup. None
+    means any chat may be monitored.
+
+    Spilled messages keep only the fields of message_fields. The spill file is
+    written and read by a thread of its own, in the order of the calls."""
+
+    def __init__(
+        self,
+        maxsize: int = 100,
+        policy: str = "drop_unmonitored",
+        spill_path: str | None = None,
+        monitored_chats: Collection[int] | None = None,
+    ):
+        if policy not in INGRESS_POLICIES:
+            raise ValueError(f"Unknown ingress policy {policy}")
+        self._maxsize = maxsize
+        self._policy = policy
+        self._spill_path = os.path.abspath(spill_path or DEFAULT_SPILL_PATH)
+        self._messages: deque[Message] = deque()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._monitored: frozenset[int] | None = None
+        self._configured: frozenset[int] | None = (
+            frozenset(monitored_chats) if monitored_chats is not None else None
+        )
+        self._spill_executor: ThreadPoolExecutor | None = None
+        self._spill_writer: Any = None
+        self._spill_reader: Any = None
+        self._n_spilled = 0
+        self.high_water_mark = 0
+        self.dropped = 0
+        self.filtered = 0
+        self.spilled = 0
+
+    @property
+    def depth(self) -> int:
+        """Number of buffered messages, including spilled ones."""
+        return len(self._messages) + self._n_spilled
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "depth": self.depth,
+            "high_water_mark": self.high_water_mark,
+            "dropped": self.dropped,
+            "filtered": self.filtered,
+            "spilled": self.spilled,
+        }
+
+    def set_monitored_chats(self, chat_ids: Collection[int] | None) -> None:
+        """Messages from chats not in chat_ids are discarded from now on. None
+        accepts all chats."""
+        self._monitored = frozenset(chat_ids) if chat_ids is not None else None
+
+    def accepts(self, chat_id: int) -> bool:
+        """Whether messages of the chat are buffered."""
+        return self._monitored is None or chat_id in self._monitored
+
+    def may_be_monitored(self, chat_id: int) -> bool:
+        """Whether the chat has or may have an agent. Unlike accepts, this is
+        False for chats which are not configured before the monitored chats are
+        set."""
+        known = self._monitored if self._monitored is not None else self._configured
+        return known is None or chat_id in known
+
+    async def put(self, message: Message) -> None:
+        if not self.accepts(message.chat_id):
+            self.filtered += 1
+            return
+        if self._n_spilled:
+            # Keep the order: once spilling, everything goes to the spill file
+            await self._spill(message)
+        elif len(self._messages) < self._maxsize:
+            self._messages.append(message)
+        elif self._policy == "block":
+            while len(self._messages) >= self._maxsize:
+                self._not_full.clear()
+                await self._not_full.wait()
+            self._messages.append(message)
+        elif self._policy == "spill" or not self._drop_one():
+            await self._spill(message)
+        else:
+            self._messages.append(message)
+        self.high_water_mark = max(self.high_water_mark, self.depth)
+        self._not_empty.set()
+
+    async def get(self) -> Message:
+        while not self._messages:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        message = self._messages.popleft()
+        if self._n_spilled:
+            # Counted until it is back, so put() keeps spilling in the meantime
+            self._messages.append(await self._in_spill_thread(self._read_record))
+            self._n_spilled -= 1
+            if not self._n_spilled:
+                await self._in_spill_thread(self._close_spill_file)
+            self._not_empty.set()
+        self._not_full.set()
+        return message
+
+    def _drop_one(self) -> bool:
+        """Discards a buffered message, returns False if none may be discarded."""
+        index = 0
+        if self._policy == "drop_unmonitored":
+            index = next(
+                (
+                    i
+                    for i, m in enumerate(self._messages)
+                    if not self.may_be_monitored(m.chat_id)
+                ),
+                -1,
+            )
+            if index < 0:
+                return False
+        dropped = self._messages[index]
+        del self._messages[index]
+        self.dropped += 1
+        metrics.tracer.discard(dropped.chat_id, dropped.id)
+        _logger.warning(
+            "Ingress buffer full, dropped message %i from chat %s",
+            dropped.id,
+            dropped.chat_id,
+        )
+        return True
+
+    async def _in_spill_thread(self, function: Callable[..., _T], *args: Any) -> _T:
+        if self._spill_executor is None:
+            self._spill_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="ingress-spill"
+            )
+        return await asyncio.get_running_loop().run_in_executor(
+            self._spill_executor, function, *args
+        )
+
+    async def _spill(self, message: Message) -> None:
+        self._n_spilled += 1
+        self.spilled += 1
+        line = json.dumps(message_fields(message), ensure_ascii=False) + "\n"
+        await self._in_spill_thread(self._write_record, line.encode("utf-8"))
+
+    def _write_record(self, data: bytes) -> None:
+        if self._spill_writer is None:
+            self._spill_writer = open(self._spill_path, "wb")
+            self._spill_reader = open(self._spill_path, "rb")
+        self._spill_writer.write(data)
+        self._spill_writer.flush()
+
+    def _read_record(self) -> Message:
+        return make_message(*json.loads(self._spill_reader.readline()))
+
+    def _close_spill_file(self) -> None:
+        self._spill_writer.close()
+        self._spill_reader.close()
+        self._spill_writer = self._spill_reader = None
+        os.remove(self._spill_path)
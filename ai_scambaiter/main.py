@@ -1,11 +1,16 @@
+import argparse
 import asyncio
 import logging
 
+from dependency_injector import providers
 from dependency_injector.wiring import Provide, inject
 
-from . import TelegramInterface, BotRunner
+from . import TelegramInterface, BotRunner, metrics
 from .container import Container
 from .controller import Controller
+from .conversation_store import DEFAULT_PATH as DEFAULT_CONVERSATIONS_PATH
+from .relay import RelayTelegramInterface, TelegramRelay
+from .supervisor import Supervisor, worker_name
 
 _logger = logging.getLogger("Main")
 
@@ -17,7 +22,13 @@ generate_scam = True
 async def _main(
     telegram_interface: TelegramInterface = Provide[Container.telegram_interface],
     bot_runner: BotRunner = Provide[Container.bot_runner],
+    metrics_port: str | None = Provide[Container.config.metrics.port],
+    interactive: bool = True,
 ):
+    if metrics_port:
+        await metrics.MetricsServer(
+            metrics.registry, metrics.tracer, int(metrics_port)
+        ).start()
     await telegram_interface.start()
     await bot_runner.start()
     if mock and generate_scam:
@@ -29,13 +40,81 @@ async def _main(
 
     while True:
         _logger.debug("Waiting for messages...")
-        coroutines = [bot_runner.run(), controller.run()]
+        coroutines = [bot_runner.run()]
+        # Workers of the supervisor share the terminal, so they take no commands
+        if interactive:
+            coroutines.append(controller.run())
         if mock and generate_scam:
             coroutines.append(scam_generator.run())
         await asyncio.gather(*coroutines)
 
 
-def main():
+@inject
+async def _supervise(supervisor: Supervisor = Provide[Container.supervisor]):
+    await supervisor.run()
+
+
+@inject
+async def _run_ingress(
+    config_path: str | None = None,
+    telegram_interface: TelegramInterface = Provide[Container.telegram_interface],
+    relay: TelegramRelay = Provide[Container.telegram_relay],
+    supervisor: Supervisor = Provide[Container.supervisor],
+    metrics_port: str | None = Provide[Container.config.metrics.port],
+):
+    """Receives and sends the telegram messages of all chats, while the agents
+    run in worker processes."""
+    if metrics_port:
+        await metrics.MetricsServer(
+            metrics.registry, metrics.tracer, int(metrics_port)
+        ).start()
+    await telegram_interface.start()
+    await supervisor.run_agent_workers(relay, config_path)
+
+
+def _use_relay(container: Container, path: str, shard: str) -> None:
+    """Sets up the container of an agent worker: telegram through the relay, the
+    chats of the shard, and files of its own for the conversation store, token
+    cache, recording and metrics. sqlite files are not shared, so the workers
+    never wait for each other's locks on the event loop."""
+    index, n_shards = (int(n) for n in shard.split("/"))
+    container.telegram_interface.override(
+        providers.Singleton(RelayTelegramInterface, path=path)
+    )
+    chats = (container.config.conversations.chats() or "").strip().split("\n")
+    container.config.conversations.chats.from_value("\n".join(chats[index::n_shards]))
+    metrics_port = container.config.metrics.port()
+    if metrics_port:
+        container.config.metrics.port.from_value(str(int(metrics_port) + 1 + index))
+    conversations_path = (
+        container.config.storage.conversations() or DEFAULT_CONVERSATIONS_PATH
+    )
+    container.config.storage.conversations.from_value(f"{conversations_path}.{index}")
+    token_cache_path = container.config.chatgpt.token_cache()
+    if token_cache_path:
+        container.config.chatgpt.token_cache.from_value(f"{token_cache_path}.{index}")
+    recording_path = container.config.recording.path()
+    if recording_path:
+        container.config.recording.path.from_value(f"{recording_path}.{index}")
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="AI scambaiter")
+    parser.add_argument(
+        "--config", help="config file read on top of config.ini, e.g. per account"
+    )
+    parser.add_argument(
+        "--worker", action="store_true", help="run as worker of the supervisor"
+    )
+    parser.add_argument(
+        "--rate-limit-server", help="host:port of the shared OpenAI rate limits"
+    )
+    parser.add_argument("--relay", help="socket of the telegram relay")
+    parser.add_argument("--shard", help="index/count of the chats to handle")
+    return parser.parse_args()
+
+
+def main(worker: str | None = None, mode: str = "bot", config: str | None = None):
     log_level = logging.INFO
     logging.basicConfig(
         level=log_level,
@@ -43,22 +122,45 @@ def main():
         datefmt="%Y-%m-%d %H:%M:%S",
         handlers=[
             # logging.StreamHandler(sys.stdout),
-            logging.FileHandler("ai_scambaiter.log", encoding="utf-8"),
+            logging.FileHandler(
+                f"ai_scambaiter.{worker}.log" if worker else "ai_scambaiter.log",
+                encoding="utf-8",
+            ),
         ],
     )
     logging.getLogger("Main").setLevel(log_level)
     logging.getLogger("BotRunner").setLevel(log_level)
     logging.getLogger("Agent").setLevel(log_level)
+    logging.getLogger("Scheduler").setLevel(log_level)
     logging.getLogger("ChatGPT").setLevel(log_level)
     logging.getLogger("Telegram").setLevel(log_level)
+    logging.getLogger("Store").setLevel(log_level)
+    logging.getLogger("Metrics").setLevel(log_level)
+    logging.getLogger("Recorder").setLevel(log_level)
+    logging.getLogger("RateLimit").setLevel(log_level)
+    logging.getLogger("Supervisor").setLevel(log_level)
+    logging.getLogger("Relay").setLevel(log_level)
+    logging.getLogger("Prefilter").setLevel(log_level)
     logging.getLogger("openai").setLevel(logging.WARN)
     logging.getLogger("telethon").setLevel(logging.WARN)
     logging.getLogger("httpcore").setLevel(logging.WARN)
-    asyncio.run(_main())
+    if mode == "supervisor":
+        asyncio.run(_supervise())
+    elif mode == "ingress":
+        asyncio.run(_run_ingress(config))
+    else:
+        asyncio.run(_main(interactive=worker is None))
 
 
 if __name__ == "__main__":
+    args = _parse_args()
     container = Container()
+    if args.config:
+        container.config.from_ini(args.config, required=True)
+    if args.rate_limit_server:
+        container.config.chatgpt.rate_limit_server.from_value(args.rate_limit_server)
+    if args.relay:
+        _use_relay(container, args.relay, args.shard or "0/1")
     container.wire(modules=[__name__])
 
     ### Test with mocks
@@ -75,4 +177,14 @@ if __name__ == "__main__":
         )
         ### End mocking
 
-    main()
+    if args.worker:
+        if args.relay:
+            main(worker=f"agents{(args.shard or '0').split('/')[0]}")
+        else:
+            main(worker=worker_name(args.config or "config.ini"))
+    elif container.config.supervisor.workers():
+        main(mode="supervisor")
+    elif int(container.config.supervisor.agent_workers() or 0) > 0:
+        main(mode="ingress", config=args.config)
+    else:
+        main()
@@ -0,0 +1,359 @@
+"""In-process metrics registry with Prometheus text exposition, and per-message
+traces of the reply pipeline.
+
+Instrumented code uses the metrics defined at the end of this module. Values which
+are cheaper to read on demand (queue depths, history sizes) are provided by
+collector callbacks that run when the metrics are rendered."""
+
+from __future__ import annotations
+
+import asyncio
+import bisect
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Iterable
+
+_logger = logging.getLogger("Metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+LabelValues = tuple[str, ...]
+# name, labels, value
+Sample = tuple[str, dict[str, str], float]
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        k
+        + '="'
+        + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names: tuple[str, ...] = tuple(labels)
+
+    def _key(self, labels: dict[str, object]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> list[Sample]:
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: object) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: object) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[Sample]:
+        return [
+            (self.name, dict(zip(self.label_names, key)), value)
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: object) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets))
+        # Per label values: counts per bucket (last one is +Inf), sum
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self._values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def count(self, **labels: object) -> int:
+        values = self._values.get(self._key(labels))
+        return sum(values[0]) if values else 0
+
+    def samples(self) -> list[Sample]:
+        samples: list[Sample] = []
+        for key, (counts, total) in self._values.items():
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                samples.append(
+                    (self.name + "_bucket", {**labels, "le": le}, cumulative)
+                )
+            samples.append((self.name + "_sum", labels, total[0]))
+            samples.append((self.name + "_count", labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+        self._collectors: list[Callable[[], None]] = []
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """Registers a callback which updates gauges before they are rendered."""
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], None]) -> None:
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    def collect(self) -> None:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                _logger.error("Error in metrics collector: %s", e)
+
+    def render(self) -> str:
+        """Renders all metrics in the Prometheus text format."""
+        self.collect()
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+class Tracer:
+    """Timestamps of the stages a message passes through until it is answered.
+
+    A trace is identified by chat id and message id. When a reply is sent, the
+    trace of the message which triggered it is finished and kept in a ring buffer
+    of recent traces."""
+
+    def __init__(self, max_open: int = 10000, max_finished: int = 1000):
+        self._open: OrderedDict[tuple[int, int], dict[str, float]] = OrderedDict()
+        self._max_open = max_open
+        self.finished: deque[dict[str, object]] = deque(maxlen=max_finished)
+
+    def mark(self, chat_id: int, message_id: int, stage: str) -> float:
+        """Records the time at which the message reached a stage and returns it.
+        Only the first time is kept if a stage is marked more than once."""
+        key = (chat_id, message_id)
+        trace = self._open.get(key)
+        if trace is None:
+            trace = self._open[key] = {}
+            if len(self._open) > self._max_open:
+                self._open.popitem(last=False)
+        return trace.setdefault(stage, time.time())
+
+    def since(self, chat_id: int, message_id: int, stage: str, now: float) -> float:
+        """Seconds between the stage and now, or -1 if the stage is unknown."""
+        trace = self._open.get((chat_id, message_id))
+        if trace is None or stage not in trace:
+            return -1
+        return now - trace[stage]
+
+    def get(self, chat_id: int, message_id: int) -> dict[str, float] | None:
+        return self._open.get((chat_id, message_id))
+
+    def discard(self, chat_id: int, message_id: int) -> None:
+        self._open.pop((chat_id, message_id), None)
+
+    def finish(self, chat_id: int, message_id: int) -> dict[str, float] | None:
+        trace = self._open.pop((chat_id, message_id), None)
+        if trace is not None:
+            self.finished.append(
+                {"chat_id": chat_id, "message_id": message_id, **trace}
+            )
+            _logger.debug(
+                "Trace of message %i in chat %i: %s", message_id, chat_id, trace
+            )
+        return trace
+
+
+class MetricsServer:
+    """Minimal HTTP server for /metrics (Prometheus) and /traces (JSON)."""
+
+    def __init__(self, registry: MetricsRegistry, tracer: Tracer, port: int):
+        self._registry = registry
+        self._tracer = tracer
+        self._port = port
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle, host="127.0.0.1", port=self._port
+        )
+        _logger.info("Serving metrics on port %i", self._port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1] if len(parts) > 1 else "/"
+            if path.startswith("/metrics"):
+                status, content_type = "200 OK", "text/plain; version=0.0.4"
+                body = self._registry.render()
+            elif path.startswith("/traces"):
+                status, content_type = "200 OK", "application/json"
+                body = json.dumps(list(self._tracer.finished))
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", ""
+            data = body.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode()
+                + data
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+registry = MetricsRegistry()
+tracer = Tracer()
+
+dispatch_latency = registry.histogram(
+    "scambaiter_dispatch_latency_seconds",
+    "Time from receipt by the telegram client until the agent handles a message",
+)
+debounce_wait = registry.histogram(
+    "scambaiter_debounce_wait_seconds",
+    "Time from the agent handling a message until the reply is generated",
+)
+llm_latency = registry.histogram(
+    "scambaiter_llm_latency_seconds",
+    "Duration of requests to the language model",
+    labels=("kind",),
+)
+llm_requests = registry.counter(
+    "scambaiter_llm_requests_total",
+    "Requests to the language model",
+    labels=("outcome",),
+)
+llm_tokens = registry.counter(
+    "scambaiter_llm_tokens_total",
+    "Tokens used by requests to the language model",
+    labels=("kind",),
+)
+llm_request_tokens = registry.histogram(
+    "scambaiter_llm_request_tokens",
+    "Prompt tokens per request to the language model",
+    buckets=(1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+)
+send_latency = registry.histogram(
+    "scambaiter_send_latency_seconds", "Duration of sending a telegram message"
+)
+outbound_depth = registry.gauge(
+    "scambaiter_outbound_queue_depth", "Telegram messages waiting to be sent"
+)
+outbound_messages = registry.counter(
+    "scambaiter_outbound_messages_total",
+    "Outgoing telegram messages (parts of replies) by outcome",
+    labels=("outcome",),
+)
+flood_wait_seconds = registry.counter(
+    "scambaiter_flood_wait_seconds_total",
+    "Seconds telegram asked to wait before sending again",
+)
+reply_latency = registry.histogram(
+    "scambaiter_reply_latency_seconds",
+    "Time from receipt of a message until the reply to it was sent",
+)
+ingress_depth = registry.gauge(
+    "scambaiter_ingress_queue_depth", "Messages waiting in the ingress buffer"
+)
+ingress_high_water_mark = registry.gauge(
+    "scambaiter_ingress_queue_high_water_mark",
+    "Highest number of messages in the ingress buffer",
+)
+ingress_dropped = registry.gauge(
+    "scambaiter_ingress_dropped_messages",
+    "Messages dropped or filtered by the ingress buffer",
+    labels=("reason",),
+)
+inbox_depth = registry.gauge(
+    "scambaiter_inbox_depth", "Messages waiting for an agent", labels=("chat",)
+)
+history_tokens = registry.gauge(
+    "scambaiter_history_tokens", "Tokens in the history of an agent", labels=("chat",)
+)
+prefilter_decisions = registry.counter(
+    "scambaiter_prefilter_decisions_total",
+    "Incoming messages by decision of the pre-filter (reply, batch, skip)",
+    labels=("decision",),
+)
+llm_calls_avoided = registry.counter(
+    "scambaiter_llm_calls_avoided_total",
+    "Model requests that replying after the response wait to every message "
+    "would have made, but the pre-filter avoided",
+)
+scheduled_deadlines = registry.gauge(
+    "scambaiter_scheduled_deadlines", "Pending reply and silence deadlines"
+)
+running_replies = registry.gauge(
+    "scambaiter_running_replies", "Replies being generated or waiting for a worker"
+)
@@ -1,8 +1,164 @@
-from collections.abc import Sequence
-from ai_scambaiter import GPTMessage
-from ai_scambaiter.chatgpt_interface import ChatGPTInterfaceImpl
+import asyncio
+import random
+from collections.abc import AsyncIterator, Sequence
+from ai_scambaiter import ChatGPTInterface, GPTMessage, TokenUsage
+from ai_scambaiter.chatgpt_interface import (
+    REPLY_TOKENS,
+    ChatGPTInterfaceImpl,
+    _to_openai_param,
+)
+from ai_scambaiter.history import ChatHistory
+from ai_scambaiter.recording import TrafficRecording, request_key
 
 
 class ChatGPTInterfaceMock(ChatGPTInterfaceImpl):
-    async def send_and_receive(self, messages: Sequence[GPTMessage]) -> str | None:
+    async def send_and_receive(
+        self,
+        messages: Sequence[GPTMessage],
+        usage: TokenUsage | None = None,
+        params: Sequence[object] | None = None,
+    ) -> str | None:
         return f"This is a sample reply to the message {messages[-1].content}."
+
+    async def stream_and_receive(
+        self,
+        messages: Sequence[GPTMessage],
+        usage: TokenUsage | None = None,
+        params: Sequence[object] | None = None,
+    ) -> AsyncIterator[str]:
+        reply = await self.send_and_receive(messages)
+        for word in reply.split(" "):
+            yield word + " "
+
+
+class LatencyChatGPTInterfaceMock(ChatGPTInterface):
+    """Offline stand-in for the model with realistic timing, for load tests.
+
+    The time to the first token is log-normal around latency seconds; the reply
+    then arrives at tokens_per_second. Tokens are estimated from the length of the
+    text, so no tokenizer needs to be downloaded."""
+
+    def __init__(
+        self,
+        latency: float = 1.0,
+        latency_sigma: float = 0.5,
+        tokens_per_second: float = 50.0,
+        reply_tokens: int = 40,
+        max_input_tokens: int = 120000,
+        max_concurrency: int | None = None,
+        seed: int = 1,
+    ):
+        self._latency = latency
+        self._latency_sigma = latency_sigma
+        self._tokens_per_second = tokens_per_second
+        self._reply_tokens = reply_tokens
+        self._max_input_tokens = max_input_tokens
+        self._semaphore = (
+            asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        )
+        self._rng = random.Random(seed)
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.prompt_tokens = 0
+
+    def number_of_tokens(self, text: str) -> int:
+        return len(text) // 4 + 1
+
+    def number_of_tokens_batch(self, texts: Sequence[str]) -> list[int]:
+        return [self.number_of_tokens(text) for text in texts]
+
+    def shorten_history(self, n_preamble_tokens: int, history: ChatHistory) -> None:
+        budget = self._max_input_tokens - n_preamble_tokens - REPLY_TOKENS
+        while history.n_tokens > budget and history:
+            history.pop_oldest()
+
+    def message_param(self, message: GPTMessage) -> object:
+        return _to_openai_param(message)
+
+    async def send_and_receive(
+        self,
+        messages: Sequence[GPTMessage],
+        usage: TokenUsage | None = None,
+        params: Sequence[object] | None = None,
+    ) -> str | None:
+        return "".join(
+            [piece async for piece in self.stream_and_receive(messages, usage, params)]
+        )
+
+    async def stream_and_receive(
+        self,
+        messages: Sequence[GPTMessage],
+        usage: TokenUsage | None = None,
+        params: Sequence[object] | None = None,
+    ) -> AsyncIterator[str]:
+        if self._semaphore is not None:
+            await self._semaphore.acquire()
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        n_prompt_tokens = sum(m.n_tokens for m in messages) + REPLY_TOKENS
+        self.prompt_tokens += n_prompt_tokens
+        try:
+            await asyncio.sleep(
+                self._rng.lognormvariate(0, self._latency_sigma) * self._latency
+            )
+            words = f"Reply to: {messages[-1].content}".split(" ")
+            words = (words * (self._reply_tokens // len(words) + 1))[
+                : self._reply_tokens
+            ]
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(1 / self._tokens_per_second)
+                yield word if i == len(words) - 1 else word + " "
+            if usage is not None:
+                usage.requests += 1
+                usage.prompt_tokens += n_prompt_tokens
+                usage.completion_tokens += len(words)
+        finally:
+            self.in_flight -= 1
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+
+class ReplayChatGPTInterfaceMock(ChatGPTInterfaceImpl):
+    """Answers with the replies of a recording, after the recorded duration
+    divided by speed. Token counting and shortening of the history are the real
+    ones, so their cost is part of a replay."""
+
+    def __init__(self, recording: TrafficRecording, speed: float = 1.0, **kwargs):
+        super().__init__(api_key="replay", **kwargs)
+        self._completions = recording.completions
+        self._speed = speed
+        self.requests = 0
+        self.misses = 0
+
+    async def send_and_receive(
+        self,
+        messages: Sequence[GPTMessage],
+        usage: TokenUsage | None = None,
+        params: Sequence[object] | None = None,
+    ) -> str | None:
+        self.requests += 1
+        recorded = self._completions.get(request_key(messages))
+        if recorded:
+            reply, duration = recorded.popleft()
+        else:
+            # The request differs from the recorded ones, e.g. because messages
+            # were grouped differently
+            self.misses += 1
+            reply, duration = "Again?", 1.0
+        await asyncio.sleep(duration / self._speed)
+        if usage is not None:
+            usage.requests += 1
+            usage.prompt_tokens += sum(m.n_tokens for m in messages)
+            usage.completion_tokens += self.number_of_tokens(reply)
+        return reply
+
+    async def stream_and_receive(
+        self,
+        messages: Sequence[GPTMessage],
+        usage: TokenUsage | None = None,
+        params: Sequence[object] | None = None,
+    ) -> AsyncIterator[str]:
+        yield await self.send_and_receive(messages, usage, params)
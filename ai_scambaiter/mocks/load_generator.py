@@ -0,0 +1,102 @@
+"""Synthetic traffic of many scam chats at once, for load tests."""
+
+from __future__ import annotations
+
+import asyncio
+import random
+import string
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Sequence
+
+_WORDS = (
+    "hello dear how are you today I am fine thank you my friend investment bitcoin "
+    "platform profit trust me please send wallet address account bank transfer "
+    "opportunity mining trading binary options withdraw fee tax urgent honey love "
+    "beautiful weather Singapore Dubai uncle business gold return guaranteed"
+).split()
+
+
+@dataclass
+class LoadProfile:
+    """Traffic of one chat. Messages arrive at random (Poisson) times; some of
+    them start a burst of further messages in quick succession."""
+
+    # Average number of messages per chat and minute, bursts not included
+    messages_per_minute: float = 2.0
+    # Probability that a message is followed by a burst, and its size
+    burst_probability: float = 0.1
+    burst_size: int = 5
+    # Seconds between the messages of a burst
+    burst_interval: float = 0.5
+    # Message lengths in characters are log-normal around this median
+    median_length: int = 60
+    length_sigma: float = 1.0
+    max_length: int = 4000
+
+
+class LoadGenerator:
+    """Sends messages from the scammers of many chats concurrently.
+
+    deliver is called with chat id and text for every message, e.g.
+    ScaledTelegramInterfaceMock.receive_from_scammer."""
+
+    def __init__(
+        self,
+        deliver: Callable[[int, str], Awaitable[None]],
+        chat_ids: Sequence[int],
+        profile: LoadProfile | None = None,
+        seed: int = 1,
+    ):
+        self._deliver = deliver
+        self._chat_ids = list(chat_ids)
+        self._profile = profile or LoadProfile()
+        self._rng = random.Random(seed)
+        self.sent = 0
+        self.bursts = 0
+
+    async def run(self, duration: float) -> None:
+        """Generates messages in all chats for duration seconds."""
+        deadline = time.monotonic() + duration
+        await asyncio.gather(
+            *(self._run_chat(chat_id, deadline) for chat_id in self._chat_ids)
+        )
+
+    async def _run_chat(self, chat_id: int, deadline: float) -> None:
+        profile = self._profile
+        rate = profile.messages_per_minute / 60
+        if rate <= 0:
+            return
+        while True:
+            delay = self._rng.expovariate(rate)
+            if time.monotonic() + delay >= deadline:
+                return
+            await asyncio.sleep(delay)
+            await self._send(chat_id)
+            if self._rng.random() < profile.burst_probability:
+                self.bursts += 1
+                for _ in range(profile.burst_size):
+                    await asyncio.sleep(profile.burst_interval)
+                    if time.monotonic() >= deadline:
+                        return
+                    await self._send(chat_id)
+
+    async def _send(self, chat_id: int) -> None:
+        self.sent += 1
+        await self._deliver(chat_id, self._text())
+
+    def _text(self) -> str:
+        profile = self._profile
+        length = int(
+            self._rng.lognormvariate(0, profile.length_sigma) * profile.median_length
+        )
+        length = max(1, min(profile.max_length, length))
+        words: list[str] = []
+        n_chars = 0
+        while n_chars < length:
+            word = self._rng.choice(_WORDS)
+            if self._rng.random() < 0.05:
+                word = "".join(self._rng.choices(string.ascii_lowercase, k=8))
+            words.append(word)
+            n_chars += len(word) + 1
+        return " ".join(words)[:length]
@@ -0,0 +1,306 @@
+"""Local stand-in for the chat completions endpoint of the OpenAI API.
+
+Serves POST /v1/chat/completions with and without streaming, with configurable
+latency, server errors and rate limits, so the real client path (connection
+pool, timeouts, retries) can be tested without network access. Point the bot at
+it with base_url in the [chatgpt] section, e.g. http://127.0.0.1:8089/v1
+
+Usage: python -m ai_scambaiter.mocks.openai_stub --port 8089 --rate-limit-rate 0.05
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+
+_logger = logging.getLogger("OpenAIStub")
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+}
+
+
+@dataclass
+class StubSettings:
+    # Time to the first token, log-normal around latency seconds
+    latency: float = 0.5
+    latency_sigma: float = 0.5
+    # Speed at which the reply is generated after the first token
+    tokens_per_second: float = 100.0
+    reply_tokens: int = 40
+    # Fraction of requests answered with 500 or 429 (with retry-after)
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after: float = 1.0
+    # Reported at the end of each reply, e.g. length for one that is cut off
+    finish_reason: str = "stop"
+    seed: int = 1
+
+
+@dataclass
+class StubStats:
+    connections: int = 0
+    requests: int = 0
+    streamed: int = 0
+    errors: int = 0
+    rate_limited: int = 0
+    status: dict[int, int] = field(default_factory=dict)
+
+
+class OpenAIStubServer:
+    def __init__(
+        self,
+        settings: StubSettings | None = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.settings = settings or StubSettings()
+        self.stats = StubStats()
+        self._host = host
+        self._port = port
+        self._rng = random.Random(self.settings.seed)
+        self._ids = itertools.count(1)
+        self._server: asyncio.AbstractServer | None = None
+        # Open connections and the tasks serving them
+        self._connections: dict[asyncio.StreamWriter, asyncio.Task] = {}
+
+    @property
+    def port(self) -> int:
+        """The port the server listens on (chosen by the OS if 0 was given)."""
+        if self._server is None:
+            return self._port
+        return self._server.sockets[0].getsockname()[1]
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self._host}:{self.port}/v1"
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle_connection, host=self._host, port=self._port
+        )
+        _logger.info("OpenAI stub listening on %s", self.base_url)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            # Idle keep-alive connections would otherwise stay open
+            for writer in self._connections:
+                writer.close()
+            await asyncio.gather(*self._connections.values(), return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Serves requests on one keep-alive connection until the client closes it."""
+        self.stats.connections += 1
+        self._connections[writer] = asyncio.current_task()  # type: ignore
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                headers: dict[str, str] = {}
+                while (line := await reader.readline()).strip():
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                parts = request_line.decode("latin-1").split()
+                path = parts[1] if len(parts) > 1 else "/"
+                await self._handle_request(path, body, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _handle_request(
+        self, path: str, body: bytes, writer: asyncio.StreamWriter
+    ) -> None:
+        self.stats.requests += 1
+        if not path.rstrip("/").endswith("/chat/completions"):
+            await self._send_error(writer, 404, "not_found", "Unknown path")
+            return
+        try:
+            request = json.loads(body)
+            messages = request["messages"]
+        except (ValueError, KeyError):
+            await self._send_error(writer, 400, "invalid_request_error", "Bad request")
+            return
+        settings = self.settings
+        draw = self._rng.random()
+        if draw < settings.rate_limit_rate:
+            self.stats.rate_limited += 1
+            await self._send_error(
+                writer,
+                429,
+                "rate_limit_exceeded",
+                "Rate limit reached",
+                {"retry-after": f"{settings.retry_after:g}"},
+            )
+            return
+        await asyncio.sleep(
+            self._rng.lognormvariate(0, settings.latency_sigma) * settings.latency
+        )
+        if draw < settings.rate_limit_rate + settings.error_rate:
+            self.stats.errors += 1
+            await self._send_error(writer, 500, "server_error", "Injected error")
+            return
+        n_prompt_tokens = sum(len(str(m.get("content", ""))) // 4 + 5 for m in messages)
+        last = str(messages[-1].get("content", "")) if messages else ""
+        words = f"Reply to: {last}".split()
+        words = (words * (settings.reply_tokens // max(1, len(words)) + 1))[
+            : settings.reply_tokens
+        ]
+        usage = {
+            "prompt_tokens": n_prompt_tokens,
+            "completion_tokens": len(words),
+            "total_tokens": n_prompt_tokens + len(words),
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        completion_id = f"chatcmpl-stub{next(self._ids)}"
+        model = request.get("model", "stub")
+        if request.get("stream"):
+            self.stats.streamed += 1
+            include_usage = (request.get("stream_options") or {}).get("include_usage")
+            await self._stream(
+                writer, completion_id, model, words, usage if include_usage else None
+            )
+            return
+        await asyncio.sleep(len(words) / settings.tokens_per_second)
+        await self._send_json(
+            writer,
+            200,
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": settings.finish_reason,
+                        "message": {"role": "assistant", "content": " ".join(words)},
+                    }
+                ],
+                "usage": usage,
+            },
+        )
+
+    async def _stream(
+        self,
+        writer: asyncio.StreamWriter,
+        completion_id: str,
+        model: str,
+        words: list[str],
+        usage: dict | None,
+    ) -> None:
+        """Sends the reply as server-sent events in a chunked response."""
+        self._count_status(200)
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+
+        def chunk(choices: list, usage: dict | None = None) -> dict:
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices,
+                "usage": usage,
+            }
+
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(1 / self.settings.tokens_per_second)
+            delta = {"content": word if i == 0 else " " + word}
+            if i == 0:
+                delta["role"] = "assistant"
+            await self._send_event(
+                writer, chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+            )
+        end = {"index": 0, "delta": {}, "finish_reason": self.settings.finish_reason}
+        await self._send_event(writer, chunk([end]))
+        if usage is not None:
+            await self._send_event(writer, chunk([], usage))
+        await self._send_chunk(writer, b"data: [DONE]\n\n")
+        await self._send_chunk(writer, b"")
+
+    async def _send_event(self, writer: asyncio.StreamWriter, data: dict) -> None:
+        await self._send_chunk(writer, b"data: " + json.dumps(data).encode() + b"\n\n")
+
+    async def _send_chunk(self, writer: asyncio.StreamWriter, data: bytes) -> None:
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        await writer.drain()
+
+    async def _send_error(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        code: str,
+        message: str,
+        headers: dict[str, str] | None = None,
+    ) -> None:
+        error = {"error": {"message": message, "type": code, "code": code}}
+        await self._send_json(writer, status, error, headers)
+
+    async def _send_json(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        data: dict,
+        headers: dict[str, str] | None = None,
+    ) -> None:
+        self._count_status(status)
+        body = json.dumps(data).encode()
+        head = (
+            f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+        )
+        for name, value in (headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        writer.write(head.encode() + b"\r\n" + body)
+        await writer.drain()
+
+    def _count_status(self, status: int) -> None:
+        self.stats.status[status] = self.stats.status.get(status, 0) + 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    defaults = StubSettings()
+    for name, value in vars(defaults).items():
+        parser.add_argument(
+            "--" + name.replace("_", "-"), type=type(value), default=value
+        )
+    args = parser.parse_args()
+    settings = StubSettings(**{k: getattr(args, k) for k in vars(defaults)})
+    logging.basicConfig(level=logging.INFO)
+
+    async def serve() -> None:
+        server = OpenAIStubServer(settings, args.host, args.port)
+        await server.start()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
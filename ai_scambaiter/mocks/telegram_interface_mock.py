@@ -1,11 +1,23 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import itertools
 import logging
+import time
+from collections.abc import Collection
+from types import SimpleNamespace
+from typing import AsyncIterator
 from unittest.mock import Mock
 
+from telethon import events
 from telethon.hints import TotalList
 from telethon.tl.custom import Message
+from telethon.tl.types import PeerUser
 
+from .. import TelegramInterface, metrics
+from ..ingress import IngressBuffer
+from ..recording import RecordedMessage, TrafficRecording
 from ..telegram_interface import TelegramInterfaceImpl
 
 _logger = logging.getLogger("Telegram")
@@ -17,7 +29,11 @@ class TelegramInterfaceMock(TelegramInterfaceImpl):
         self.chat = Mock(id=1234567)
 
     async def get_messages(
-        self, chat_id: int, number_of_messages: int = 100, oldest_first: bool = True
+        self,
+        chat_id: int,
+        number_of_messages: int = 100,
+        oldest_first: bool = True,
+        min_id: int = 0,
     ) -> TotalList:
         def make_message(i):
             m = Message(i + 100)
@@ -25,10 +41,182 @@ class TelegramInterfaceMock(TelegramInterfaceImpl):
             m._sender_id = 111 if (i % 2) == 0 else 222
             return m
 
-        return TotalList(make_message(i) for i in range(10))
+        return TotalList(make_message(i) for i in range(10) if i + 100 > min_id)
 
-    async def send_message(self, chat_id: int, message: str):
+    async def send_message(self, chat_id: int, message: str, replace: bool = False):
         print("Send message: " + message)
 
+    def typing(self, chat_id: int):
+        return contextlib.nullcontext()
+
     async def delete_last_message(self, chat_id: int):
         print("Delete last message")
+
+
+class ScaledTelegramInterfaceMock(TelegramInterface):
+    """Offline telegram interface with any number of dialogs, for load tests.
+
+    Every dialog starts with history_length canned messages. Sent messages are
+    delivered back through the message stream after send_latency seconds, like
+    telegram does with outgoing messages."""
+
+    def __init__(
+        self,
+        n_dialogs: int,
+        own_id: int,
+        history_length: int = 20,
+        send_latency: float = 0.0,
+        ingress_size: int = 1000,
+        ingress_policy: str = "drop_unmonitored",
+        first_chat_id: int = 10_000_000,
+    ):
+        self._own_id = own_id
+        self._history_length = history_length
+        self._send_latency = send_latency
+        self._chat_ids = list(range(first_chat_id, first_chat_id + n_dialogs))
+        self._dialogs: dict[int, object] = {}
+        self._messages: dict[int, list[Message]] = {}
+        self._message_ids = itertools.count(1)
+        self.queue = IngressBuffer(maxsize=ingress_size, policy=ingress_policy)
+        self.received = 0
+        self.sent = 0
+
+    @property
+    def chat_ids(self) -> list[int]:
+        return self._chat_ids
+
+    async def start(self) -> None:
+        for i, chat_id in enumerate(self._chat_ids):
+            self._dialogs[chat_id] = SimpleNamespace(id=chat_id, title=f"Scammer {i}")
+            self._messages[chat_id] = [
+                self._make_message(
+                    chat_id,
+                    self._own_id if j % 2 else chat_id,
+                    f"Message {j} in chat {i}",
+                )
+                for j in range(self._history_length)
+            ]
+        _logger.debug("Started telegram interface with %i chats", len(self._dialogs))
+
+    @property
+    def dialogs(self) -> dict[int, object]:
+        return self._dialogs
+
+    async def get_messages(
+        self,
+        chat_id: int,
+        number_of_messages: int = 100,
+        oldest_first: bool = False,
+        min_id: int = 0,
+    ) -> TotalList:
+        messages = [m for m in self._messages[chat_id] if m.id > min_id]
+        messages = messages[-number_of_messages:]
+        return TotalList(messages if oldest_first else reversed(messages))
+
+    async def send_message(
+        self, chat_id: int, message: str, replace: bool = False
+    ) -> None:
+        t_start = time.monotonic()
+        if self._send_latency:
+            await asyncio.sleep(self._send_latency)
+        metrics.send_latency.observe(time.monotonic() - t_start)
+        self.sent += 1
+        await self._deliver(self._make_message(chat_id, self._own_id, message))
+
+    def typing(self, chat_id: int):
+        return contextlib.nullcontext()
+
+    async def delete_last_message(self, chat_id: int) -> None:
+        messages = self._messages[chat_id]
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i].sender_id == self._own_id:
+                del messages[i]
+                return
+
+    def set_monitored_chats(self, chat_ids: Collection[int] | None) -> None:
+        self.queue.set_monitored_chats(chat_ids)
+
+    async def message_stream(self) -> AsyncIterator[Message]:
+        while True:
+            yield await self.queue.get()
+
+    async def receive_from_scammer(self, chat_id: int, text: str) -> None:
+        """A new message from the other side of the chat."""
+        self.received += 1
+        await self._deliver(self._make_message(chat_id, chat_id, text))
+
+    async def _deliver(self, message: Message) -> None:
+        self._messages[message.chat_id].append(message)
+        event = events.NewMessage()
+        event.message = message
+        await self._on_new_message(event)
+
+    async def _on_new_message(self, event) -> None:
+        message = event.message
+        # Messages of other chats must not fill the tracer
+        if self.queue.may_be_monitored(message.chat_id):
+            metrics.tracer.mark(message.chat_id, message.id, "received")
+        await self.queue.put(message)
+
+    def _make_message(
+        self,
+        chat_id: int,
+        sender_id: int | None,
+        text: str | None,
+        message_id: int | None = None,
+    ) -> Message:
+        m = Message(
+            message_id if message_id is not None else next(self._message_ids),
+            peer_id=PeerUser(chat_id),
+            from_id=PeerUser(sender_id) if sender_id is not None else None,
+        )
+        m.text = text
+        return m
+
+
+class ReplayTelegramInterfaceMock(ScaledTelegramInterfaceMock):
+    """Telegram interface with the dialogs and histories of a recording. The
+    recorded messages are fed in with receive_recorded."""
+
+    def __init__(
+        self,
+        recording: TrafficRecording,
+        own_id: int,
+        send_latency: float = 0.0,
+        ingress_size: int = 1000,
+        ingress_policy: str = "drop_unmonitored",
+    ):
+        super().__init__(
+            0,
+            own_id,
+            send_latency=send_latency,
+            ingress_size=ingress_size,
+            ingress_policy=ingress_policy,
+        )
+        self._recording = recording
+        chat_ids = {*recording.dialogs, *recording.histories}
+        chat_ids.update(m.chat_id for m in recording.messages)
+        self._chat_ids = sorted(chat_ids)
+        # Ids of sent messages must not collide with recorded ones
+        ids = [m.id for m in recording.messages]
+        ids.extend(m.id for h in recording.histories.values() for m in h)
+        self._message_ids = itertools.count(max(ids, default=0) + 1)
+
+    async def start(self) -> None:
+        for chat_id in self._chat_ids:
+            title = self._recording.dialogs.get(chat_id) or str(chat_id)
+            self._dialogs[chat_id] = SimpleNamespace(id=chat_id, title=title)
+            history = self._recording.histories.get(chat_id, [])
+            self._messages[chat_id] = [
+                self._make_message(chat_id, m.sender_id, m.text, m.id)
+                for m in reversed(history)
+            ]
+        _logger.debug("Started telegram interface with %i chats", len(self._dialogs))
+
+    async def receive_recorded(self, message: RecordedMessage) -> None:
+        self.received += 1
+        await self._deliver(
+            self._make_message(
+                message.chat_id, message.sender_id, message.text, message.id
+            )
+        )
@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from telethon import errors
+
+from . import metrics
+from .rate_limit import TokenBucket, backoff_delay
+
+if TYPE_CHECKING:
+    from typing import AsyncContextManager
+
+_logger = logging.getLogger("Telegram")
+
+# Longest message telegram accepts
+MAX_MESSAGE_LENGTH = 4096
+DEFAULT_SEND_RATE = 5.0
+DEFAULT_CHAT_SEND_INTERVAL = 1.0
+DEFAULT_SEND_RETRIES = 5
+
+# Where a long message is best split, in order of preference
+_SPLIT_POINTS = (re.compile(r"\n"), re.compile(r"[.!?…]\s"), re.compile(r"\s"))
+
+# Errors after which sending again may succeed
+_TRANSIENT_ERRORS = (
+    ConnectionError,
+    OSError,
+    asyncio.TimeoutError,
+    errors.ServerError,
+    errors.RpcCallFailError,
+)
+
+
+def split_message(text: str, max_length: int) -> list[str]:
+    """Splits text into parts of at most max_length characters, at line breaks,
+    sentence ends or spaces if possible."""
+    parts: list[str] = []
+    text = text.strip()
+    while len(text) > max_length:
+        cut = max_length
+        for pattern in _SPLIT_POINTS:
+            ends = [m.end() for m in pattern.finditer(text, 0, max_length)]
+            # Parts should not get too short
+            ends = [end for end in ends if end >= max_length // 4]
+            if ends:
+                cut = ends[-1]
+                break
+        parts.append(text[:cut].strip())
+        text = text[cut:].strip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+@dataclass(slots=True)
+class _Outbound:
+    text: str
+    # Seconds to wait (with typing indicator) before sending, for human pacing
+    pause: float
+    # Resolved when the last part of the message is sent
+    future: asyncio.Future[bool]
+    first: bool
+    last: bool
+    # Sent with replace, so a newer reply may drop it
+    replaceable: bool
+    attempt: int = 0
+    # Being sent, so it can no longer be replaced
+    sending: bool = False
+
+
+class OutboundQueue:
+    """Sends the outgoing messages of all chats.
+
+    Messages are sent in order per chat, at most one per chat_interval seconds in
+    a chat and send_rate per second for the account. A FloodWait pauses all
+    sending for the requested time, a slow mode wait the chat; transient errors
+    are retried with backoff. A reply (sent with replace) drops the replies of
+    its chat which are not sent yet, so an outdated reply is not sent after a
+    newer one. Other messages, e.g. from the operator, and replies which are
+    partly sent already are never dropped."""
+
+    def __init__(
+        self,
+        send: Callable[[int, str], Awaitable[None]],
+        typing: Callable[[int], AsyncContextManager[object]] | None = None,
+        send_rate: str | None = None,
+        chat_interval: str | None = None,
+        max_retries: str | None = None,
+        split_length: str | None = None,
+        typing_speed: str | None = None,
+    ):
+        self._send = send
+        self._typing = typing
+        rate = float(send_rate or DEFAULT_SEND_RATE)
+        self._account_budget = TokenBucket(max(1.0, rate), rate)
+        self._chat_interval = float(
+            chat_interval if chat_interval is not None else DEFAULT_CHAT_SEND_INTERVAL
+        )
+        self._max_retries = int(
+            max_retries if max_retries is not None else DEFAULT_SEND_RETRIES
+        )
+        self._split_length = min(
+            MAX_MESSAGE_LENGTH, int(split_length or MAX_MESSAGE_LENGTH)
+        )
+        # Characters per second, 0 sends the parts of a message at once
+        self._typing_speed = float(typing_speed or 0)
+        self._queues: dict[int, deque[_Outbound]] = {}
+        self._senders: dict[int, asyncio.Task[None]] = {}
+        # Monotonic time before which nothing may be sent, per chat and overall
+        self._chat_ready: dict[int, float] = {}
+        self._paused_until = 0.0
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def send(self, chat_id: int, text: str, replace: bool = False) -> bool:
+        """Sends text, split into parts if it is long. Returns once it is sent,
+        or False if a newer reply replaced it before. replace marks the text as
+        a reply, which drops the older replies of the chat not sent yet."""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(chat_id, deque())
+        if replace:
+            self._drop(queue)
+        parts = split_message(text, self._split_length)
+        for i, part in enumerate(parts):
+            pause = len(part) / self._typing_speed if i and self._typing_speed else 0
+            queue.append(
+                _Outbound(
+                    part,
+                    pause,
+                    future,
+                    first=i == 0,
+                    last=i == len(parts) - 1,
+                    replaceable=replace,
+                )
+            )
+        if not parts:
+            future.set_result(True)
+        sender = self._senders.get(chat_id)
+        if sender is None or sender.done():
+            self._senders[chat_id] = asyncio.create_task(self._run(chat_id, queue))
+        return await future
+
+    def _drop(self, queue: deque[_Outbound]) -> None:
+        """Drops the replies which are not sent yet."""
+        # Once a part of a message is sent or being sent, the rest follows
+        head = queue[0] if queue else None
+        started = head.future if head and (head.sending or not head.first) else None
+        kept: list[_Outbound] = []
+        for message in queue:
+            if not message.replaceable or message.future is started:
+                kept.append(message)
+            elif not message.future.done():
+                message.future.set_result(False)
+                metrics.outbound_messages.inc(outcome="superseded")
+        queue.clear()
+        queue.extend(kept)
+
+    async def _run(self, chat_id: int, queue: deque[_Outbound]) -> None:
+        """Sends the messages of a chat until its queue is empty."""
+        while queue:
+            message = queue[0]
+            if message.pause:
+                await self._pause(chat_id, message.pause)
+            await self._wait_turn(chat_id)
+            if not queue or queue[0] is not message:
+                # Replaced meanwhile
+                continue
+            message.sending = True
+            error: Exception | None = None
+            try:
+                await self._send(chat_id, message.text)
+            except Exception as e:
+                error = e
+            message.sending = False
+            self._chat_ready[chat_id] = time.monotonic() + self._chat_interval
+            if error is not None:
+                if not self._handle_error(chat_id, message, error):
+                    queue.popleft()
+                    # The remaining parts of the message are not sent either
+                    while queue and queue[0].future is message.future:
+                        queue.popleft()
+                    if not message.future.done():
+                        message.future.set_exception(error)
+                    metrics.outbound_messages.inc(outcome="failed")
+                continue
+            queue.popleft()
+            metrics.outbound_messages.inc(outcome="sent")
+            if message.last and not message.future.done():
+                message.future.set_result(True)
+        del self._senders[chat_id]
+        if self._queues.get(chat_id) is queue:
+            del self._queues[chat_id]
+
+    def _handle_error(self, chat_id: int, message: _Outbound, error: Exception) -> bool:
+        """Delays the next attempt, returns False if the message is given up."""
+        now = time.monotonic()
+        if isinstance(error, errors.FloodWaitError):
+            _logger.warning("Flood wait of %is, pausing all sends", error.seconds)
+            metrics.flood_wait_seconds.inc(error.seconds)
+            self._paused_until = max(self._paused_until, now + error.seconds)
+            return True
+        if isinstance(error, errors.SlowModeWaitError):
+            _logger.warning("Slow mode in %i, waiting %is", chat_id, error.seconds)
+            self._chat_ready[chat_id] = max(
+                self._chat_ready.get(chat_id, 0.0), now + error.seconds
+            )
+            return True
+        if isinstance(error, _TRANSIENT_ERRORS) and message.attempt < self._max_retries:
+            delay = backoff_delay(message.attempt)
+            message.attempt += 1
+            _logger.warning(
+                "Error sending to %i, retrying in %.1fs: %s", chat_id, delay, error
+            )
+            metrics.outbound_messages.inc(outcome="retried")
+            self._chat_ready[chat_id] = now + delay
+            return True
+        _logger.error("Giving up sending to %i: %s", chat_id, error)
+        return False
+
+    async def _pause(self, chat_id: int, seconds: float) -> None:
+        """Waits like a human typing the message."""
+        if self._typing is None:
+            await asyncio.sleep(seconds)
+            return
+        try:
+            async with self._typing(chat_id):
+                await asyncio.sleep(seconds)
+        except Exception as e:
+            _logger.debug("Could not show typing in %i: %s", chat_id, e)
+
+    async def _wait_turn(self, chat_id: int) -> None:
+        while True:
+            ready = max(self._paused_until, self._chat_ready.get(chat_id, 0.0))
+            delay = ready - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        await self._account_budget.acquire(1)
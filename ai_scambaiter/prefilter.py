@@ -0,0 +1,210 @@
+"""Local decision whether an incoming message needs a reply, so that messages
+like "ok", emoji or repeated forwards do not each cost a model request.
+
+Rules catch the obvious cases (a message repeated within a short burst,
+acknowledgements). The rest is scored by a small logistic model over a few
+features of the text. Its default weights are below; other weights can be
+loaded from a JSON file {"bias": b, "weights": {feature: w}}. Nothing is sent
+over the network."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import math
+import re
+import time
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+
+from . import metrics
+from .settings import from_section
+
+_logger = logging.getLogger("Prefilter")
+
+
+class Decision(Enum):
+    # Reply after the usual response wait
+    REPLY = "reply"
+    # Answer together with the next message, or after the batch wait
+    BATCH = "batch"
+    # Keep in the history, but do not reply
+    SKIP = "skip"
+
+
+# Per chat: off (always reply), normal, or strict (also skip acknowledgements
+# and messages the model scores below skip_threshold)
+CHAT_MODES = ("off", "normal", "strict")
+
+# Texts of the last messages per chat, to recognize repeated forwards
+RECENT_MESSAGES = 20
+
+_WORD = re.compile(r"\w+")
+_URL = re.compile(r"https?://|www\.|t\.me/", re.IGNORECASE)
+_DIGITS = re.compile(r"\d{3,}")
+# Nothing but emoji, punctuation and spaces
+_NO_WORDS = re.compile(r"^[\W_]+$")
+_ACKNOWLEDGEMENTS = frozenset(
+    "ok okay okey k kk fine good great nice cool yes yeah yep yup no nope sure "
+    "thanks thank thx ty alright right hmm hm lol haha hahaha ah oh wow".split()
+)
+_QUESTION_WORDS = frozenset(
+    "who what when where why how which can could do does did are is will would "
+    "should may have has".split()
+)
+_GREETINGS = frozenset("hi hello hey dear morning evening".split())
+_MONEY_WORDS = frozenset(
+    "money pay send bank account transfer bitcoin btc usdt crypto wallet invest "
+    "investment profit card fee dollar dollars euro usd eur gift".split()
+)
+
+DEFAULT_BIAS = -0.5
+DEFAULT_WEIGHTS = {
+    "question": 2.5,
+    "greeting": 1.2,
+    "money": 1.5,
+    "url": 1.0,
+    "digits": 0.8,
+    # log2 of the number of words
+    "length": 0.6,
+    "acknowledgement": -2.0,
+    "no_words": -1.5,
+}
+
+
+@dataclass
+class PrefilterSettings:
+    """Options of the pre-filter, read from the [prefilter] section."""
+
+    enabled: bool = False
+    # Mode of chats without an entry in chat_modes
+    mode: str = "normal"
+    # One "chat id or title: mode" per line
+    chat_modes: str = ""
+    # Model scores from which a message is answered right away, and below which
+    # it is skipped in strict mode
+    reply_threshold: float = 0.5
+    skip_threshold: float = 0.1
+    # Seconds after which batched messages are answered if nothing follows
+    batch_wait: float = 120.0
+    # JSON file with the weights of the model, empty for the defaults
+    model: str = ""
+    # Seconds within which the same text again is skipped as a repeat. Only
+    # bursts: a follow-up like "Are you there?" later on must be answered
+    repeat_window: float = 60.0
+
+    @classmethod
+    def from_config(cls, section: dict[str, str] | None) -> PrefilterSettings:
+        return from_section(cls, section)
+
+
+def features(text: str) -> dict[str, float]:
+    """Features of the text for the model."""
+    words = [w.lower() for w in _WORD.findall(text)]
+    word_set = set(words)
+    return {
+        "question": float("?" in text or bool(words and words[0] in _QUESTION_WORDS)),
+        "greeting": float(bool(word_set & _GREETINGS)),
+        "money": float(bool(word_set & _MONEY_WORDS) or "$" in text or "€" in text),
+        "url": float(bool(_URL.search(text))),
+        "digits": float(bool(_DIGITS.search(text))),
+        "length": math.log2(1 + len(words)),
+        "acknowledgement": float(bool(words) and word_set <= _ACKNOWLEDGEMENTS),
+        "no_words": float(bool(_NO_WORDS.match(text))),
+    }
+
+
+class ReplyModel:
+    """Logistic model of the probability that a message needs a reply."""
+
+    def __init__(self, bias: float = DEFAULT_BIAS, weights: dict | None = None):
+        self.bias = bias
+        self.weights: dict[str, float] = dict(weights or DEFAULT_WEIGHTS)
+
+    @classmethod
+    def load(cls, path: str) -> ReplyModel:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(float(data.get("bias", DEFAULT_BIAS)), data["weights"])
+
+    def score(self, text: str) -> float:
+        z = self.bias + sum(
+            self.weights.get(name, 0.0) * value
+            for name, value in features(text).items()
+        )
+        return 1 / (1 + math.exp(-z))
+
+
+class Prefilter:
+    """Decides per incoming message whether it needs a reply now (REPLY), can
+    wait for the next message (BATCH) or needs none (SKIP)."""
+
+    def __init__(self, settings: PrefilterSettings | None = None):
+        self.settings = settings or PrefilterSettings()
+        if self.settings.mode not in CHAT_MODES:
+            raise ValueError(f"Unknown prefilter mode {self.settings.mode}")
+        self._chat_modes: dict[str, str] = {}
+        for line in self.settings.chat_modes.strip().splitlines():
+            chat, _, mode = line.rpartition(":")
+            mode = mode.strip()
+            if mode not in CHAT_MODES:
+                raise ValueError(f"Unknown prefilter mode {mode} for {chat}")
+            self._chat_modes[chat.strip()] = mode
+        self._model = (
+            ReplyModel.load(self.settings.model)
+            if self.settings.model
+            else ReplyModel()
+        )
+        # Per chat: (hash of the text, monotonic time) of the recent messages
+        self._recent: dict[int, deque[tuple[bytes, float]]] = {}
+
+    def mode(self, chat_id: int, title: str | None = None) -> str:
+        if not self.settings.enabled:
+            return "off"
+        mode = self._chat_modes.get(str(chat_id))
+        if mode is None and title is not None:
+            mode = self._chat_modes.get(title)
+        return mode or self.settings.mode
+
+    def classify(
+        self, chat_id: int, text: str | None, title: str | None = None
+    ) -> Decision:
+        decision = self._classify(chat_id, text, self.mode(chat_id, title))
+        metrics.prefilter_decisions.inc(decision=decision.value)
+        _logger.debug("%s for message in %i: %s", decision.name, chat_id, text)
+        return decision
+
+    def _classify(self, chat_id: int, text: str | None, mode: str) -> Decision:
+        if mode == "off":
+            return Decision.REPLY
+        text = (text or "").strip()
+        if not text:
+            # Media like a photo of the scammer is answered like any message,
+            # there is no text to judge it by
+            return Decision.REPLY
+        if self._is_repeated(chat_id, text):
+            return Decision.SKIP
+        values = features(text)
+        if values["acknowledgement"] or values["no_words"]:
+            return Decision.SKIP if mode == "strict" else Decision.BATCH
+        score = self._model.score(text)
+        if score >= self.settings.reply_threshold:
+            return Decision.REPLY
+        if mode == "strict" and score < self.settings.skip_threshold:
+            return Decision.SKIP
+        return Decision.BATCH
+
+    def _is_repeated(self, chat_id: int, text: str) -> bool:
+        """Whether the same text arrived in the chat within the repeat window."""
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+        now = time.monotonic()
+        recent = self._recent.get(chat_id)
+        if recent is None:
+            recent = self._recent[chat_id] = deque(maxlen=RECENT_MESSAGES)
+        while recent and now - recent[0][1] > self.settings.repeat_window:
+            recent.popleft()
+        repeated = any(k == key for k, _ in recent)
+        recent.append((key, now))
+        return repeated
@@ -0,0 +1,290 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+_logger = logging.getLogger("RateLimit")
+
+# Seconds before a worker tries again to reach an unreachable rate limit server
+RECONNECT_INTERVAL = 5.0
+
+
+class TokenBucket:
+    """Token bucket which refills continuously up to its capacity.
+
+    Waiters are served in order, so a large request cannot be starved by a stream
+    of small ones."""
+
+    def __init__(self, capacity: float, per_second: float):
+        self._capacity = capacity
+        self._per_second = per_second
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @property
+    def level(self) -> float:
+        self._refill()
+        return self._level
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(
+            self._capacity, self._level + (now - self._updated) * self._per_second
+        )
+        self._updated = now
+
+    async def acquire(self, amount: float) -> None:
+        # A request larger than the bucket can never fit, let it through when full
+        amount = min(amount, self._capacity)
+        async with self._lock:
+            self._refill()
+            while self._level < amount:
+                await asyncio.sleep((amount - self._level) / self._per_second)
+                self._refill()
+            self._level -= amount
+
+    def adjust(self, amount: float) -> None:
+        """Returns (positive) or takes (negative) tokens after the fact, e.g. when
+        the actual usage differs from the estimate. The level may become negative."""
+        self._refill()
+        self._level = min(self._capacity, self._level + amount)
+
+
+class RateLimiter:
+    """Shared request and token budget for all requests to the API, plus a cap on
+    the number of concurrent requests."""
+
+    def __init__(
+        self, requests_per_minute: int, tokens_per_minute: int, max_concurrency: int
+    ):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+        self._concurrency = asyncio.Semaphore(max_concurrency)
+
+    @asynccontextmanager
+    async def reserve(self, n_tokens: int) -> AsyncIterator[None]:
+        """Waits until a request with about n_tokens tokens may be sent."""
+        async with self._concurrency:
+            await self.requests.acquire(1)
+            await self.tokens.acquire(n_tokens)
+            yield
+
+    def adjust_tokens(self, amount: float) -> None:
+        """Corrects the token budget once the actual usage is known."""
+        self.tokens.adjust(amount)
+
+
+class RemoteRateLimiter(RateLimiter):
+    """Rate limiter whose request and token budget is kept by a RateLimitServer
+    at address (host:port), so several processes share one budget. The cap on
+    concurrent requests stays per process. While the server cannot be reached,
+    the local budget is used."""
+
+    def __init__(
+        self,
+        address: str,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+        max_concurrency: int,
+    ):
+        super().__init__(requests_per_minute, tokens_per_minute, max_concurrency)
+        host, _, port = address.rpartition(":")
+        self._host = host or "127.0.0.1"
+        self._port = int(port)
+        self._writer: asyncio.StreamWriter | None = None
+        self._reader_task: asyncio.Task[None] | None = None
+        self._connect_lock = asyncio.Lock()
+        self._last_attempt = -RECONNECT_INTERVAL
+        self._ids = itertools.count()
+        self._waiters: dict[int, asyncio.Future[None]] = {}
+
+    @asynccontextmanager
+    async def reserve(self, n_tokens: int) -> AsyncIterator[None]:
+        async with self._concurrency:
+            if not await self._acquire_remote(n_tokens):
+                await self.requests.acquire(1)
+                await self.tokens.acquire(n_tokens)
+            yield
+
+    def adjust_tokens(self, amount: float) -> None:
+        if self._writer is not None:
+            self._send({"adjust": amount})
+        else:
+            super().adjust_tokens(amount)
+
+    async def _acquire_remote(self, n_tokens: int) -> bool:
+        """Waits for the server to grant the request. False if it is unreachable."""
+        if not await self._connect():
+            return False
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[request_id] = future
+        try:
+            self._send({"id": request_id, "tokens": n_tokens})
+            await future
+            return True
+        except ConnectionError:
+            return False
+        except asyncio.CancelledError:
+            if self._writer is not None:
+                self._send({"cancel": request_id})
+            raise
+        finally:
+            self._waiters.pop(request_id, None)
+
+    async def _connect(self) -> bool:
+        async with self._connect_lock:
+            if self._writer is not None:
+                return True
+            now = time.monotonic()
+            if now - self._last_attempt < RECONNECT_INTERVAL:
+                return False
+            self._last_attempt = now
+            try:
+                reader, self._writer = await asyncio.open_connection(
+                    self._host, self._port
+                )
+            except OSError as e:
+                _logger.warning(
+                    "Rate limit server %s:%i not reachable, using the local "
+                    "budget: %s",
+                    self._host,
+                    self._port,
+                    e,
+                )
+                return False
+            self._reader_task = asyncio.create_task(
+                self._read_grants(reader, self._writer)
+            )
+            return True
+
+    async def _read_grants(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while line := await reader.readline():
+                future = self._waiters.get(json.loads(line)["id"])
+                if future is not None and not future.done():
+                    future.set_result(None)
+        except (ConnectionError, ValueError, KeyError) as e:
+            _logger.warning("Connection to the rate limit server failed: %s", e)
+        finally:
+            _logger.warning("Rate limit server disconnected, using the local budget")
+            self._writer = None
+            writer.close()
+            for future in self._waiters.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Rate limit server gone"))
+
+    def _send(self, message: dict) -> None:
+        if self._writer is not None:
+            self._writer.write(json.dumps(message).encode() + b"\n")
+
+
+class RateLimitServer:
+    """Keeps the request and token budget of several processes, which connect
+    with a RemoteRateLimiter.
+
+    The protocol is one JSON object per line. Clients send {"id": n, "tokens": t}
+    to wait for a request, {"cancel": n} if they stopped waiting and
+    {"adjust": t} to correct the token estimate; the server answers {"id": n}
+    once the request may be sent."""
+
+    def __init__(
+        self,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+        self._host = host
+        self._port = port
+        self._server: asyncio.AbstractServer | None = None
+        self._connections: dict[asyncio.StreamWriter, asyncio.Task] = {}
+
+    @property
+    def port(self) -> int:
+        """The port the server listens on (chosen by the OS if 0 was given)."""
+        if self._server is None:
+            return self._port
+        return self._server.sockets[0].getsockname()[1]
+
+    @property
+    def address(self) -> str:
+        return f"{self._host}:{self.port}"
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle_connection, host=self._host, port=self._port
+        )
+        _logger.info("Rate limit server listening on %s", self.address)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for writer in self._connections:
+                writer.close()
+            await asyncio.gather(*self._connections.values(), return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self._connections[writer] = asyncio.current_task()  # type: ignore
+        # Requests of this client which wait for the budget
+        grants: dict[int, asyncio.Task[None]] = {}
+        try:
+            while line := await reader.readline():
+                try:
+                    message = json.loads(line)
+                    if "adjust" in message:
+                        self.tokens.adjust(float(message["adjust"]))
+                    elif "cancel" in message:
+                        task = grants.pop(message["cancel"], None)
+                        if task is not None:
+                            task.cancel()
+                    else:
+                        request_id = message["id"]
+                        task = asyncio.create_task(
+                            self._grant(request_id, int(message["tokens"]), writer)
+                        )
+                        grants[request_id] = task
+                        task.add_done_callback(
+                            lambda _, request_id=request_id: grants.pop(
+                                request_id, None
+                            )
+                        )
+                except (ValueError, KeyError, TypeError) as e:
+                    _logger.warning("Invalid rate limit request %r: %s", line, e)
+        except ConnectionError:
+            pass
+        finally:
+            for task in grants.values():
+                task.cancel()
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _grant(
+        self, request_id: int, n_tokens: int, writer: asyncio.StreamWriter
+    ) -> None:
+        await self.requests.acquire(1)
+        await self.tokens.acquire(n_tokens)
+        if not writer.is_closing():
+            writer.write(json.dumps({"id": request_id}).encode() + b"\n")
+
+
+def backoff_delay(
+    attempt: int, base: float = 1.0, cap: float = 60.0, retry_after: float = 0.0
+) -> float:
+    """Exponential backoff with full jitter, but at least retry_after seconds."""
+    return max(retry_after, random.uniform(0, min(cap, base * 2**attempt)))
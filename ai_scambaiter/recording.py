@@ -0,0 +1,192 @@
+"""Recording of real traffic, so benchmarks can replay it offline.
+
+The recording is a gzip compressed file with one JSON array per line:
+    ["d", chat_id, title]                           dialog
+    ["h", chat_id, [[id, sender_id, text], ...]]    history loaded on start
+    ["m", t, chat_id, id, sender_id, text]          incoming message
+    ["c", t, key, n_prompt_tokens, duration, reply] model request
+t is the unix time, so recordings of several runs can be appended to the same
+file; key identifies the request by its last message (see request_key)."""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import logging
+import time
+import zlib
+from collections import defaultdict, deque
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+
+from . import GPTMessage
+
+if TYPE_CHECKING:
+    from telethon.tl.custom import Message
+
+_logger = logging.getLogger("Recorder")
+
+# Seconds between flushes of the file, so a crash loses little
+FLUSH_INTERVAL = 1.0
+
+
+def request_key(messages: Sequence[GPTMessage]) -> str:
+    """Identifies a request to the model by its last message, which stays the
+    same when the history before it is handled differently."""
+    if not messages:
+        return ""
+    last = messages[-1]
+    data = f"{last.role.name}\n{last.content}".encode("utf-8")
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+class TrafficRecorder:
+    """Appends telegram messages and model requests to the recording at path.
+    Does nothing if no path is given.
+
+    The records are compressed and written by a thread of their own, in the
+    order they are recorded, so recording never blocks the event loop."""
+
+    def __init__(self, path: str | None = None):
+        self._file: Any = None
+        self._executor: ThreadPoolExecutor | None = None
+        self._last_flush = time.monotonic()
+        if path:
+            self._file = gzip.open(path, "at", encoding="utf-8")
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="recorder"
+            )
+            _logger.info("Recording traffic to %s", path)
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def record_dialogs(self, dialogs: dict[int, Any]) -> None:
+        if self._file is None:
+            return
+        for chat_id, dialog in dialogs.items():
+            self._write(["d", chat_id, getattr(dialog, "title", None)])
+
+    def record_history(self, chat_id: int, messages: Sequence[Message]) -> None:
+        if self._file is None:
+            return
+        history = [[m.id, m.sender_id, m.text] for m in messages]
+        self._write(["h", chat_id, history])
+
+    def record_message(self, message: Message) -> None:
+        if self._file is None:
+            return
+        self._write(
+            [
+                "m",
+                self._now(),
+                message.chat_id,
+                message.id,
+                message.sender_id,
+                message.text,
+            ]
+        )
+
+    def record_completion(
+        self, messages: Sequence[GPTMessage], reply: str, duration: float
+    ) -> None:
+        if self._file is None:
+            return
+        n_prompt_tokens = sum(m.n_tokens for m in messages)
+        self._write(
+            [
+                "c",
+                self._now(),
+                request_key(messages),
+                n_prompt_tokens,
+                round(duration, 3),
+                reply,
+            ]
+        )
+
+    def close(self) -> None:
+        """Writes the pending records and closes the file."""
+        if self._file is not None:
+            self._executor.shutdown()  # type: ignore
+            self._file.close()
+            self._file = None
+
+    def _now(self) -> float:
+        return round(time.time(), 3)
+
+    def _write(self, record: list) -> None:
+        if self._file is None:
+            return
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        self._executor.submit(self._write_line, line)  # type: ignore
+
+    def _write_line(self, line: str) -> None:
+        try:
+            self._file.write(line)
+            now = time.monotonic()
+            if now - self._last_flush >= FLUSH_INTERVAL:
+                self._file.flush()
+                self._last_flush = now
+        except (OSError, ValueError) as e:
+            _logger.error("Could not write the recording: %s", e)
+
+
+@dataclass(slots=True)
+class RecordedMessage:
+    t: float
+    chat_id: int
+    id: int
+    sender_id: int | None
+    text: str | None
+
+
+@dataclass
+class TrafficRecording:
+    """A recording loaded into memory."""
+
+    dialogs: dict[int, str | None] = field(default_factory=dict)
+    # Newest first, like get_messages returns them
+    histories: dict[int, list[RecordedMessage]] = field(default_factory=dict)
+    messages: list[RecordedMessage] = field(default_factory=list)
+    # Replies and their duration per request key, in the recorded order
+    completions: dict[str, deque[tuple[str, float]]] = field(
+        default_factory=lambda: defaultdict(deque)
+    )
+
+    @classmethod
+    def load(cls, path: str) -> TrafficRecording:
+        recording = cls()
+        for record in _read_records(path):
+            kind = record[0]
+            if kind == "d":
+                recording.dialogs[record[1]] = record[2]
+            elif kind == "h":
+                # Keep the history of the first run, later messages are replayed
+                recording.histories.setdefault(
+                    record[1], [RecordedMessage(0.0, record[1], *m) for m in record[2]]
+                )
+            elif kind == "m":
+                recording.messages.append(RecordedMessage(*record[1:]))
+            elif kind == "c":
+                _, _, key, _, duration, reply = record
+                recording.completions[key].append((reply, duration))
+        recording.messages.sort(key=lambda m: m.t)
+        return recording
+
+
+def _read_records(path: str):
+    """Yields the records of the file. A file which was not closed properly ends
+    with an incomplete record, which is skipped."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    _logger.warning("Skipping incomplete record in %s", path)
+        except (EOFError, zlib.error):
+            _logger.warning("Recording %s ends unexpectedly", path)
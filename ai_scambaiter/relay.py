@@ -0,0 +1,356 @@
+"""Telegram access for agent worker processes.
+
+In the split mode of the supervisor, one ingress process owns the telegram
+client and runs a TelegramRelay on a unix socket. The agent workers, each with a
+shard of the chats, use a RelayTelegramInterface instead of their own client, so
+tokenization and model requests never delay receiving and sending messages.
+
+The protocol is one JSON object per line. Workers send requests
+{"id": n, "op": ..., ...} which are answered with {"id": n, "result": ...} or
+{"id": n, "error": ...}, plus {"op": "monitor", "chats": [...]} and
+{"op": "typing", "chat": c, "on": bool} without an answer. The relay forwards
+new messages of the monitored chats as {"message": [chat_id, id, sender_id,
+text]}."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+from collections.abc import Collection
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Any, AsyncIterator
+
+from telethon.helpers import TotalList
+from telethon.tl.custom import Message
+
+from . import TelegramInterface, metrics
+from .ingress import make_message, message_fields
+
+if TYPE_CHECKING:
+    from typing import AsyncContextManager
+
+_logger = logging.getLogger("Relay")
+
+DEFAULT_SOCKET_PATH = "ai_scambaiter.sock"
+# Longest line, a history of many messages is sent as one
+LINE_LIMIT = 64 * 1024 * 1024
+# Messages buffered for a worker on each side of the socket. A worker which
+# falls further behind is disconnected, so it cannot hold up the other workers.
+WORKER_QUEUE_SIZE = 1000
+
+
+def _encode(data: dict) -> bytes:
+    return json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+class TelegramRelay:
+    """Serves the telegram interface of the ingress process to the agent
+    workers, and forwards each new message to the worker monitoring its chat.
+
+    Forwarding starts once n_workers have told their chats, until then new
+    messages wait in the ingress buffer. Each worker has its own outgoing queue,
+    written by a task of its own. A worker whose queue is full is disconnected.
+    Messages of a worker which is not connected are dropped, it fetches them
+    with the history when it restarts."""
+
+    def __init__(
+        self,
+        telegram_interface: TelegramInterface,
+        path: str | None = None,
+    ):
+        self._telegram_interface = telegram_interface
+        self.path = path or DEFAULT_SOCKET_PATH
+        self._server: asyncio.AbstractServer | None = None
+        self._routes: dict[int, asyncio.StreamWriter] = {}
+        self._monitors: dict[asyncio.StreamWriter, frozenset[int]] = {}
+        self._connections: dict[asyncio.StreamWriter, asyncio.Task] = {}
+        self._outboxes: dict[asyncio.StreamWriter, asyncio.Queue[bytes]] = {}
+        self._n_workers = 0
+        self._all_monitoring = asyncio.Event()
+        self.forwarded = 0
+        self.dropped = 0
+
+    async def start(self, n_workers: int) -> None:
+        self._n_workers = n_workers
+        # Left over if the last run did not stop properly
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(
+            self._handle_connection, path=self.path, limit=LINE_LIMIT
+        )
+        _logger.info("Relaying telegram on %s", self.path)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for writer in self._connections:
+                writer.close()
+            await asyncio.gather(*self._connections.values(), return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def run(self) -> None:
+        """Forwards new messages to the workers."""
+        await self._all_monitoring.wait()
+        _logger.info("All %i workers are ready", self._n_workers)
+        async for message in self._telegram_interface.message_stream():
+            writer = self._routes.get(getattr(message, "chat_id", None))  # type: ignore
+            if writer is None or writer.is_closing():
+                self.dropped += 1
+                continue
+            outbox = self._outboxes[writer]
+            try:
+                outbox.put_nowait(_encode({"message": message_fields(message)}))
+            except asyncio.QueueFull:
+                _logger.error("Worker is not keeping up, disconnecting it")
+                self.dropped += 1 + outbox.qsize()
+                self._set_monitor(writer, None)
+                writer.close()
+            # Lets the writers take the message, so a burst (e.g. the messages
+            # buffered while the workers started) does not fill their queues
+            await asyncio.sleep(0)
+
+    async def _forward(
+        self, outbox: asyncio.Queue[bytes], writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                writer.write(await outbox.get())
+                await writer.drain()
+                self.forwarded += 1
+        except ConnectionError:
+            pass
+
+    def _set_monitor(
+        self, writer: asyncio.StreamWriter, chat_ids: frozenset[int] | None
+    ) -> None:
+        if chat_ids is None:
+            self._monitors.pop(writer, None)
+        else:
+            self._monitors[writer] = chat_ids
+        self._routes = {
+            chat_id: w for w, chats in self._monitors.items() for chat_id in chats
+        }
+        if len(self._monitors) >= self._n_workers:
+            self._all_monitoring.set()
+        # Until all workers are ready, messages of every chat are kept
+        if self._all_monitoring.is_set():
+            self._telegram_interface.set_monitored_chats(self._routes.keys())
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self._connections[writer] = asyncio.current_task()  # type: ignore
+        outbox = self._outboxes[writer] = asyncio.Queue(WORKER_QUEUE_SIZE)
+        forward = asyncio.create_task(self._forward(outbox, writer))
+        # Typing indicators shown for this worker, per chat
+        typing: dict[int, asyncio.Task[None]] = {}
+        tasks: set[asyncio.Task[None]] = set()
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    op = request["op"]
+                except (ValueError, KeyError) as e:
+                    _logger.warning("Invalid relay request %r: %s", line[:100], e)
+                    continue
+                if op == "monitor":
+                    self._set_monitor(writer, frozenset(request["chats"]))
+                elif op == "typing":
+                    task = typing.pop(request["chat"], None)
+                    if task is not None:
+                        task.cancel()
+                    if request["on"]:
+                        typing[request["chat"]] = asyncio.create_task(
+                            self._show_typing(request["chat"])
+                        )
+                else:
+                    # Requests are answered in any order, a slow send must not
+                    # hold up loading the history of another chat
+                    task = asyncio.create_task(self._answer(request, writer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            for task in (forward, *typing.values(), *tasks):
+                task.cancel()
+            if writer in self._monitors:
+                _logger.warning("Worker disconnected")
+                self._set_monitor(writer, None)
+            self._connections.pop(writer, None)
+            self._outboxes.pop(writer, None)
+            writer.close()
+
+    async def _answer(self, request: dict, writer: asyncio.StreamWriter) -> None:
+        telegram = self._telegram_interface
+        op = request["op"]
+        try:
+            if op == "dialog":
+                dialog = await telegram.get_dialog(request["key"])
+                result: Any = (
+                    [dialog.id, getattr(dialog, "title", None)]  # type: ignore
+                    if dialog is not None
+                    else None
+                )
+            elif op == "get_messages":
+                messages = await telegram.get_messages(
+                    request["chat"],
+                    number_of_messages=request["limit"],
+                    oldest_first=request["oldest_first"],
+                    min_id=request["min_id"],
+                )
+                result = [message_fields(m) for m in messages]
+            elif op == "send":
+                result = await telegram.send_message(
+                    request["chat"], request["text"], request.get("replace", False)
+                )
+            elif op == "delete_last":
+                await telegram.delete_last_message(request["chat"])
+                result = None
+            else:
+                raise ValueError(f"Unknown relay request {op}")
+            response = {"id": request["id"], "result": result}
+        except Exception as e:
+            response = {"id": request["id"], "error": f"{type(e).__name__}: {e}"}
+        if not writer.is_closing():
+            writer.write(_encode(response))
+
+    async def _show_typing(self, chat_id: int) -> None:
+        try:
+            async with self._telegram_interface.typing(chat_id):
+                await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _logger.warning("Could not show typing in %i: %s", chat_id, e)
+
+
+class RelayTelegramInterface(TelegramInterface):
+    """Telegram interface of an agent worker, connected to the TelegramRelay of
+    the ingress process at path."""
+
+    def __init__(self, path: str | None = None):
+        self._path = path or DEFAULT_SOCKET_PATH
+        self._writer: asyncio.StreamWriter | None = None
+        self._reader_task: asyncio.Task[None] | None = None
+        self._ids = itertools.count()
+        self._waiters: dict[int, asyncio.Future[Any]] = {}
+        self._messages: asyncio.Queue[Message | None] = asyncio.Queue(WORKER_QUEUE_SIZE)
+        self._dialogs: dict[int, object] = {}
+
+    async def start(self) -> None:
+        reader, self._writer = await asyncio.open_unix_connection(
+            self._path, limit=LINE_LIMIT
+        )
+        self._reader_task = asyncio.create_task(self._read(reader))
+        _logger.info("Connected to the telegram relay")
+
+    @property
+    def dialogs(self) -> dict[int, object]:
+        """The dialogs resolved so far."""
+        return self._dialogs
+
+    async def get_dialog(self, chat_id_or_title: str) -> object | None:
+        row = await self._request("dialog", key=chat_id_or_title)
+        if row is None:
+            return None
+        dialog = self._dialogs[row[0]] = SimpleNamespace(id=row[0], title=row[1])
+        return dialog
+
+    async def get_messages(
+        self,
+        chat_id: int,
+        number_of_messages: int = 100,
+        oldest_first: bool = True,
+        min_id: int = 0,
+    ) -> TotalList:
+        rows = await self._request(
+            "get_messages",
+            chat=chat_id,
+            limit=number_of_messages,
+            oldest_first=oldest_first,
+            min_id=min_id,
+        )
+        return TotalList(make_message(*row) for row in rows)
+
+    async def send_message(
+        self, chat_id: int, message: str, replace: bool = False
+    ) -> bool | None:
+        return await self._request("send", chat=chat_id, text=message, replace=replace)
+
+    def typing(self, chat_id: int) -> AsyncContextManager[object]:
+        return self._typing(chat_id)
+
+    @contextlib.asynccontextmanager
+    async def _typing(self, chat_id: int) -> AsyncIterator[None]:
+        self._send({"op": "typing", "chat": chat_id, "on": True})
+        try:
+            yield
+        finally:
+            self._send({"op": "typing", "chat": chat_id, "on": False})
+
+    async def delete_last_message(self, chat_id: int) -> None:
+        await self._request("delete_last", chat=chat_id)
+
+    def set_monitored_chats(self, chat_ids: Collection[int] | None) -> None:
+        self._send({"op": "monitor", "chats": list(chat_ids or ())})
+
+    async def message_stream(self) -> AsyncIterator[Message]:
+        while True:
+            message = await self._messages.get()
+            if message is None:
+                raise ConnectionError("Connection to the telegram relay lost")
+            yield message
+
+    async def _on_new_message(self, event) -> None:
+        message = event.message
+        metrics.tracer.mark(message.chat_id, message.id, "received")
+        await self._messages.put(message)
+
+    async def _request(self, op: str, **params: Any) -> Any:
+        if self._writer is None:
+            raise ConnectionError("Not connected to the telegram relay")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[request_id] = future
+        try:
+            self._send({"id": request_id, "op": op, **params})
+            return await future
+        finally:
+            self._waiters.pop(request_id, None)
+
+    def _send(self, data: dict) -> None:
+        if self._writer is not None:
+            self._writer.write(_encode(data))
+
+    async def _read(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while line := await reader.readline():
+                data = json.loads(line)
+                if "message" in data:
+                    event = SimpleNamespace(message=make_message(*data["message"]))
+                    await self._on_new_message(event)
+                    continue
+                future = self._waiters.get(data["id"])
+                if future is None or future.done():
+                    continue
+                if "error" in data:
+                    future.set_exception(RuntimeError(data["error"]))
+                else:
+                    future.set_result(data["result"])
+        except (ConnectionError, ValueError, KeyError) as e:
+            _logger.error("Connection to the telegram relay failed: %s", e)
+        finally:
+            _logger.error("Telegram relay disconnected")
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            for future in self._waiters.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Telegram relay gone"))
+            await self._messages.put(None)
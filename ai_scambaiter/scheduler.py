@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections.abc import Awaitable, Callable, Hashable
+
+_logger = logging.getLogger("Scheduler")
+
+DEFAULT_MAX_WORKERS = 32
+# The heap is rebuilt when it holds this many times more entries than there are
+# deadlines, so stale entries of rescheduled deadlines do not pile up
+COMPACT_FACTOR = 4
+COMPACT_MIN_SIZE = 1024
+
+Job = Callable[[], Awaitable[None]]
+
+
+class Scheduler:
+    """Deadlines of all agents (reply debounce, silence timeout) behind a single
+    timer.
+
+    Each key has at most one deadline. Scheduling a key again replaces its
+    deadline in O(log n): a new heap entry is pushed and the old one is skipped
+    when it reaches the top. Only one timer handle exists, for the earliest
+    deadline. Due jobs run as tasks, at most max_workers at a time."""
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS):
+        # (deadline, sequence number, key)
+        self._heap: list[tuple[float, int, Hashable]] = []
+        # Current deadline per key: (deadline, sequence number, job)
+        self._deadlines: dict[Hashable, tuple[float, int, Job]] = {}
+        self._sequence = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+        self._timer_deadline = 0.0
+        self._workers = asyncio.Semaphore(max_workers)
+        self._running: dict[Hashable, asyncio.Task[None]] = {}
+        # Deadline (loop time) of each running job
+        self._started: dict[Hashable, float] = {}
+        # Incremented with every change, so a checkpoint is only written if needed
+        self.version = 0
+
+    @property
+    def pending(self) -> int:
+        """Number of deadlines which have not been reached yet."""
+        return len(self._deadlines)
+
+    @property
+    def running(self) -> int:
+        """Number of jobs which are running or waiting for a worker."""
+        return len(self._running)
+
+    def is_active(self, key: Hashable) -> bool:
+        """Whether key has a pending deadline or a running job."""
+        return key in self._deadlines or key in self._running
+
+    def is_pending(self, key: Hashable) -> bool:
+        """Whether key has a deadline which has not been reached yet."""
+        return key in self._deadlines
+
+    def is_running(self, key: Hashable) -> bool:
+        """Whether the job of key is running or waiting for a worker."""
+        return key in self._running
+
+    def schedule(self, key: Hashable, delay: float, job: Job) -> None:
+        """Runs job after delay seconds, replacing the pending deadline of key."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max(0.0, delay)
+        sequence = next(self._sequence)
+        self._deadlines[key] = (deadline, sequence, job)
+        self.version += 1
+        heapq.heappush(self._heap, (deadline, sequence, key))
+        if len(self._heap) > max(
+            COMPACT_MIN_SIZE, COMPACT_FACTOR * len(self._deadlines)
+        ):
+            self._compact()
+        self._arm(loop)
+
+    def cancel(self, key: Hashable) -> None:
+        """Removes the pending deadline of key. A job which already runs is not
+        affected, see cancel_running."""
+        if self._deadlines.pop(key, None) is not None:
+            self.version += 1
+
+    def snapshot(self) -> dict[Hashable, float]:
+        """The pending deadlines as unix time. Jobs which are still running are
+        included with the time they were due, so an interrupted reply is not lost
+        when the snapshot is restored."""
+        offset = time.time() - asyncio.get_running_loop().time()
+        deadlines = {key: deadline + offset for key, deadline in self._started.items()}
+        for key, (deadline, _, _) in self._deadlines.items():
+            deadlines[key] = deadline + offset
+        return deadlines
+
+    def cancel_running(self, key: Hashable) -> asyncio.Task[None] | None:
+        """Cancels the job of key if it is running, and returns its task."""
+        task = self._running.get(key)
+        if task is not None and not task.done():
+            task.cancel()
+            return task
+        return None
+
+    def _is_current(self, entry: tuple[float, int, Hashable]) -> bool:
+        current = self._deadlines.get(entry[2])
+        return current is not None and current[1] == entry[1]
+
+    def _compact(self) -> None:
+        self._heap = [
+            (deadline, sequence, key)
+            for key, (deadline, sequence, _) in self._deadlines.items()
+        ]
+        heapq.heapify(self._heap)
+
+    def _arm(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Sets the timer to the earliest pending deadline."""
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            return
+        deadline = self._heap[0][0]
+        if self._timer is not None:
+            if self._timer_deadline <= deadline:
+                # Fires early at worst, and is then set again
+                return
+            self._timer.cancel()
+        self._timer = loop.call_at(deadline, self._fire)
+        self._timer_deadline = deadline
+
+    def _fire(self) -> None:
+        self._timer = None
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if not self._is_current(entry):
+                continue
+            key = entry[2]
+            deadline, _, job = self._deadlines.pop(key)
+            task = loop.create_task(self._run_job(key, job))
+            # A callback instead of finally, which would not run if the task is
+            # cancelled before it starts
+            task.add_done_callback(lambda task, key=key: self._job_done(key, task))
+            self._running[key] = task
+            self._started[key] = deadline
+            self.version += 1
+        self._arm(loop)
+
+    async def _run_job(self, key: Hashable, job: Job) -> None:
+        try:
+            async with self._workers:
+                await job()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            _logger.error("Error in scheduled job %s: %s", key, e)
+
+    def _job_done(self, key: Hashable, task: asyncio.Task[None]) -> None:
+        if self._running.get(key) is task:
+            del self._running[key]
+            del self._started[key]
+            self.version += 1
@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+from collections.abc import Mapping
+from dataclasses import fields
+from typing import Any, TypeVar
+
+T = TypeVar("T")
+
+_TRUE = ("1", "true", "yes", "on")
+
+
+def from_section(cls: type[T], section: Mapping[str, str] | None) -> T:
+    """Creates the settings dataclass cls from a section of the configuration.
+    Values are converted to the type of their field; missing or empty values
+    keep the default."""
+    values: dict[str, Any] = {}
+    for field in fields(cls):  # type: ignore[arg-type]
+        value = (section or {}).get(field.name)
+        if value is None or value == "":
+            continue
+        if field.type in (bool, "bool"):
+            values[field.name] = value.strip().lower() in _TRUE
+        elif field.type in (int, "int"):
+            values[field.name] = int(value)
+        elif field.type in (float, "float"):
+            values[field.name] = float(value)
+        else:
+            values[field.name] = value
+    return cls(**values)
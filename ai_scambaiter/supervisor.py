@@ -0,0 +1,154 @@
+"""Runs the bot in several processes, one per telegram account.
+
+Each worker is a normal bot process started with its own config file, which is
+read on top of config.ini. It sets the account ([auth] phone, own_id, session),
+the chats of this account ([conversations] chats) and the files that must not be
+shared ([storage] conversations, [telegram] ingress_spill and dialog_cache,
+[metrics] port, ...).
+The OpenAI requests of all workers are limited by one budget, kept by the
+supervisor (see RateLimitServer).
+
+With agent_workers instead, the supervisor runs a single account: it owns the
+telegram client itself and relays it to agent workers, which split the chats
+between them (see TelegramRelay). Workers take no console commands, so the
+Controller is not available in either mode."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import sys
+import time
+from collections.abc import Awaitable
+from pathlib import Path
+
+from .chatgpt_interface import DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE
+from .rate_limit import RateLimitServer, backoff_delay
+from .relay import TelegramRelay
+
+_logger = logging.getLogger("Supervisor")
+
+# A worker which ran this long before it failed is restarted without delay
+STABLE_RUNTIME = 60.0
+# Seconds a worker gets to shut down before it is killed
+STOP_TIMEOUT = 10.0
+
+
+def worker_name(config_path: str) -> str:
+    """Short name of the worker with this config file, e.g. for its log file."""
+    return Path(config_path).stem
+
+
+class Supervisor:
+    """Starts a worker process per config file in workers (one per line), or
+    agent_workers processes for the chats of this process, and restarts workers
+    which fail."""
+
+    def __init__(
+        self,
+        workers: str | None,
+        requests_per_minute: str | None = None,
+        tokens_per_minute: str | None = None,
+        rate_limit_port: str | None = None,
+        agent_workers: str | None = None,
+    ):
+        self.workers = [w.strip() for w in (workers or "").splitlines() if w.strip()]
+        self.agent_workers = int(agent_workers or 0)
+        rpm = int(requests_per_minute or DEFAULT_REQUESTS_PER_MINUTE)
+        tpm = int(tokens_per_minute or DEFAULT_TOKENS_PER_MINUTE)
+        self._rate_limit_server = RateLimitServer(
+            rpm, tpm, port=int(rate_limit_port or 0)
+        )
+
+    async def run(self) -> None:
+        """Runs a worker per account."""
+        await self._serve(
+            {
+                worker_name(config_path): ["--config", config_path]
+                for config_path in self.workers
+            }
+        )
+
+    async def run_agent_workers(
+        self, relay: TelegramRelay, config_path: str | None = None
+    ) -> None:
+        """Runs the agent workers, which use the telegram client of this process
+        through the relay. config_path is the config file of this process, which
+        the workers read as well."""
+        config_args = ["--config", config_path] if config_path else []
+        await relay.start(self.agent_workers)
+        try:
+            await self._serve(
+                {
+                    f"agents{i}": [
+                        *config_args,
+                        "--relay",
+                        relay.path,
+                        "--shard",
+                        f"{i}/{self.agent_workers}",
+                    ]
+                    for i in range(self.agent_workers)
+                },
+                relay.run(),
+            )
+        finally:
+            await relay.stop()
+
+    async def _serve(
+        self, workers: dict[str, list[str]], *coroutines: Awaitable[None]
+    ) -> None:
+        await self._rate_limit_server.start()
+        try:
+            await asyncio.gather(
+                *(self._run_worker(name, args) for name, args in workers.items()),
+                *coroutines,
+            )
+        finally:
+            await self._rate_limit_server.stop()
+
+    async def _run_worker(self, name: str, args: list[str]) -> None:
+        attempt = 0
+        while True:
+            t_start = time.monotonic()
+            process = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-m",
+                "ai_scambaiter.main",
+                "--worker",
+                *args,
+                "--rate-limit-server",
+                self._rate_limit_server.address,
+            )
+            _logger.info("Started worker %s (pid %i)", name, process.pid)
+            try:
+                return_code = await process.wait()
+            except asyncio.CancelledError:
+                await self._stop_worker(name, process)
+                raise
+            if return_code == 0:
+                _logger.info("Worker %s finished", name)
+                return
+            if time.monotonic() - t_start >= STABLE_RUNTIME:
+                attempt = 0
+            delay = backoff_delay(attempt)
+            attempt += 1
+            _logger.error(
+                "Worker %s exited with code %i, restarting in %.1fs",
+                name,
+                return_code,
+                delay,
+            )
+            await asyncio.sleep(delay)
+
+    async def _stop_worker(
+        self, name: str, process: asyncio.subprocess.Process
+    ) -> None:
+        if process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            _logger.warning("Worker %s did not stop, killing it", name)
+            process.kill()
+            await process.wait()
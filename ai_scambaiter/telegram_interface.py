@@ -1,14 +1,21 @@
 from __future__ import annotations
 
-import asyncio
 import logging
-from typing import TYPE_CHECKING, AsyncIterator
+import time
+from typing import TYPE_CHECKING, Any, AsyncIterator
 
 from telethon import TelegramClient, events
 
-from . import TelegramInterface
+from . import TelegramInterface, metrics
+from .dialogs import DialogRegistry
+from .ingress import IngressBuffer
+from .outbound import OutboundQueue
+from .recording import TrafficRecorder
 
 if TYPE_CHECKING:
+    from collections.abc import Collection
+    from typing import AsyncContextManager
+
     from telethon.hints import TotalList
     from telethon.tl.custom import Message
 
@@ -21,42 +28,108 @@ class TelegramInterfaceImpl(TelegramInterface):
         api_id: str | int,
         api_hash: str,
         phone: str,
+        ingress_size: str | None = None,
+        ingress_policy: str | None = None,
+        ingress_spill_path: str | None = None,
+        recorder: TrafficRecorder | None = None,
+        session: str | None = None,
+        dialog_cache_path: str | None = None,
+        outbound_settings: dict[str, str] | None = None,
+        chats: str | None = None,
     ):
         self.phone = phone
         self.api_id = api_id
         self.api_hash = api_hash
-        self.queue: asyncio.Queue[Message] = asyncio.Queue(maxsize=100)
-        self._dialogs: dict[int, object] = []
+        self._recorder: TrafficRecorder = recorder or TrafficRecorder()
 
-        self.client = TelegramClient("Session", int(api_id), api_hash)
+        session = session or "Session"
+        self.client = TelegramClient(session, int(api_id), api_hash)
+        self.dialog_registry = DialogRegistry(self.client, dialog_cache_path)
+        self.outbound = OutboundQueue(
+            self._send_now, self.typing, **(outbound_settings or {})
+        )
         self.client.add_event_handler(self._on_new_message, events.NewMessage)
+        self.queue: IngressBuffer = IngressBuffer(
+            maxsize=int(ingress_size or 100),
+            policy=ingress_policy or "drop_unmonitored",
+            # Next to the session file, which is per account
+            spill_path=ingress_spill_path or f"{session}.ingress_spill",
+            monitored_chats=self._configured_chat_ids(chats),
+        )
+        metrics.registry.add_collector(self._collect_metrics)
+
+    def _configured_chat_ids(self, chats: str | None) -> set[int] | None:
+        """Ids of the configured chats, or None if a title is not known yet."""
+        if chats is None:
+            return None
+        chat_ids = set()
+        for chat in filter(None, (c.strip() for c in chats.splitlines())):
+            entry = self.dialog_registry.lookup(chat)
+            if entry is not None:
+                chat_ids.add(entry.id)
+                continue
+            try:
+                chat_ids.add(int(chat))
+            except ValueError:
+                return None
+        return chat_ids
 
     async def start(self):
         await self.client.start(phone=self.phone)  # type: ignore
-        self._dialogs = {d.id: d for d in await self.client.get_dialogs()}
-        _logger.info("Got %i chats", len(self._dialogs))
+        # Dialogs are fetched when the agents need them, see get_dialog
+        _logger.info("Connected, %i chats known", len(self.dialog_registry.entries))
 
     @property
     def dialogs(self) -> dict[int, object]:
-        """Get all dialogs (chats) from the telegram client."""
-        return self._dialogs
+        """The dialogs (chats) resolved so far."""
+        return self.dialog_registry.entries  # type: ignore
+
+    async def get_dialog(self, chat_id_or_title: str) -> object | None:
+        entry = await self.dialog_registry.resolve(chat_id_or_title)
+        if entry is not None:
+            self._recorder.record_dialogs({entry.id: entry})
+        return entry
+
+    def _entity(self, chat_id: int) -> Any:
+        """The cached input peer of the chat, or its id for telethon to look up."""
+        entry = self.dialog_registry.get(chat_id)
+        return entry.entity if entry is not None and entry.entity else chat_id
 
     async def get_messages(
-        self, chat_id: int, number_of_messages: int = 100, oldest_first: bool = True
+        self,
+        chat_id: int,
+        number_of_messages: int = 100,
+        oldest_first: bool = True,
+        min_id: int = 0,
     ) -> TotalList:
-        return await self.client.get_messages(
-            self._dialogs[chat_id], limit=number_of_messages, reverse=oldest_first
+        messages = await self.client.get_messages(
+            self._entity(chat_id),
+            limit=number_of_messages,
+            reverse=oldest_first,
+            min_id=min_id,
         )
+        self._recorder.record_history(
+            chat_id, messages if not oldest_first else messages[::-1]
+        )
+        return messages
+
+    async def send_message(
+        self, chat_id: int, message: str, replace: bool = False
+    ) -> bool:
+        return await self.outbound.send(chat_id, message, replace)
 
-    async def send_message(self, chat_id: int, message: str):
+    async def _send_now(self, chat_id: int, message: str) -> None:
         _logger.info("Sending telegram message to %i: %s", chat_id, message)
+        t_start = time.monotonic()
         try:
-            msg = await self.client.send_message(self._dialogs[chat_id], message)
+            msg = await self.client.send_message(self._entity(chat_id), message)
             if not msg:
                 raise RuntimeError("Message not sent")
-        except Exception as e:
-            _logger.error("Error sending message to %i: %s", chat_id, e)
-            raise e
+        finally:
+            metrics.send_latency.observe(time.monotonic() - t_start)
+
+    def typing(self, chat_id: int) -> AsyncContextManager[object]:
+        return self.client.action(self._entity(chat_id), "typing")
 
     async def delete_last_message(self, chat_id: int):
         messages = await self.get_messages(
@@ -70,9 +143,29 @@ class TelegramInterfaceImpl(TelegramInterface):
                 messages[0].text,
             )
 
+    def set_monitored_chats(self, chat_ids: Collection[int] | None) -> None:
+        self.queue.set_monitored_chats(chat_ids)
+
+    @property
+    def ingress_stats(self) -> dict[str, int]:
+        return self.queue.stats
+
     async def message_stream(self) -> AsyncIterator[Message]:
         while True:
             yield await self.queue.get()
 
     async def _on_new_message(self, event: events.NewMessage):
-        await self.queue.put(event.message)
+        message = event.message
+        # Messages of other chats must not fill the tracer or the recording
+        if self.queue.may_be_monitored(message.chat_id):
+            metrics.tracer.mark(message.chat_id, message.id, "received")
+            self._recorder.record_message(message)
+        await self.queue.put(message)
+
+    def _collect_metrics(self) -> None:
+        stats = self.queue.stats
+        metrics.ingress_depth.set(stats["depth"])
+        metrics.ingress_high_water_mark.set(stats["high_water_mark"])
+        metrics.ingress_dropped.set(stats["dropped"], reason="overflow")
+        metrics.ingress_dropped.set(stats["filtered"], reason="unmonitored")
+        metrics.outbound_depth.set(self.outbound.depth)
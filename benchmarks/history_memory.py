@@ -0,0 +1,93 @@
+"""Memory used by the conversation history of one agent.
+
+Compares the old layout (a plain list of GPTMessage with a per-instance __dict__)
+with the current one (ChatHistory of slotted GPTMessage, with and without the
+cached request params). The message texts are created before measuring, because
+their size does not depend on the layout.
+
+Usage: python -m benchmarks.history_memory [number of messages]
+"""
+
+import functools
+import random
+import string
+import sys
+import tracemalloc
+from dataclasses import dataclass
+
+from ai_scambaiter import GPTMessage, Role
+from ai_scambaiter.chatgpt_interface import ChatGPTInterfaceImpl
+from ai_scambaiter.history import ChatHistory
+
+MAX_INPUT_TOKENS = 120000
+
+
+@dataclass
+class LegacyGPTMessage:
+    content: str
+    role: Role
+    n_tokens: int
+
+
+def make_texts(n: int) -> list[str]:
+    rng = random.Random(1)
+    alphabet = string.ascii_letters + "      "
+    # Chat messages are mostly short, with a long tail
+    lengths = [max(1, int(rng.lognormvariate(3.5, 1.0))) for _ in range(n)]
+    return ["".join(rng.choices(alphabet, k=length)) for length in lengths]
+
+
+def measure(build) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    history = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del history
+    return used
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    texts = make_texts(n)
+    roles = [Role.USER if i % 2 else Role.ASSISTANT for i in range(n)]
+    n_tokens = [len(t) // 4 + 5 for t in texts]
+    text_bytes = sum(sys.getsizeof(t) for t in texts)
+    # Messages which fit into the token budget of one agent
+    per_agent = int(n * MAX_INPUT_TOKENS / sum(n_tokens))
+
+    def legacy():
+        return [
+            LegacyGPTMessage(content=t, role=r, n_tokens=k)
+            for t, r, k in zip(texts, roles, n_tokens)
+        ]
+
+    # Telegram message ids, large enough not to be cached small ints
+    message_ids = list(range(10**6, 10**6 + n))
+
+    def compact(to_param=None, keep_ids=False):
+        def build():
+            history = ChatHistory(to_param, keep_ids)
+            for t, r, k, i in zip(texts, roles, n_tokens, message_ids):
+                history.append(GPTMessage(content=t, role=r, n_tokens=k), i)
+            return history
+
+        return build
+
+    # message_param does not use the instance, so no API key or tokenizer is needed
+    to_param = functools.partial(ChatGPTInterfaceImpl.message_param, None)
+    results = [
+        ("list of dataclass (before)", measure(legacy)),
+        ("ChatHistory, slotted", measure(compact())),
+        ("  + ids (agent default)", measure(compact(keep_ids=True))),
+        ("  + ids + params", measure(compact(to_param, keep_ids=True))),
+    ]
+    print(f"{n} messages, {text_bytes / n:.0f} bytes of text per message (excluded)")
+    print(f"about {per_agent} messages per agent at {MAX_INPUT_TOKENS} tokens\n")
+    print(f"{'layout':32} {'bytes/message':>14} {'KiB/agent':>10}")
+    for name, used in results:
+        print(f"{name:32} {used / n:14.0f} {used / n * per_agent / 1024:10.0f}")
+
+
+if __name__ == "__main__":
+    main()
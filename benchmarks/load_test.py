@@ -0,0 +1,163 @@
+"""Load test of the bot with many concurrent scam chats, fully offline.
+
+Telegram and the model are replaced by mocks with configurable latency, and a
+synthetic generator sends messages into all chats. The report shows throughput,
+reply latency percentiles, event loop lag and memory.
+
+The reply latency includes the agent's response wait (--response-wait), the time
+it waits for further messages before it answers.
+
+Usage: python -m benchmarks.load_test --chats 300 --duration 60
+"""
+
+import argparse
+import asyncio
+import gc
+import logging
+import time
+
+from ai_scambaiter import metrics
+from ai_scambaiter.bot_runner import BotRunnerImpl
+from ai_scambaiter.mocks.chatgpt_interface_mock import LatencyChatGPTInterfaceMock
+from ai_scambaiter.mocks.load_generator import LoadGenerator, LoadProfile
+from ai_scambaiter.mocks.telegram_interface_mock import ScaledTelegramInterfaceMock
+from benchmarks.report import (
+    peak_rss_mib,
+    print_latencies,
+    print_summary,
+    rss_mib,
+    sample_loop_lag,
+    stage_latencies,
+)
+
+OWN_ID = 1
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--rate", type=float, default=2, help="messages/chat/minute")
+    parser.add_argument("--burst-probability", type=float, default=0.1)
+    parser.add_argument("--burst-size", type=int, default=5)
+    parser.add_argument("--burst-interval", type=float, default=0.5)
+    parser.add_argument("--median-length", type=int, default=60, help="characters")
+    parser.add_argument("--length-sigma", type=float, default=1.0)
+    parser.add_argument("--history", type=int, default=200, help="messages/chat")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="seconds")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=50)
+    parser.add_argument("--llm-concurrency", type=int, default=0, help="0: no limit")
+    parser.add_argument("--send-latency", type=float, default=0.1, help="seconds")
+    parser.add_argument("--response-wait", type=float, default=1.0, help="seconds")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--start-concurrency", type=int, default=16)
+    parser.add_argument("--reply-workers", type=int, default=32)
+    parser.add_argument(
+        "--prefilter", action="store_true", help="skip or batch no-reply messages"
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args()
+
+
+async def run(args: argparse.Namespace) -> None:
+    # Keep the traces of all replies, not only the most recent ones
+    metrics.tracer = metrics.Tracer(max_finished=10**7)
+    gc.collect()
+    rss_before = rss_mib()
+
+    telegram = ScaledTelegramInterfaceMock(
+        args.chats,
+        OWN_ID,
+        history_length=args.history,
+        send_latency=args.send_latency,
+        ingress_size=max(1000, args.chats * 10),
+    )
+    chatgpt = LatencyChatGPTInterfaceMock(
+        latency=args.llm_latency,
+        tokens_per_second=args.llm_tokens_per_second,
+        max_concurrency=args.llm_concurrency or None,
+    )
+    await telegram.start()
+    runner = BotRunnerImpl(
+        message_stream=telegram.message_stream,
+        telegram_interface=telegram,
+        chatgpt_interface=chatgpt,
+        conversation_store=None,
+        conversations="\n".join(str(chat_id) for chat_id in telegram.chat_ids),
+        own_id=str(OWN_ID),
+        start_concurrency=str(args.start_concurrency),
+        reply_workers=str(args.reply_workers),
+        agent_settings={
+            "response_wait": str(args.response_wait),
+            "streaming": str(args.streaming),
+        },
+        prefilter_settings={"enabled": str(args.prefilter)},
+    )
+    t_start = time.monotonic()
+    await runner.start()
+    startup = time.monotonic() - t_start
+    rss_started = rss_mib()
+
+    generator = LoadGenerator(
+        telegram.receive_from_scammer,
+        telegram.chat_ids,
+        LoadProfile(
+            messages_per_minute=args.rate,
+            burst_probability=args.burst_probability,
+            burst_size=args.burst_size,
+            burst_interval=args.burst_interval,
+            median_length=args.median_length,
+            length_sigma=args.length_sigma,
+        ),
+    )
+    lags: list[float] = []
+    lag_task = asyncio.create_task(sample_loop_lag(lags))
+    run_task = asyncio.create_task(runner.run())
+    t_start = time.monotonic()
+    await generator.run(args.duration)
+    # Let the replies to the last messages go out
+    drain = args.response_wait + 5 * args.llm_latency + args.send_latency + 1
+    await asyncio.sleep(drain)
+    elapsed = time.monotonic() - t_start
+    rss_peak = peak_rss_mib()
+    lag_task.cancel()
+    run_task.cancel()
+    await runner.stop()
+
+    superseded = sum(a.usage.superseded_requests for a in runner.agents.values())
+    lags.sort()
+    n_dropped = telegram.queue.dropped + sum(runner.inbox_drops.values())
+    summary = [
+        ("chats", f"{len(runner.agents)} of {args.chats}, started in {startup:.2f}s"),
+        ("messages in", f"{generator.sent} ({generator.sent / elapsed:.1f}/s)"),
+        ("  bursts", generator.bursts),
+        ("replies out", f"{telegram.sent} ({telegram.sent / elapsed:.1f}/s)"),
+        ("model requests", f"{chatgpt.requests} ({superseded} superseded)"),
+        ("  max in flight", chatgpt.max_in_flight),
+        ("  avoided", f"{metrics.llm_calls_avoided.value():.0f} by the pre-filter"),
+        ("messages dropped", n_dropped),
+    ]
+    print_summary(summary)
+    print_latencies(
+        [
+            ("reply", stage_latencies("received", "sent")),
+            ("  dispatch", stage_latencies("received", "handled")),
+            ("  generate+send", stage_latencies("reply_started", "sent")),
+            ("event loop lag", lags),
+        ]
+    )
+    print(
+        f"memory (MiB)       {rss_before:.0f} before, {rss_started:.0f} after start "
+        f"({(rss_started - rss_before) * 1024 / max(1, args.chats):.0f} KiB/chat), "
+        f"{rss_mib():.0f} at end, {rss_peak:.0f} peak"
+    )
+
+
+def main() -> None:
+    args = parse_args()
+    logging.basicConfig(level=args.log_level)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
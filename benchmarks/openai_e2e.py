@@ -0,0 +1,119 @@
+"""End-to-end test of the real OpenAI client path against the local stub server.
+
+Sends many concurrent requests through ChatGPTInterfaceImpl (connection pool,
+rate limiter, retries with backoff) to ai_scambaiter.mocks.openai_stub, with
+injected latency, errors and rate limits. No network access is needed.
+
+Usage: python -m benchmarks.openai_e2e --requests 200 --rate-limit-rate 0.1
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+from ai_scambaiter import GPTMessage, Role, TokenUsage, metrics
+from ai_scambaiter.chatgpt_interface import ChatGPTInterfaceImpl
+from ai_scambaiter.mocks.openai_stub import OpenAIStubServer, StubSettings
+from benchmarks.report import print_latencies, print_summary
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--streaming", type=float, default=0.5, help="fraction")
+    parser.add_argument("--prompt-messages", type=int, default=50)
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--requests-per-minute", type=int, default=100000)
+    parser.add_argument("--tokens-per-minute", type=int, default=100000000)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.05)
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--log-level", default="CRITICAL")
+    return parser.parse_args()
+
+
+async def run(args: argparse.Namespace) -> None:
+    stub = OpenAIStubServer(
+        StubSettings(
+            latency=args.latency,
+            tokens_per_second=args.tokens_per_second,
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            retry_after=args.retry_after,
+        )
+    )
+    await stub.start()
+    chatgpt = ChatGPTInterfaceImpl(
+        api_key="stub",
+        token_cache_path="",
+        requests_per_minute=str(args.requests_per_minute),
+        tokens_per_minute=str(args.tokens_per_minute),
+        max_concurrency=str(args.max_concurrency),
+        max_retries=str(args.max_retries),
+        timeout=str(args.timeout),
+        base_url=stub.base_url,
+    )
+    # Token counts are given, so the tokenizer is never loaded
+    prompt = [
+        GPTMessage(
+            content=f"Message {i} of the conversation",
+            role=Role.USER if i % 2 else Role.ASSISTANT,
+            n_tokens=12,
+        )
+        for i in range(args.prompt_messages)
+    ]
+    usage = TokenUsage()
+    latencies: list[float] = []
+    n_streamed = round(args.requests * args.streaming)
+
+    async def request(i: int) -> bool:
+        t_start = time.monotonic()
+        if i < n_streamed:
+            reply = "".join(
+                [piece async for piece in chatgpt.stream_and_receive(prompt, usage)]
+            )
+        else:
+            reply = await chatgpt.send_and_receive(prompt, usage)
+        if not reply:
+            return False
+        latencies.append(time.monotonic() - t_start)
+        return True
+
+    t_start = time.monotonic()
+    results = await asyncio.gather(*(request(i) for i in range(args.requests)))
+    elapsed = time.monotonic() - t_start
+    await stub.stop()
+
+    latencies.sort()
+    outcomes = {
+        outcome: int(metrics.llm_requests.value(outcome=outcome))
+        for outcome in ("ok", "retryable_error", "error")
+    }
+    summary = [
+        ("requests", f"{args.requests} ({n_streamed} streamed) in {elapsed:.1f}s"),
+        ("succeeded", f"{sum(results)} ({sum(results) / elapsed:.1f}/s)"),
+        ("attempts", ", ".join(f"{k} {v}" for k, v in outcomes.items())),
+        (
+            "stub responses",
+            ", ".join(f"{k}: {v}" for k, v in stub.stats.status.items()),
+        ),
+        ("connections", f"{stub.stats.connections} for {stub.stats.requests} requests"),
+        ("tokens", f"{usage.prompt_tokens} prompt, {usage.completion_tokens} reply"),
+    ]
+    print_summary(summary)
+    print_latencies([("request", latencies)])
+
+
+def main() -> None:
+    args = parse_args()
+    logging.basicConfig(level=args.log_level)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""Replays recorded traffic through the bot runner, offline and reproducibly.
+
+Record with the [recording] path option of the bot, then e.g.
+    python -m benchmarks.replay recording.jsonl.gz --speed 10
+
+The recorded messages of the other side are fed in at their original pace
+divided by speed; the model answers with the recorded replies after the recorded
+duration divided by speed. Own messages are not replayed, since the agents send
+their replies themselves. Token counting uses the real tokenizer.
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from ai_scambaiter import metrics
+from ai_scambaiter.bot_runner import BotRunnerImpl
+from ai_scambaiter.mocks.chatgpt_interface_mock import ReplayChatGPTInterfaceMock
+from ai_scambaiter.mocks.telegram_interface_mock import ReplayTelegramInterfaceMock
+from ai_scambaiter.recording import TrafficRecording
+from benchmarks.report import (
+    peak_rss_mib,
+    print_latencies,
+    print_summary,
+    rss_mib,
+    sample_loop_lag,
+    stage_latencies,
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=1.0, help="time factor")
+    parser.add_argument(
+        "--max-gap", type=float, default=60, help="longest pause in recorded seconds"
+    )
+    parser.add_argument("--own-id", type=int, help="default: guessed from senders")
+    parser.add_argument("--response-wait", type=float, default=10, help="seconds")
+    parser.add_argument("--send-latency", type=float, default=0.1, help="seconds")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument(
+        "--prefilter", action="store_true", help="skip or batch no-reply messages"
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args()
+
+
+def guess_own_id(recording: TrafficRecording) -> int:
+    """In private chats the other side has the id of the chat, so the most
+    frequent other sender is us."""
+    senders = Counter(
+        m.sender_id
+        for m in (
+            *recording.messages,
+            *(m for h in recording.histories.values() for m in h),
+        )
+        if m.sender_id is not None and m.sender_id != m.chat_id
+    )
+    if not senders:
+        raise ValueError("Cannot tell the own id from the recording, use --own-id")
+    return senders.most_common(1)[0][0]
+
+
+async def feed(
+    telegram: ReplayTelegramInterfaceMock,
+    recording: TrafficRecording,
+    own_id: int,
+    speed: float,
+    max_gap: float,
+) -> int:
+    """Delivers the recorded messages of the other side at their recorded pace."""
+    n_fed = 0
+    t_previous = recording.messages[0].t if recording.messages else 0.0
+    for message in recording.messages:
+        delay = min(max_gap, message.t - t_previous) / speed
+        t_previous = message.t
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if message.sender_id == own_id:
+            continue
+        await telegram.receive_recorded(message)
+        n_fed += 1
+    return n_fed
+
+
+async def run(args: argparse.Namespace) -> None:
+    recording = TrafficRecording.load(args.recording)
+    own_id = args.own_id if args.own_id is not None else guess_own_id(recording)
+    # Keep the traces of all replies, not only the most recent ones
+    metrics.tracer = metrics.Tracer(max_finished=10**7)
+    rss_before = rss_mib()
+
+    telegram = ReplayTelegramInterfaceMock(
+        recording, own_id, send_latency=args.send_latency / args.speed
+    )
+    chatgpt = ReplayChatGPTInterfaceMock(recording, args.speed, token_cache_path="")
+    await telegram.start()
+    runner = BotRunnerImpl(
+        message_stream=telegram.message_stream,
+        telegram_interface=telegram,
+        chatgpt_interface=chatgpt,
+        conversation_store=None,
+        conversations="\n".join(str(chat_id) for chat_id in telegram.chat_ids),
+        own_id=str(own_id),
+        agent_settings={
+            "response_wait": str(args.response_wait / args.speed),
+            "streaming": str(args.streaming),
+        },
+        prefilter_settings={"enabled": str(args.prefilter)},
+    )
+    t_start = time.monotonic()
+    cpu_start = time.process_time()
+    await runner.start()
+    startup = time.monotonic() - t_start
+    startup_cpu = time.process_time() - cpu_start
+
+    lags: list[float] = []
+    lag_task = asyncio.create_task(sample_loop_lag(lags))
+    run_task = asyncio.create_task(runner.run())
+    t_start = time.monotonic()
+    cpu_start = time.process_time()
+    n_fed = await feed(telegram, recording, own_id, args.speed, args.max_gap)
+    # Let the replies to the last messages go out
+    longest = max(
+        (d for replies in recording.completions.values() for _, d in replies),
+        default=0,
+    )
+    drain = args.response_wait + longest + args.send_latency + 1
+    await asyncio.sleep(drain / args.speed)
+    elapsed = time.monotonic() - t_start
+    cpu = time.process_time() - cpu_start
+    lag_task.cancel()
+    run_task.cancel()
+    await runner.stop()
+
+    lags.sort()
+    superseded = sum(a.usage.superseded_requests for a in runner.agents.values())
+    print_summary(
+        [
+            ("chats", f"{len(runner.agents)}, started in {startup:.2f}s"),
+            ("  startup cpu", f"{startup_cpu:.2f}s"),
+            ("messages in", f"{n_fed} of {len(recording.messages)} recorded"),
+            ("replies out", telegram.sent),
+            ("model requests", f"{chatgpt.requests} ({superseded} superseded)"),
+            ("  not recorded", chatgpt.misses),
+            ("  avoided", f"{metrics.llm_calls_avoided.value():.0f} by the pre-filter"),
+            ("replay", f"{elapsed:.1f}s, {cpu:.2f}s cpu"),
+            ("token cache", f"{chatgpt.token_cache.hits} hits"),
+        ]
+    )
+    print_latencies(
+        [
+            ("reply", stage_latencies("received", "sent")),
+            ("  dispatch", stage_latencies("received", "handled")),
+            ("  generate+send", stage_latencies("reply_started", "sent")),
+            ("event loop lag", lags),
+        ]
+    )
+    print(
+        f"{'memory (MiB)':18} {rss_before:.0f} before, {rss_mib():.0f} at end, "
+        f"{peak_rss_mib():.0f} peak"
+    )
+
+
+def main() -> None:
+    args = parse_args()
+    logging.basicConfig(level=args.log_level)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
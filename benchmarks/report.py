@@ -0,0 +1,63 @@
+"""Measurements and report formatting shared by the benchmarks."""
+
+import asyncio
+import resource
+import time
+
+from ai_scambaiter import metrics
+
+LAG_INTERVAL = 0.05
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values, NaN if there are none."""
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def rss_mib() -> float:
+    """Current resident set size, or the peak if the current one is unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 2**20
+    except OSError:
+        return peak_rss_mib()
+
+
+def peak_rss_mib() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+async def sample_loop_lag(lags: list[float]) -> None:
+    """Records how late the event loop wakes up a sleeping task."""
+    while True:
+        t_start = time.monotonic()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(time.monotonic() - t_start - LAG_INTERVAL)
+
+
+def stage_latencies(start: str, end: str) -> list[float]:
+    """Sorted times between two stages of the finished reply traces."""
+    return sorted(
+        trace[end] - trace[start]
+        for trace in metrics.tracer.finished
+        if start in trace and end in trace
+    )
+
+
+def print_summary(rows: list[tuple[str, object]]) -> None:
+    for name, value in rows:
+        print(f"{name:18} {value}")
+
+
+def print_latencies(rows: list[tuple[str, list[float]]]) -> None:
+    """Prints percentiles of sorted latencies in seconds."""
+    print(f"{'latency (s)':18} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for name, values in rows:
+        print(
+            f"{name:18} {percentile(values, 50):8.3f} {percentile(values, 95):8.3f} "
+            f"{percentile(values, 99):8.3f} "
+            f"{values[-1] if values else float('nan'):8.3f}"
+        )
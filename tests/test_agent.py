@@ -0,0 +1,187 @@
+import asyncio
+import itertools
+import threading
+import time
+
+import pytest
+
+from ai_scambaiter import agent as agent_module
+from ai_scambaiter import metrics
+from ai_scambaiter.agent import Agent, AgentSettings
+from ai_scambaiter.conversation_store import ConversationStoreImpl
+from ai_scambaiter.ingress import make_message
+from ai_scambaiter.mocks.chatgpt_interface_mock import LatencyChatGPTInterfaceMock
+from ai_scambaiter.mocks.telegram_interface_mock import ScaledTelegramInterfaceMock
+from ai_scambaiter.prefilter import Decision
+
+OWN_ID = 1
+_message_ids = itertools.count(1000)
+
+
+def chatgpt(latency=0.0):
+    return LatencyChatGPTInterfaceMock(
+        latency=latency, latency_sigma=0, tokens_per_second=1000, reply_tokens=3
+    )
+
+
+async def start_agent(chatgpt_interface=None, store=None, history_length=0, **settings):
+    telegram = ScaledTelegramInterfaceMock(1, OWN_ID, history_length=history_length)
+    await telegram.start()
+    agent = Agent(
+        telegram.chat_ids[0],
+        OWN_ID,
+        telegram,
+        chatgpt_interface or chatgpt(),
+        store,
+        AgentSettings.from_config({k: str(v) for k, v in settings.items()}),
+    )
+    await agent.start()
+    return agent, telegram
+
+
+def from_scammer(agent, text):
+    return make_message(agent.chat_id, next(_message_ids), agent.chat_id, text)
+
+
+def test_avoided_calls_are_counted_against_the_debounce():
+    async def main():
+        agent, telegram = await start_agent(response_wait=0.05)
+        before = metrics.llm_calls_avoided.value()
+        await agent.receive_message(from_scammer(agent, "ok"), Decision.SKIP)
+        await asyncio.sleep(0.1)
+        # Without pre-filter, "ok" would have been answered by now
+        await agent.receive_message(from_scammer(agent, "How are you?"))
+        # Answered by the pending reply, as it would be without pre-filter
+        await agent.receive_message(from_scammer(agent, "ok"), Decision.BATCH, 10)
+        await asyncio.sleep(0.1)
+        await agent.stop()
+        return metrics.llm_calls_avoided.value() - before, telegram.sent
+
+    avoided, sent = asyncio.run(main())
+    assert avoided == 1
+    assert sent == 1
+
+
+class ThreadCheckingStore(ConversationStoreImpl):
+    def __init__(self, path):
+        super().__init__(path)
+        self.threads = set()
+
+    def add(self, *args):
+        self.threads.add(threading.current_thread())
+        super().add(*args)
+
+
+def test_messages_are_stored_off_the_loop_in_order(tmp_path):
+    async def main():
+        store = ThreadCheckingStore(str(tmp_path / "conversations.db"))
+        agent, _ = await start_agent(store=store, response_wait=10)
+        await agent.receive_message(from_scammer(agent, "Hello"))
+        own_id = next(_message_ids)
+        await agent.receive_message(make_message(agent.chat_id, own_id, OWN_ID, "Hi"))
+        # Runs after the message it removes was written
+        agent.remove_last_assistant_message()
+        await agent.receive_message(from_scammer(agent, "Still there?"))
+        await agent.stop()
+        return store, agent.chat_id
+
+    store, chat_id = asyncio.run(main())
+    assert store.threads and threading.main_thread() not in store.threads
+    assert [m.content for _, m in store.load(chat_id, 10)] == ["Hello", "Still there?"]
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_reply_to_older_messages_is_not_sent(streaming):
+    async def main():
+        agent, telegram = await start_agent(
+            chatgpt(latency=0.1), response_wait=10, streaming=streaming
+        )
+        await agent.receive_message(from_scammer(agent, "Hello"))
+        # Started outside the scheduler, so the newer message cannot cancel it
+        reply = asyncio.create_task(agent._send_reply())
+        await asyncio.sleep(0.05)
+        await agent.receive_message(from_scammer(agent, "Are you there?"))
+        await reply
+        await agent.stop()
+        return agent.usage, telegram.sent
+
+    usage, sent = asyncio.run(main())
+    assert sent == 0
+    assert usage.superseded_requests == 1
+    assert usage.superseded_tokens > 0
+
+
+def test_newer_message_cancels_the_running_reply():
+    async def main():
+        agent, telegram = await start_agent(chatgpt(latency=0.1), response_wait=0.01)
+        await agent.receive_message(from_scammer(agent, "Hello"))
+        await asyncio.sleep(0.05)
+        await agent.receive_message(from_scammer(agent, "Are you there?"))
+        await asyncio.sleep(0.3)
+        await agent.stop()
+        return agent.usage, telegram.sent
+
+    usage, sent = asyncio.run(main())
+    assert sent == 1
+    assert usage.superseded_requests == 1
+    assert usage.requests == 1
+
+
+class FailingChatGPT(LatencyChatGPTInterfaceMock):
+    async def send_and_receive(self, messages, usage=None, params=None):
+        self.requests += 1
+        return None
+
+
+async def fill_history(agent, n_messages):
+    for i in range(n_messages):
+        await agent.receive_message(from_scammer(agent, f"This is message {i}."))
+    # Lets the summary task finish
+    await asyncio.sleep(0.05)
+
+
+def test_failed_summary_is_retried_with_backoff(monkeypatch):
+    monkeypatch.setattr(
+        agent_module, "backoff_delay", lambda attempt, **_: 60.0 * 2**attempt
+    )
+
+    async def main():
+        failing = FailingChatGPT(latency=0)
+        agent, _ = await start_agent(
+            failing, response_wait=100, summary_budget=20, summary_keep=10
+        )
+        await fill_history(agent, 10)
+        first = (failing.requests, agent._summary_retry_at - time.monotonic())
+        # The backoff is over
+        agent._summary_retry_at = 0.0
+        await fill_history(agent, 1)
+        second = (failing.requests, agent._summary_retry_at - time.monotonic())
+        await agent.stop()
+        return first, second
+
+    (n_first, delay_first), (n_second, delay_second) = asyncio.run(main())
+    assert n_first == 1
+    assert 59 < delay_first <= 60
+    assert n_second == 2
+    assert 119 < delay_second <= 120
+
+
+def test_summary_is_restored_after_restart(tmp_path):
+    async def main():
+        store = ConversationStoreImpl(str(tmp_path / "conversations.db"))
+        settings = dict(response_wait=100, summary_budget=20, summary_keep=10)
+        agent, _ = await start_agent(store=store, **settings)
+        await fill_history(agent, 10)
+        await agent.stop()
+        summary = agent._summary
+        kept = list(agent._chatgpt_history.items())
+        restarted, _ = await start_agent(store=store, **settings)
+        await restarted.stop()
+        return summary, kept, restarted
+
+    summary, kept, restarted = asyncio.run(main())
+    assert summary is not None
+    assert 0 < len(kept) < 10
+    assert restarted._summary == summary
+    # Only the messages after the summary are loaded
+    assert list(restarted._chatgpt_history.items()) == kept
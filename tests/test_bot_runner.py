@@ -0,0 +1,109 @@
+import asyncio
+from types import SimpleNamespace
+
+from ai_scambaiter import bot_runner, metrics
+from ai_scambaiter.bot_runner import BotRunnerImpl
+
+
+class SlowAgent:
+    """Handles the messages of its chat one at a time, each until released."""
+
+    def __init__(self, chat_id, *args):
+        self.chat_id = int(chat_id)
+        self.title = str(chat_id)
+        self.received = []
+        self.release = asyncio.Event()
+        self.release.set()
+        self.stopped = False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        self.stopped = True
+
+    async def receive_message(self, message, decision, batch_wait):
+        await self.release.wait()
+        self.received.append(message.id)
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.messages = asyncio.Queue()
+
+    def set_monitored_chats(self, chat_ids):
+        pass
+
+    async def message_stream(self):
+        while True:
+            yield await self.messages.get()
+
+
+def message(message_id, chat_id):
+    return SimpleNamespace(id=message_id, chat_id=chat_id, sender_id=chat_id, text="")
+
+
+async def start_runner(monkeypatch, **settings):
+    monkeypatch.setattr(bot_runner, "Agent", SlowAgent)
+    telegram = FakeTelegram()
+    runner = BotRunnerImpl(
+        telegram.message_stream, telegram, None, None, "1\n2", "99", **settings
+    )
+    await runner.start()
+    runner.agents[1].release.clear()
+    return runner, telegram, asyncio.create_task(runner.run())
+
+
+def test_full_inbox_does_not_hold_up_other_chats(monkeypatch):
+    async def main():
+        runner, telegram, run = await start_runner(
+            monkeypatch, inbox_size="2", inbox_policy="block"
+        )
+        for i in range(10):
+            telegram.messages.put_nowait(message(i, 1))
+        telegram.messages.put_nowait(message(100, 2))
+        await asyncio.sleep(0.05)
+        other = list(runner.agents[2].received)
+        runner.agents[1].release.set()
+        await asyncio.sleep(0.05)
+        run.cancel()
+        await runner.stop()
+        return other, runner.agents[1].received, runner.inbox_drops
+
+    other, slow, drops = asyncio.run(main())
+    assert other == [100]
+    # Nothing is lost, and the order is kept
+    assert slow == list(range(10))
+    assert drops == {}
+
+
+def test_drop_oldest(monkeypatch):
+    async def main():
+        runner, telegram, run = await start_runner(
+            monkeypatch, inbox_size="2", inbox_policy="drop_oldest"
+        )
+        for i in range(10):
+            telegram.messages.put_nowait(message(i, 1))
+        await asyncio.sleep(0.05)
+        runner.agents[1].release.set()
+        await asyncio.sleep(0.05)
+        run.cancel()
+        await runner.stop()
+        return runner.agents[1].received, runner.inbox_drops
+
+    received, drops = asyncio.run(main())
+    assert received == [8, 9]
+    assert drops == {1: 8}
+
+
+def test_stop_removes_the_metrics_collector(monkeypatch):
+    async def main():
+        runner, _, run = await start_runner(monkeypatch)
+        run.cancel()
+        n_collectors = len(metrics.registry._collectors)
+        await runner.stop()
+        return runner, n_collectors - len(metrics.registry._collectors)
+
+    runner, n_removed = asyncio.run(main())
+    assert n_removed == 1
+    assert all(agent.stopped for agent in runner.agents.values())
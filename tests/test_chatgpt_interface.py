@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from ai_scambaiter import GPTMessage, IncompleteReplyError, Role, TokenUsage
+from ai_scambaiter.chatgpt_interface import ChatGPTInterfaceImpl
+from ai_scambaiter.mocks.openai_stub import OpenAIStubServer, StubSettings
+
+# Token counts are given, so the tokenizer is never loaded
+PROMPT = [GPTMessage(content="Hello, how are you?", role=Role.USER, n_tokens=10)]
+
+
+async def with_stub(finish_reason, request):
+    stub = OpenAIStubServer(
+        StubSettings(latency=0.01, tokens_per_second=1000, finish_reason=finish_reason)
+    )
+    await stub.start()
+    try:
+        chatgpt = ChatGPTInterfaceImpl(
+            api_key="stub", token_cache_path="", base_url=stub.base_url
+        )
+        return await request(chatgpt)
+    finally:
+        await stub.stop()
+
+
+async def stream(chatgpt, usage=None):
+    return "".join([piece async for piece in chatgpt.stream_and_receive(PROMPT, usage)])
+
+
+def test_complete_reply():
+    async def request(chatgpt):
+        return await chatgpt.send_and_receive(PROMPT), await stream(chatgpt)
+
+    reply, streamed = asyncio.run(with_stub("stop", request))
+    assert reply.startswith("Reply to: Hello")
+    assert streamed == reply
+
+
+def test_cut_off_reply_is_not_returned():
+    async def request(chatgpt):
+        return await chatgpt.send_and_receive(PROMPT)
+
+    assert asyncio.run(with_stub("length", request)) is None
+
+
+def test_cut_off_stream_raises_after_the_usage():
+    usage = TokenUsage()
+
+    async def request(chatgpt):
+        with pytest.raises(IncompleteReplyError):
+            await stream(chatgpt, usage)
+
+    asyncio.run(with_stub("content_filter", request))
+    assert usage.completion_tokens > 0
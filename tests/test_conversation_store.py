@@ -0,0 +1,43 @@
+import pytest
+
+from ai_scambaiter import GPTMessage, Role
+from ai_scambaiter.conversation_store import ConversationStoreImpl
+
+
+def gpt(content, role=Role.USER):
+    return GPTMessage(content=content, role=role, n_tokens=len(content))
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ConversationStoreImpl(str(tmp_path / "conversations.db"))
+
+
+def test_last_messages_are_loaded_oldest_first(store):
+    store.add_many(1, [(i, gpt(f"Message {i}")) for i in range(10)])
+    store.add(2, 3, gpt("Other chat"))
+    loaded = store.load(1, 3)
+    assert [message_id for message_id, _ in loaded] == [7, 8, 9]
+    assert loaded[-1][1] == gpt("Message 9")
+
+
+def test_messages_are_stored_once(store):
+    store.add(1, 5, gpt("First"))
+    store.add(1, 5, gpt("Again"))
+    assert store.load(1, 10) == [(5, gpt("First"))]
+
+
+def test_remove_last_of_role(store):
+    store.add_many(
+        1,
+        [(1, gpt("Hi")), (2, gpt("Hello", Role.ASSISTANT)), (3, gpt("How are you?"))],
+    )
+    store.remove_last(1, Role.ASSISTANT)
+    assert [m.content for _, m in store.load(1, 10)] == ["Hi", "How are you?"]
+
+
+def test_summary_is_replaced(store):
+    assert store.load_summary(1) is None
+    store.save_summary(1, 10, gpt("Old", Role.SYSTEM))
+    store.save_summary(1, 20, gpt("New", Role.SYSTEM))
+    assert store.load_summary(1) == (20, gpt("New", Role.SYSTEM))
@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import pytest
+
+from ai_scambaiter import bot_runner
+from ai_scambaiter.bot_runner import BotRunnerImpl
+from ai_scambaiter.conversation_store import ConversationStoreImpl
+
+
+class FakeAgent:
+    def __init__(self, chat_id, *args):
+        self.chat_id = int(chat_id)
+        self.restored = {}
+
+    async def start(self):
+        pass
+
+    def restore_deadline(self, kind, delay):
+        self.restored[kind] = delay
+
+
+class FakeTelegram:
+    def set_monitored_chats(self, chat_ids):
+        self.monitored = list(chat_ids)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ConversationStoreImpl(str(tmp_path / "conversations.db"))
+
+
+def start_runner(store, chats, monkeypatch, catch_up_ramp="60"):
+    monkeypatch.setattr(bot_runner, "Agent", FakeAgent)
+    runner = BotRunnerImpl(
+        None,
+        FakeTelegram(),
+        None,
+        store,
+        "\n".join(str(chat) for chat in chats),
+        "1",
+        catch_up_ramp=catch_up_ramp,
+    )
+    asyncio.run(runner.start())
+    return runner
+
+
+def test_store_keeps_deadlines_of_other_chats(store):
+    store.save_deadlines({(1, "reply"): 10.0, (2, "silence"): 20.0})
+    store.save_deadlines({(1, "silence"): 30.0}, chat_ids=[1])
+    assert store.load_deadlines() == {(1, "silence"): 30.0, (2, "silence"): 20.0}
+    store.save_deadlines({})
+    assert store.load_deadlines() == {}
+
+
+def test_future_deadlines_keep_their_time(store, monkeypatch):
+    now = time.time()
+    store.save_deadlines({(5, "reply"): now + 100, (5, "silence"): now + 3600})
+    runner = start_runner(store, [5], monkeypatch)
+    restored = runner.agents[5].restored
+    assert 99 < restored["reply"] <= 100
+    assert 3599 < restored["silence"] <= 3600
+
+
+def test_overdue_deadlines_are_spread_over_the_ramp(store, monkeypatch):
+    now = time.time()
+    store.save_deadlines(
+        {(2, "reply"): now - 10, (3, "reply"): now - 30, (4, "silence"): now - 20}
+    )
+    runner = start_runner(store, [2, 3, 4], monkeypatch, catch_up_ramp="30")
+    # Oldest first
+    assert runner.agents[3].restored == {"reply": 0}
+    assert runner.agents[4].restored == {"silence": 10}
+    assert runner.agents[2].restored == {"reply": 20}
+
+
+def test_chats_without_checkpoint_get_no_deadline(store, monkeypatch):
+    store.save_deadlines({(2, "reply"): time.time() + 50})
+    runner = start_runner(store, [2, 3], monkeypatch)
+    assert set(runner.agents[2].restored) == {"reply"}
+    assert runner.agents[3].restored == {}
@@ -0,0 +1,75 @@
+import asyncio
+from types import SimpleNamespace
+
+from telethon.tl.types import InputPeerUser, User
+
+from ai_scambaiter.dialogs import DialogRegistry
+
+
+class FakeClient:
+    def __init__(self, users=(), dialogs=()):
+        self.users = {user.id: user for user in users}
+        # Newest first, like telegram sorts the dialog list
+        self.dialogs = list(dialogs)
+        self.n_listed = 0
+
+    async def get_entity(self, chat_id):
+        if chat_id not in self.users:
+            raise ValueError(f"Unknown {chat_id}")
+        return self.users[chat_id]
+
+    async def iter_dialogs(self):
+        for dialog in self.dialogs:
+            self.n_listed += 1
+            yield dialog
+
+
+def dialog(chat_id, title, top_message):
+    return SimpleNamespace(
+        id=chat_id,
+        title=title,
+        message=SimpleNamespace(id=top_message),
+        pinned=False,
+        input_entity=InputPeerUser(chat_id, chat_id * 10),
+    )
+
+
+def test_chat_is_fetched_without_the_dialog_list():
+    client = FakeClient(users=[User(5, access_hash=50, first_name="Anna")])
+    registry = DialogRegistry(client)
+    entry = asyncio.run(registry.resolve("5"))
+    assert (entry.id, entry.title) == (5, "Anna")
+    assert entry.entity == InputPeerUser(5, 50)
+    assert client.n_listed == 0
+
+
+def test_unknown_title_is_looked_up_in_the_dialog_list():
+    client = FakeClient(dialogs=[dialog(6, "Bob", 3), dialog(7, "Carl", 2)])
+    registry = DialogRegistry(client)
+    entry = asyncio.run(registry.resolve("Carl"))
+    assert entry.id == 7
+    assert registry.lookup("Bob").id == 6
+
+
+def test_refresh_stops_at_the_first_unchanged_dialog():
+    client = FakeClient(
+        dialogs=[dialog(1, "A", 10), dialog(2, "B", 5), dialog(3, "C", 3)]
+    )
+    registry = DialogRegistry(client)
+    assert asyncio.run(registry.refresh()) == 3
+    client.dialogs[0] = dialog(1, "A", 11)
+    client.n_listed = 0
+    assert asyncio.run(registry.refresh()) == 1
+    assert client.n_listed == 2
+    assert registry.get(1).top_message == 11
+    assert asyncio.run(registry.refresh(full=True)) == 3
+
+
+def test_dialogs_are_kept_between_runs(tmp_path):
+    path = str(tmp_path / "dialogs.db")
+    client = FakeClient(dialogs=[dialog(6, "Bob", 3)])
+    asyncio.run(DialogRegistry(client, path).refresh())
+    # Known without any request
+    entry = DialogRegistry(None, path).lookup("Bob")
+    assert (entry.id, entry.top_message) == (6, 3)
+    assert entry.entity == InputPeerUser(6, 60)
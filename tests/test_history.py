@@ -0,0 +1,131 @@
+import pytest
+
+from ai_scambaiter import GPTMessage, Role
+from ai_scambaiter.history import ChatHistory
+
+
+def message(content, role=Role.USER, n_tokens=None):
+    return GPTMessage(
+        content=content,
+        role=role,
+        n_tokens=n_tokens if n_tokens is not None else len(content),
+    )
+
+
+def to_param(m):
+    return {"role": m.role.name.lower(), "content": m.content}
+
+
+def test_append_keeps_order_and_token_total():
+    history = ChatHistory()
+    assert not history
+    history.append(message("a"))
+    history.append(message("bb", Role.ASSISTANT))
+    history.append(message("ccc"))
+    assert len(history) == 3
+    assert history.n_tokens == 6
+    assert [m.content for m in history] == ["a", "bb", "ccc"]
+
+
+def test_pop_oldest():
+    history = ChatHistory()
+    history.append(message("a"))
+    history.append(message("bb"))
+    assert history.oldest().content == "a"
+    assert history.pop_oldest().content == "a"
+    assert history.n_tokens == 2
+    assert history.pop_oldest().content == "bb"
+    assert history.oldest() is None
+    with pytest.raises(IndexError):
+        history.pop_oldest()
+
+
+def test_remove_last_assistant_message():
+    history = ChatHistory()
+    history.append(message("hi"))
+    history.append(message("first", Role.ASSISTANT))
+    history.append(message("question"))
+    history.append(message("second", Role.ASSISTANT))
+    history.append(message("later"))
+    assert history.remove_last_assistant_message().content == "second"
+    assert history.remove_last_assistant_message().content == "first"
+    assert history.remove_last_assistant_message() is None
+    assert [m.content for m in history] == ["hi", "question", "later"]
+    assert history.n_tokens == len("hiquestionlater")
+
+
+def test_removed_message_at_front_is_skipped():
+    history = ChatHistory()
+    history.append(message("answer", Role.ASSISTANT))
+    history.append(message("next"))
+    history.remove_last_assistant_message()
+    assert history.oldest().content == "next"
+    assert history.pop_oldest().content == "next"
+    assert not history
+
+
+def test_evicted_assistant_message_is_not_removed_again():
+    history = ChatHistory()
+    history.append(message("answer", Role.ASSISTANT))
+    history.append(message("user"))
+    history.pop_oldest()
+    assert history.remove_last_assistant_message() is None
+    assert [m.content for m in history] == ["user"]
+
+
+def test_last():
+    history = ChatHistory()
+    for content in "abcde":
+        history.append(
+            message(content, Role.ASSISTANT if content == "d" else Role.USER)
+        )
+    history.remove_last_assistant_message()
+    assert [m.content for m in history.last(2)] == ["c", "e"]
+    assert [m.content for m in history.last(10)] == ["a", "b", "c", "e"]
+    assert history.last(0) == []
+
+
+def test_params_follow_the_messages():
+    history = ChatHistory(to_param)
+    assert history.keeps_params
+    history.append(message("a"))
+    history.append(message("b", Role.ASSISTANT))
+    history.append(message("c"))
+    history.append(message("d", Role.ASSISTANT))
+    history.remove_last_assistant_message()
+    history.remove_last_assistant_message()
+    assert history.params() == [to_param(m) for m in history]
+    history.pop_oldest()
+    assert history.params() == [{"role": "user", "content": "c"}]
+
+
+def test_params_require_converter():
+    history = ChatHistory()
+    assert not history.keeps_params
+    with pytest.raises(RuntimeError):
+        history.params()
+
+
+def test_ids_follow_the_messages():
+    history = ChatHistory(keep_ids=True)
+    history.append(message("a"), 1)
+    history.append(message("b", Role.ASSISTANT), 2)
+    history.append(message("c"), 3)
+    history.remove_last_assistant_message()
+    assert [(i, m.content) for i, m in history.items()] == [(1, "a"), (3, "c")]
+    history.pop_oldest()
+    assert [i for i, _ in history.items()] == [3]
+
+
+def test_clear():
+    history = ChatHistory(to_param, keep_ids=True)
+    history.append(message("a", Role.ASSISTANT), 1)
+    history.append(message("b"), 2)
+    history.clear()
+    assert not history
+    assert history.n_tokens == 0
+    assert history.params() == []
+    assert list(history.items()) == []
+    assert history.remove_last_assistant_message() is None
+    history.append(message("c", Role.ASSISTANT), 3)
+    assert history.remove_last_assistant_message().content == "c"
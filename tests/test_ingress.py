@@ -0,0 +1,176 @@
+import asyncio
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+from telethon.tl.custom import Message
+from telethon.tl.types import MessageFwdHeader, PeerUser
+
+from ai_scambaiter.ingress import IngressBuffer
+
+
+def message(message_id, chat_id):
+    return SimpleNamespace(
+        id=message_id, chat_id=chat_id, sender_id=chat_id, text=f"text {message_id}"
+    )
+
+
+async def drain(buffer):
+    return [(await buffer.get()).id for _ in range(buffer.depth)]
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        IngressBuffer(policy="unknown")
+
+
+def test_unmonitored_chats_are_filtered():
+    async def main():
+        buffer = IngressBuffer(maxsize=10)
+        buffer.set_monitored_chats([1])
+        await buffer.put(message(1, 1))
+        await buffer.put(message(2, 2))
+        return await drain(buffer), buffer.stats
+
+    ids, stats = asyncio.run(main())
+    assert ids == [1]
+    assert stats["filtered"] == 1
+
+
+def test_drop_oldest():
+    async def main():
+        buffer = IngressBuffer(maxsize=2, policy="drop_oldest")
+        for i in range(4):
+            await buffer.put(message(i, 1))
+        return await drain(buffer), buffer.stats
+
+    ids, stats = asyncio.run(main())
+    assert ids == [2, 3]
+    assert stats["dropped"] == 2
+    assert stats["high_water_mark"] == 2
+
+
+def test_drop_unmonitored_keeps_configured_chats(tmp_path):
+    async def main():
+        buffer = IngressBuffer(
+            maxsize=3,
+            policy="drop_unmonitored",
+            spill_path=str(tmp_path / "spill.bin"),
+            monitored_chats=[1],
+        )
+        await buffer.put(message(1, 1))
+        for i in range(3):
+            await buffer.put(message(10 + i, 999))
+        await buffer.put(message(2, 1))
+        return await drain(buffer), buffer.stats
+
+    ids, stats = asyncio.run(main())
+    assert ids == [1, 12, 2]
+    assert stats["dropped"] == 2
+
+
+def test_drop_unmonitored_spills_when_all_may_be_monitored(tmp_path):
+    async def main():
+        buffer = IngressBuffer(
+            maxsize=2, policy="drop_unmonitored", spill_path=str(tmp_path / "s.bin")
+        )
+        for i in range(5):
+            await buffer.put(message(i, i))
+        return await drain(buffer), buffer.stats
+
+    ids, stats = asyncio.run(main())
+    assert ids == [0, 1, 2, 3, 4]
+    assert stats["dropped"] == 0
+    assert stats["spilled"] == 3
+
+
+def test_drop_unmonitored_after_monitored_chats_are_set(tmp_path):
+    async def main():
+        buffer = IngressBuffer(
+            maxsize=2, policy="drop_unmonitored", spill_path=str(tmp_path / "s.bin")
+        )
+        await buffer.put(message(1, 5))
+        await buffer.put(message(2, 1))
+        buffer.set_monitored_chats([1])
+        await buffer.put(message(3, 1))
+        return await drain(buffer)
+
+    assert asyncio.run(main()) == [2, 3]
+
+
+def test_spill_keeps_order(tmp_path):
+    path = tmp_path / "spill.bin"
+
+    async def main():
+        buffer = IngressBuffer(maxsize=2, policy="spill", spill_path=str(path))
+        for i in range(6):
+            await buffer.put(message(i, 1))
+        assert buffer.depth == 6
+        first = [(await buffer.get()).id for _ in range(3)]
+        await buffer.put(message(6, 1))
+        return first + await drain(buffer), buffer.stats
+
+    ids, stats = asyncio.run(main())
+    assert ids == list(range(7))
+    assert stats["spilled"] == 5
+    assert not path.exists()
+
+
+def test_spill_forwarded_message(tmp_path):
+    connection = sqlite3.connect(":memory:")
+    forwarded = Message(
+        3,
+        peer_id=PeerUser(7),
+        from_id=PeerUser(7),
+        fwd_from=MessageFwdHeader(date=None, from_id=PeerUser(8)),
+        message="Send the money here",
+    )
+    # Like a message from telethon, referencing its client and sqlite session
+    client = SimpleNamespace(parse_mode=None, session=connection)
+    forwarded._client = client
+    forwarded._forward = SimpleNamespace(_client=client)
+
+    async def main():
+        buffer = IngressBuffer(
+            maxsize=1, policy="spill", spill_path=str(tmp_path / "s.bin")
+        )
+        await buffer.put(message(1, 7))
+        await buffer.put(forwarded)
+        return [await buffer.get() for _ in range(2)], buffer.stats
+
+    (first, restored), stats = asyncio.run(main())
+    assert stats["spilled"] == 1
+    assert first.id == 1
+    assert (restored.chat_id, restored.id, restored.sender_id, restored.text) == (
+        7,
+        3,
+        7,
+        "Send the money here",
+    )
+
+
+def test_block_waits_for_space():
+    async def main():
+        buffer = IngressBuffer(maxsize=1, policy="block")
+        await buffer.put(message(1, 1))
+        put = asyncio.create_task(buffer.put(message(2, 1)))
+        await asyncio.sleep(0.01)
+        assert not put.done()
+        first = await buffer.get()
+        await asyncio.wait_for(put, 1)
+        second = await buffer.get()
+        return first.id, second.id
+
+    assert asyncio.run(main()) == (1, 2)
+
+
+def test_may_be_monitored():
+    buffer = IngressBuffer()
+    assert buffer.may_be_monitored(5)
+    buffer = IngressBuffer(monitored_chats=[1])
+    assert buffer.may_be_monitored(1)
+    assert not buffer.may_be_monitored(5)
+    assert buffer.accepts(5)
+    buffer.set_monitored_chats([5])
+    assert buffer.may_be_monitored(5)
+    assert not buffer.accepts(1)
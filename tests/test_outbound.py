@@ -0,0 +1,231 @@
+import asyncio
+import time
+
+import pytest
+from telethon import errors
+
+from ai_scambaiter.outbound import OutboundQueue, split_message
+
+
+class FakeSender:
+    """Records sent messages; errors[text] are raised for the first attempts."""
+
+    def __init__(self, errors_by_text=None, latency=0.0):
+        self.errors = {k: list(v) for k, v in (errors_by_text or {}).items()}
+        self.latency = latency
+        self.attempts = []
+        self.sent = []
+        self.start = time.monotonic()
+
+    async def __call__(self, chat_id, text):
+        self.attempts.append((chat_id, text))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        pending = self.errors.get(text)
+        if pending:
+            raise pending.pop(0)
+        self.sent.append((chat_id, text, time.monotonic() - self.start))
+
+
+def queue(send, **settings):
+    defaults = {"send_rate": "100", "chat_interval": "0", "max_retries": "3"}
+    return OutboundQueue(send, **{**defaults, **settings})
+
+
+def test_split_message_short_text():
+    assert split_message("  hello  ", 100) == ["hello"]
+    assert split_message("", 100) == []
+
+
+def test_split_message_prefers_line_breaks():
+    text = "first line\n" + "x " * 20
+    parts = split_message(text, 30)
+    assert parts[0] == "first line"
+    assert all(len(p) <= 30 for p in parts)
+
+
+def test_split_message_at_sentence_end():
+    text = "This is one sentence. This is another one that is long."
+    parts = split_message(text, 30)
+    assert parts[0] == "This is one sentence."
+    assert " ".join(parts) == text
+
+
+def test_split_message_at_space():
+    parts = split_message("word " * 20, 22)
+    assert all(len(p) <= 22 for p in parts)
+    assert all(not p.startswith(" ") and not p.endswith(" ") for p in parts)
+    assert " ".join(parts).split() == ["word"] * 20
+
+
+def test_split_message_without_break_points():
+    parts = split_message("x" * 25, 10)
+    assert parts == ["x" * 10, "x" * 10, "x" * 5]
+
+
+def test_split_message_ignores_breaks_near_the_start():
+    # A part shorter than a quarter of the limit is not cut off
+    parts = split_message("ab " + "x" * 40, 20)
+    assert parts[0] == "ab " + "x" * 17
+
+
+def test_messages_of_a_chat_are_sent_in_order():
+    async def main():
+        send = FakeSender(latency=0.01)
+        outbound = queue(send)
+        results = await asyncio.gather(
+            *(outbound.send(1, f"message {i}") for i in range(5))
+        )
+        return results, send.sent, outbound.depth
+
+    results, sent, depth = asyncio.run(main())
+    assert results == [True] * 5
+    assert [text for _, text, _ in sent] == [f"message {i}" for i in range(5)]
+    assert depth == 0
+
+
+def test_long_message_is_sent_in_parts():
+    async def main():
+        send = FakeSender()
+        outbound = queue(send, split_length="20")
+        assert await outbound.send(1, "word " * 12)
+        return send.sent
+
+    sent = asyncio.run(main())
+    assert len(sent) == 3
+    assert all(len(text) <= 20 for _, text, _ in sent)
+
+
+def test_flood_wait_pauses_all_chats():
+    async def main():
+        send = FakeSender({"first": [errors.FloodWaitError(request=None, capture=1)]})
+        outbound = queue(send)
+        first = asyncio.create_task(outbound.send(1, "first"))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(outbound.send(2, "second"))
+        return await asyncio.gather(first, second), send
+
+    results, send = asyncio.run(main())
+    assert results == [True, True]
+    assert send.attempts.count((1, "first")) == 2
+    times = {text: t for _, text, t in send.sent}
+    assert times["first"] >= 1
+    assert times["second"] >= 1
+
+
+def test_slow_mode_delays_only_its_chat():
+    async def main():
+        send = FakeSender({"slow": [errors.SlowModeWaitError(request=None, capture=1)]})
+        outbound = queue(send)
+        return (
+            await asyncio.gather(outbound.send(1, "slow"), outbound.send(2, "fast")),
+            send,
+        )
+
+    results, send = asyncio.run(main())
+    assert results == [True, True]
+    times = {text: t for _, text, t in send.sent}
+    assert times["slow"] >= 1
+    assert times["fast"] < 0.5
+
+
+def test_transient_errors_are_retried():
+    async def main():
+        send = FakeSender({"hello": [ConnectionError("lost"), ConnectionError("lost")]})
+        outbound = queue(send)
+        return await outbound.send(1, "hello"), send
+
+    result, send = asyncio.run(main())
+    assert result is True
+    assert len(send.attempts) == 3
+    assert len(send.sent) == 1
+
+
+def test_permanent_error_drops_the_rest_of_the_message():
+    async def main():
+        send = FakeSender(
+            {"word word word": [errors.ChatWriteForbiddenError(request=None)]}
+        )
+        outbound = queue(send, split_length="15")
+        with pytest.raises(errors.ChatWriteForbiddenError):
+            await outbound.send(1, "word word word word word")
+        assert await outbound.send(1, "next")
+        return send
+
+    send = asyncio.run(main())
+    assert [text for _, text, _ in send.sent] == ["next"]
+
+
+def test_retries_are_limited():
+    async def main():
+        send = FakeSender({"hello": [ConnectionError("lost")] * 10})
+        outbound = queue(send, max_retries="2")
+        with pytest.raises(ConnectionError):
+            await outbound.send(1, "hello")
+        return send
+
+    assert len(asyncio.run(main()).attempts) == 3
+
+
+def test_replace_drops_queued_replies():
+    async def main():
+        send = FakeSender(latency=0.05)
+        outbound = queue(send)
+        first = asyncio.create_task(outbound.send(1, "first", replace=True))
+        await asyncio.sleep(0.01)
+        # "first" is being sent and cannot be replaced any more
+        queued = asyncio.create_task(outbound.send(1, "outdated", replace=True))
+        newer = asyncio.create_task(outbound.send(1, "newer", replace=True))
+        return await asyncio.gather(first, queued, newer), send
+
+    results, send = asyncio.run(main())
+    assert results == [True, False, True]
+    assert [text for _, text, _ in send.sent] == ["first", "newer"]
+
+
+def test_replace_keeps_other_messages():
+    async def main():
+        send = FakeSender(latency=0.05)
+        outbound = queue(send)
+        first = asyncio.create_task(outbound.send(1, "first", replace=True))
+        await asyncio.sleep(0.01)
+        operator = asyncio.create_task(outbound.send(1, "from the operator"))
+        queued = asyncio.create_task(outbound.send(1, "outdated", replace=True))
+        newer = asyncio.create_task(outbound.send(1, "newer", replace=True))
+        return await asyncio.gather(first, operator, queued, newer), send
+
+    results, send = asyncio.run(main())
+    assert results == [True, True, False, True]
+    assert [text for _, text, _ in send.sent] == [
+        "first",
+        "from the operator",
+        "newer",
+    ]
+
+
+def test_replace_keeps_partly_sent_reply():
+    async def main():
+        send = FakeSender()
+        # Parts after the first wait like a human typing them
+        outbound = queue(send, split_length="20", typing_speed="100")
+        old = asyncio.create_task(outbound.send(1, "word " * 12, replace=True))
+        await asyncio.sleep(0.05)
+        new = asyncio.create_task(outbound.send(1, "short reply", replace=True))
+        return await asyncio.gather(old, new), send
+
+    results, send = asyncio.run(main())
+    assert results == [True, True]
+    texts = [text for _, text, _ in send.sent]
+    assert " ".join(texts[:-1]) == ("word " * 12).strip()
+    assert texts[-1] == "short reply"
+
+
+def test_chat_interval():
+    async def main():
+        send = FakeSender()
+        outbound = queue(send, chat_interval="0.1")
+        await asyncio.gather(outbound.send(1, "a"), outbound.send(1, "b"))
+        return send.sent
+
+    sent = asyncio.run(main())
+    assert sent[1][2] - sent[0][2] >= 0.1
@@ -0,0 +1,116 @@
+import json
+
+import pytest
+
+from ai_scambaiter import prefilter
+from ai_scambaiter.prefilter import (
+    Decision,
+    Prefilter,
+    PrefilterSettings,
+    ReplyModel,
+    features,
+)
+
+
+def make_prefilter(**values):
+    return Prefilter(
+        PrefilterSettings.from_config(
+            {"enabled": "true", **{k: str(v) for k, v in values.items()}}
+        )
+    )
+
+
+def test_settings_from_config():
+    settings = PrefilterSettings.from_config(
+        {"enabled": "yes", "mode": "strict", "batch_wait": "30", "model": ""}
+    )
+    assert settings.enabled
+    assert settings.mode == "strict"
+    assert settings.batch_wait == 30.0
+    assert settings.model == ""
+    assert not PrefilterSettings.from_config(None).enabled
+
+
+def test_disabled_replies_to_everything():
+    pf = Prefilter(PrefilterSettings.from_config({"enabled": "false"}))
+    assert pf.classify(1, "ok") is Decision.REPLY
+    assert pf.classify(1, None) is Decision.REPLY
+
+
+def test_questions_and_scam_topics_are_answered():
+    pf = make_prefilter()
+    assert pf.classify(1, "Hello dear, how are you?") is Decision.REPLY
+    assert pf.classify(1, "Send 200 USDT to my wallet") is Decision.REPLY
+    assert pf.classify(1, "Where do you live") is Decision.REPLY
+
+
+def test_acknowledgements_are_batched():
+    pf = make_prefilter()
+    assert pf.classify(1, "ok") is Decision.BATCH
+    assert pf.classify(1, "Thanks!") is Decision.BATCH
+    assert pf.classify(1, "👍") is Decision.BATCH
+
+
+def test_media_is_answered():
+    pf = make_prefilter(mode="strict")
+    assert pf.classify(1, None) is Decision.REPLY
+    assert pf.classify(1, "   ") is Decision.REPLY
+
+
+def test_strict_mode_skips_acknowledgements():
+    pf = make_prefilter(mode="strict")
+    assert pf.classify(1, "ok") is Decision.SKIP
+    assert pf.classify(1, "How are you?") is Decision.REPLY
+
+
+def test_repeats_within_the_window_are_skipped(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(prefilter.time, "monotonic", lambda: now[0])
+    pf = make_prefilter(repeat_window=60)
+    assert pf.classify(1, "Are you there?") is Decision.REPLY
+    now[0] += 10
+    assert pf.classify(1, "Are you there?") is Decision.SKIP
+    # Other chats and other spellings are not repeats
+    assert pf.classify(2, "Are you there?") is Decision.REPLY
+    assert pf.classify(1, "are you there?") is Decision.REPLY
+    # A follow-up later on is answered
+    now[0] += 3600
+    assert pf.classify(1, "Are you there?") is Decision.REPLY
+
+
+def test_chat_modes():
+    pf = make_prefilter(chat_modes="5: strict\nLena Olsen: off")
+    assert pf.mode(5) == "strict"
+    assert pf.mode(7, "Lena Olsen") == "off"
+    assert pf.mode(8, "Someone") == "normal"
+    assert pf.classify(5, "ok") is Decision.SKIP
+    assert pf.classify(7, "ok", "Lena Olsen") is Decision.REPLY
+    assert pf.classify(8, "ok") is Decision.BATCH
+
+
+def test_unknown_modes():
+    with pytest.raises(ValueError):
+        make_prefilter(mode="sometimes")
+    with pytest.raises(ValueError):
+        make_prefilter(chat_modes="5: sometimes")
+
+
+def test_features():
+    values = features("Hi, send $100 to https://example.com?")
+    assert values["question"] == 1
+    assert values["greeting"] == 1
+    assert values["money"] == 1
+    assert values["url"] == 1
+    assert values["digits"] == 1
+    assert values["acknowledgement"] == 0
+    assert features("ok ok")["acknowledgement"] == 1
+    assert features("!!! 🙂")["no_words"] == 1
+
+
+def test_model_weights_from_file(tmp_path):
+    path = tmp_path / "model.json"
+    path.write_text(json.dumps({"bias": 5, "weights": {}}))
+    model = ReplyModel.load(str(path))
+    assert model.score("anything") > 0.99
+    pf = make_prefilter(model=path)
+    assert pf.classify(1, "the weather") is Decision.REPLY
@@ -0,0 +1,145 @@
+import asyncio
+import time
+
+from ai_scambaiter.rate_limit import (
+    RateLimiter,
+    RateLimitServer,
+    RemoteRateLimiter,
+    TokenBucket,
+    backoff_delay,
+)
+
+
+def test_bucket_starts_full_and_waits_when_empty():
+    async def main():
+        bucket = TokenBucket(2, 20)
+        start = time.monotonic()
+        await bucket.acquire(1)
+        await bucket.acquire(1)
+        immediate = time.monotonic() - start
+        await bucket.acquire(1)
+        return immediate, time.monotonic() - start
+
+    immediate, total = asyncio.run(main())
+    assert immediate < 0.02
+    assert total >= 0.04
+
+
+def test_bucket_lets_oversized_request_through_when_full():
+    async def main():
+        bucket = TokenBucket(10, 1000)
+        await asyncio.wait_for(bucket.acquire(100), 1)
+        return bucket.level
+
+    assert asyncio.run(main()) < 1
+
+
+def test_bucket_serves_waiters_in_order():
+    async def main():
+        bucket = TokenBucket(10, 100)
+        await bucket.acquire(10)
+        order = []
+
+        async def acquire(name, amount):
+            await bucket.acquire(amount)
+            order.append(name)
+
+        large = asyncio.create_task(acquire("large", 8))
+        await asyncio.sleep(0)
+        small = [asyncio.create_task(acquire(f"small{i}", 1)) for i in range(3)]
+        await asyncio.gather(large, *small)
+        return order
+
+    assert asyncio.run(main())[0] == "large"
+
+
+def test_bucket_adjust():
+    async def main():
+        bucket = TokenBucket(10, 0.001)
+        await bucket.acquire(5)
+        bucket.adjust(3)
+        after_return = bucket.level
+        bucket.adjust(-20)
+        after_take = bucket.level
+        bucket.adjust(100)
+        return after_return, after_take, bucket.level
+
+    after_return, after_take, capped = asyncio.run(main())
+    assert round(after_return) == 8
+    assert round(after_take) == -12
+    assert capped == 10
+
+
+def test_rate_limiter_caps_concurrency():
+    async def main():
+        limiter = RateLimiter(6000, 10**6, max_concurrency=2)
+        active = 0
+        max_active = 0
+
+        async def request():
+            nonlocal active, max_active
+            async with limiter.reserve(10):
+                active += 1
+                max_active = max(max_active, active)
+                await asyncio.sleep(0.01)
+                active -= 1
+
+        await asyncio.gather(*(request() for _ in range(6)))
+        return max_active
+
+    assert asyncio.run(main()) == 2
+
+
+def test_rate_limiter_limits_tokens():
+    async def main():
+        # 60 tokens per second
+        limiter = RateLimiter(6000, 3600, max_concurrency=10)
+        start = time.monotonic()
+        async with limiter.reserve(3600):
+            pass
+        async with limiter.reserve(3):
+            pass
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) >= 0.04
+
+
+def test_remote_rate_limiter_shares_the_budget():
+    async def main():
+        # 100 tokens per second for all clients together
+        server = RateLimitServer(6000, 6000)
+        await server.start()
+        first, second = (RemoteRateLimiter(server.address, 6000, 6000, 4) for _ in "ab")
+        try:
+            async with first.reserve(6000):
+                pass
+            start = time.monotonic()
+            # The local budget of the second client is full, the shared one empty
+            async with second.reserve(5):
+                pass
+            return time.monotonic() - start
+        finally:
+            await server.stop()
+
+    assert asyncio.run(main()) >= 0.04
+
+
+def test_remote_rate_limiter_falls_back_to_local_budget():
+    async def main():
+        server = RateLimitServer(60, 1000)
+        await server.start()
+        address = server.address
+        await server.stop()
+        limiter = RemoteRateLimiter(address, 60, 1000, 1)
+        async with limiter.reserve(10):
+            pass
+        limiter.adjust_tokens(-5)
+        return limiter.tokens.level
+
+    assert round(asyncio.run(main())) == 985
+
+
+def test_backoff_delay():
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt) <= 60
+    assert backoff_delay(0, retry_after=5) >= 5
@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+
+from ai_scambaiter import GPTMessage, Role
+from ai_scambaiter.recording import TrafficRecorder, TrafficRecording, request_key
+
+
+def test_recording_is_read_back(tmp_path):
+    path = str(tmp_path / "traffic.jsonl.gz")
+    recorder = TrafficRecorder(path)
+    recorder.record_dialogs({5: SimpleNamespace(title="Scammer")})
+    for i in range(100):
+        recorder.record_message(
+            SimpleNamespace(chat_id=5, id=i, sender_id=5, text=f"Message {i}")
+        )
+    prompt = [GPTMessage(content="Message 99", role=Role.USER, n_tokens=3)]
+    recorder.record_completion(prompt, "Reply", 0.5)
+    # Writes the records still waiting for the recorder's thread
+    recorder.close()
+
+    recording = TrafficRecording.load(path)
+    assert recording.dialogs == {5: "Scammer"}
+    assert [m.id for m in recording.messages] == list(range(100))
+    assert recording.messages[-1].text == "Message 99"
+    assert list(recording.completions[request_key(prompt)]) == [("Reply", 0.5)]
+
+
+def test_nothing_is_recorded_without_path():
+    recorder = TrafficRecorder()
+    recorder.record_message(SimpleNamespace(chat_id=5, id=1, sender_id=5, text="Hi"))
+    assert not recorder.enabled
+    recorder.close()
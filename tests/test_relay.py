@@ -0,0 +1,104 @@
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+from ai_scambaiter import relay as relay_module
+from ai_scambaiter.relay import RelayTelegramInterface, TelegramRelay
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.messages = asyncio.Queue()
+        self.sent = []
+        self.monitored = None
+
+    def set_monitored_chats(self, chat_ids):
+        self.monitored = set(chat_ids)
+
+    async def message_stream(self):
+        while True:
+            yield await self.messages.get()
+
+    async def get_dialog(self, key):
+        return SimpleNamespace(id=int(key), title=f"Chat {key}")
+
+    async def get_messages(self, chat_id, number_of_messages, oldest_first, min_id):
+        return [message(chat_id, i) for i in range(min_id + 1, number_of_messages + 1)]
+
+    async def send_message(self, chat_id, text, replace=False):
+        self.sent.append((chat_id, text, replace))
+        return True
+
+    @contextlib.asynccontextmanager
+    async def typing(self, chat_id):
+        yield
+
+
+def message(chat_id, message_id, text="hello"):
+    return SimpleNamespace(chat_id=chat_id, id=message_id, sender_id=chat_id, text=text)
+
+
+async def start_relay(tmp_path, n_workers):
+    telegram = FakeTelegram()
+    relay = TelegramRelay(telegram, str(tmp_path / "relay.sock"))
+    await relay.start(n_workers)
+    return relay, telegram, asyncio.create_task(relay.run())
+
+
+async def stop_relay(relay, run):
+    run.cancel()
+    await relay.stop()
+
+
+def test_round_trip(tmp_path):
+    async def main():
+        relay, telegram, run = await start_relay(tmp_path, 1)
+        worker = RelayTelegramInterface(relay.path)
+        await worker.start()
+        worker.set_monitored_chats([5])
+        telegram.messages.put_nowait(message(5, 1, "Hi there"))
+        received = await anext(worker.message_stream())
+        dialog = await worker.get_dialog("5")
+        history = await worker.get_messages(5, 3, min_id=1)
+        sent = await worker.send_message(5, "Hello", replace=True)
+        monitored = telegram.monitored
+        await stop_relay(relay, run)
+        return telegram, monitored, received, dialog, history, sent
+
+    telegram, monitored, received, dialog, history, sent = asyncio.run(main())
+    assert monitored == {5}
+    assert (received.chat_id, received.id, received.sender_id) == (5, 1, 5)
+    assert received.text == "Hi there"
+    assert (dialog.id, dialog.title) == (5, "Chat 5")
+    assert [m.id for m in history] == [2, 3]
+    assert sent is True
+    assert telegram.sent == [(5, "Hello", True)]
+
+
+def test_slow_worker_does_not_hold_up_the_others(tmp_path, monkeypatch):
+    monkeypatch.setattr(relay_module, "WORKER_QUEUE_SIZE", 2)
+
+    async def main():
+        relay, telegram, run = await start_relay(tmp_path, 2)
+        # Reports its chat, but never reads
+        _, slow = await asyncio.open_unix_connection(relay.path)
+        slow.write(b'{"op": "monitor", "chats": [1]}\n')
+        worker = RelayTelegramInterface(relay.path)
+        await worker.start()
+        worker.set_monitored_chats([2])
+        await asyncio.sleep(0.05)
+        for i in range(50):
+            telegram.messages.put_nowait(message(1, i, "x" * 100_000))
+            telegram.messages.put_nowait(message(2, i))
+        stream = worker.message_stream()
+        received = [(await anext(stream)).id for _ in range(50)]
+        monitored = telegram.monitored
+        slow.close()
+        await stop_relay(relay, run)
+        return received, monitored, relay.dropped
+
+    received, monitored, dropped = asyncio.run(main())
+    assert received == list(range(50))
+    # The slow worker was disconnected, its chat is no longer monitored
+    assert monitored == {2}
+    assert dropped > 0
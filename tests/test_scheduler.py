@@ -0,0 +1,225 @@
+import asyncio
+import time
+
+from ai_scambaiter.scheduler import Scheduler
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_jobs_run_in_deadline_order():
+    async def main():
+        scheduler = Scheduler()
+        order = []
+
+        def job(name):
+            async def run_job():
+                order.append(name)
+
+            return run_job
+
+        scheduler.schedule("c", 0.03, job("c"))
+        scheduler.schedule("a", 0.01, job("a"))
+        scheduler.schedule("b", 0.02, job("b"))
+        assert scheduler.pending == 3
+        await asyncio.sleep(0.1)
+        return order, scheduler
+
+    order, scheduler = run(main())
+    assert order == ["a", "b", "c"]
+    assert scheduler.pending == 0
+    assert scheduler.running == 0
+
+
+def test_reschedule_replaces_deadline():
+    async def main():
+        scheduler = Scheduler()
+        calls = []
+
+        async def job():
+            calls.append(asyncio.get_running_loop().time())
+
+        start = asyncio.get_running_loop().time()
+        scheduler.schedule("key", 0.01, job)
+        scheduler.schedule("key", 0.05, job)
+        assert scheduler.pending == 1
+        await asyncio.sleep(0.03)
+        assert calls == []
+        await asyncio.sleep(0.05)
+        return [t - start for t in calls]
+
+    calls = run(main())
+    assert len(calls) == 1
+    assert calls[0] >= 0.05
+
+
+def test_reschedule_earlier_fires_early():
+    async def main():
+        scheduler = Scheduler()
+        calls = []
+
+        async def job():
+            calls.append("ran")
+
+        scheduler.schedule("key", 10, job)
+        scheduler.schedule("key", 0.01, job)
+        await asyncio.sleep(0.05)
+        return calls
+
+    assert run(main()) == ["ran"]
+
+
+def test_cancel_removes_pending_deadline():
+    async def main():
+        scheduler = Scheduler()
+        calls = []
+
+        async def job():
+            calls.append("ran")
+
+        scheduler.schedule("key", 0.01, job)
+        scheduler.cancel("key")
+        scheduler.cancel("unknown")
+        assert not scheduler.is_active("key")
+        await asyncio.sleep(0.05)
+        return calls
+
+    assert run(main()) == []
+
+
+def test_cancel_running_job():
+    async def main():
+        scheduler = Scheduler()
+        started = asyncio.Event()
+        cancelled = []
+
+        async def job():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        scheduler.schedule("key", 0, job)
+        await started.wait()
+        assert scheduler.is_active("key")
+        assert scheduler.running == 1
+        task = scheduler.cancel_running("key")
+        assert task is not None
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert scheduler.cancel_running("key") is None
+        return cancelled, scheduler
+
+    cancelled, scheduler = run(main())
+    assert cancelled == [True]
+    assert scheduler.running == 0
+    assert not scheduler.is_active("key")
+
+
+def test_failing_job_does_not_stop_others():
+    async def main():
+        scheduler = Scheduler()
+        calls = []
+
+        async def failing():
+            raise RuntimeError("boom")
+
+        async def job():
+            calls.append("ran")
+
+        scheduler.schedule("failing", 0, failing)
+        scheduler.schedule("ok", 0.01, job)
+        await asyncio.sleep(0.05)
+        return calls, scheduler
+
+    calls, scheduler = run(main())
+    assert calls == ["ran"]
+    assert scheduler.running == 0
+
+
+def test_max_workers():
+    async def main():
+        scheduler = Scheduler(max_workers=2)
+        active = 0
+        max_active = 0
+
+        async def job():
+            nonlocal active, max_active
+            active += 1
+            max_active = max(max_active, active)
+            await asyncio.sleep(0.02)
+            active -= 1
+
+        for i in range(6):
+            scheduler.schedule(i, 0, job)
+        await asyncio.sleep(0.15)
+        return max_active
+
+    assert run(main()) == 2
+
+
+def test_snapshot_includes_pending_and_running():
+    async def main():
+        scheduler = Scheduler()
+        started = asyncio.Event()
+
+        async def blocking():
+            started.set()
+            await asyncio.sleep(10)
+
+        async def job():
+            pass
+
+        now = time.time()
+        scheduler.schedule("running", 0, blocking)
+        scheduler.schedule("pending", 60, job)
+        await started.wait()
+        snapshot = scheduler.snapshot()
+        scheduler.cancel_running("running")
+        scheduler.cancel("pending")
+        return now, snapshot
+
+    now, snapshot = run(main())
+    assert set(snapshot) == {"running", "pending"}
+    assert abs(snapshot["running"] - now) < 1
+    assert abs(snapshot["pending"] - (now + 60)) < 1
+
+
+def test_version_changes_with_deadlines():
+    async def main():
+        scheduler = Scheduler()
+
+        async def job():
+            pass
+
+        versions = [scheduler.version]
+        scheduler.schedule("key", 60, job)
+        versions.append(scheduler.version)
+        scheduler.cancel("key")
+        versions.append(scheduler.version)
+        scheduler.cancel("key")
+        versions.append(scheduler.version)
+        return versions
+
+    versions = run(main())
+    assert versions[0] < versions[1] < versions[2] == versions[3]
+
+
+def test_many_reschedules_keep_heap_small():
+    async def main():
+        scheduler = Scheduler()
+
+        async def job():
+            pass
+
+        for i in range(10000):
+            scheduler.schedule(i % 10, 60 + i, job)
+        heap_size = len(scheduler._heap)
+        for key in range(10):
+            scheduler.cancel(key)
+        return heap_size
+
+    assert run(main()) <= 1024 + 1
@@ -0,0 +1,48 @@
+from ai_scambaiter.chatgpt_interface import TokenCountCache
+
+
+def test_counts_in_memory():
+    cache = TokenCountCache("enc")
+    assert cache.get_many(["a", "b"]) == [None, None]
+    cache.put_many(["a", "b"], [1, 2])
+    assert cache.get_many(["b", "a", "c", "a"]) == [2, 1, None, 1]
+    assert cache.hits == 3
+    assert cache.misses == 3
+
+
+def test_least_recently_used_is_evicted():
+    cache = TokenCountCache("enc", max_size=2)
+    cache.put_many(["a", "b"], [1, 2])
+    # "a" is used again, so "b" is the oldest
+    cache.get_many(["a"])
+    cache.put_many(["c"], [3])
+    assert cache.get_many(["a", "b", "c"]) == [1, None, 3]
+
+
+def test_flushed_counts_are_read_back(tmp_path):
+    path = str(tmp_path / "tokens.db")
+    cache = TokenCountCache("enc", path=path)
+    cache.put_many(["hello", "world"], [5, 7])
+    cache.flush()
+    reopened = TokenCountCache("enc", path=path)
+    assert reopened.get_many(["world", "new"]) == [7, None]
+    # Now in memory as well
+    assert reopened.get_many(["world"], from_disk=False) == [7]
+
+
+def test_disk_is_not_read_for_callers_on_the_event_loop(tmp_path):
+    path = str(tmp_path / "tokens.db")
+    cache = TokenCountCache("enc", path=path)
+    cache.put_many(["hello"], [5])
+    cache.flush()
+    reopened = TokenCountCache("enc", path=path)
+    assert reopened.get_many(["hello"], from_disk=False) == [None]
+    assert reopened.get_many(["hello"]) == [5]
+
+
+def test_counts_of_other_encodings_are_not_used(tmp_path):
+    path = str(tmp_path / "tokens.db")
+    cache = TokenCountCache("enc", path=path)
+    cache.put_many(["hello"], [5])
+    cache.flush()
+    assert TokenCountCache("other", path=path).get_many(["hello"]) == [None]